@@ -0,0 +1,122 @@
+"""Сравнение агрегации КН/дохода: по ночам (прежняя) и разностными массивами.
+
+Перед замером сравнивает результаты: КН должны совпасть точно, доход - с
+допуском INCOME_ABS_TOL. Побитового совпадения дохода нет: прежняя агрегация
+складывает доход за ночь в порядке бронирований, новая - префиксной суммой
+дельт (с компенсацией), и округления float происходят в другом порядке.
+На 1 млн бронирований расхождение - до ~1e-7 руб. (относительное ~1e-11),
+допуск - сотая доля копейки; при записи в таблицу (2 знака) расхождение не
+видно. Скрипт печатает фактическое расхождение.
+
+Запуск из папки backend:
+    python benchmarks/bench_aggregation.py --bookings 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute  # noqa: E402
+import main  # noqa: E402
+
+SETTINGS = {city: '' for city in [
+    'Балашиха', 'Железнодорожный', 'Жуковский', 'Ивантеевка', 'Казань',
+    'Королев', 'Люберцы', 'Мытищи', 'Ногинск', 'Пушкино',
+    'Раменское', 'Сергиев Посад', 'Фрязино', 'Щелково', 'Электросталь'
+]}
+
+
+def generate_rows(count: int, seed: int = 42) -> list:
+    """Бронирования с длинным хвостом по длительности (до 120 ночей)"""
+    rng = random.Random(seed)
+    cities = list(SETTINGS)
+    start = date(2025, 1, 1)
+    rows = []
+    for _ in range(count):
+        city = rng.choice(cities)
+        check_in = start + timedelta(days=rng.randrange(365))
+        nights = 1 + int(rng.expovariate(1 / 6)) if rng.random() > 0.05 else rng.randrange(30, 120)
+        check_out = check_in + timedelta(days=nights)
+        rows.append([
+            f"{city} кв. {rng.randrange(200)}",
+            check_in.strftime('%d.%m.%Y'),
+            check_out.strftime('%d.%m.%Y'),
+            'Гость', '2', 'Сайт',
+            f"{rng.randrange(1500, 300000)},{rng.randrange(100):02d}",
+            '-',
+        ])
+    return rows
+
+
+def legacy_process(data, settings):
+    """Прежняя агрегация: кортеж на каждую ночь и обновление словаря"""
+    city_data = {}
+    for row in data:
+        city = main.get_city_from_object_name(row[0], settings)
+        calculations = compute.calculate_room_nights_and_income(row[1], row[2], row[6])
+        if not city or not calculations:
+            continue
+        dates = city_data.setdefault(city, {})
+        for day, kn, income in calculations:
+            if day not in dates:
+                dates[day] = {'kn': 0, 'income': 0}
+            dates[day]['kn'] += kn
+            dates[day]['income'] += income
+    return city_data
+
+
+INCOME_ABS_TOL = 1e-4  # Допустимое расхождение дохода за день (руб.) - сотая доля копейки
+
+
+def compare_results(expected, actual) -> dict:
+    """Проверяет КН (точно) и доход (с допуском INCOME_ABS_TOL); возвращает расхождение дохода"""
+    assert expected.keys() == actual.keys(), 'Разный набор городов'
+    stats = {'values': 0, 'different': 0, 'max_abs': 0.0, 'max_rel': 0.0}
+    for city, dates in expected.items():
+        assert dates.keys() == actual[city].keys(), f'Разный набор дат для {city}'
+        for day, values in dates.items():
+            got = actual[city][day]
+            assert values['kn'] == got['kn'], f'КН {city} {day}: {values["kn"]} != {got["kn"]}'
+            diff = abs(values['income'] - got['income'])
+            assert diff <= INCOME_ABS_TOL, f'Доход {city} {day}: {values["income"]} != {got["income"]}'
+            stats['values'] += 1
+            if diff:
+                stats['different'] += 1
+                stats['max_abs'] = max(stats['max_abs'], diff)
+                stats['max_rel'] = max(stats['max_rel'], diff / abs(values['income']))
+    return stats
+
+
+def timed(func):
+    started = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - started
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bookings', type=int, default=1000000)
+    args = parser.parse_args()
+
+    rows = generate_rows(args.bookings)
+    sample = rows[:10000]
+    nights = sum((compute.parse_date(r[2]) - compute.parse_date(r[1])).days for r in sample)
+    print(f"Бронирований: {len(rows)}, в среднем ночей: {nights / len(sample):.1f}")
+
+    expected, legacy_time = timed(lambda: legacy_process(rows, SETTINGS))
+    (actual, warnings), new_time = timed(lambda: compute.process_xls_data(rows, SETTINGS))
+    assert not warnings, warnings[:5]
+    stats = compare_results(expected, actual)
+    print(f"КН совпадают точно; доход отличается в {stats['different']} из {stats['values']} значений: "
+          f"до {stats['max_abs']:.2e} руб. (отн. {stats['max_rel']:.1e}), допуск {INCOME_ABS_TOL:g} руб.")
+
+    print(f"по ночам              {legacy_time:8.2f} с")
+    print(f"разностные массивы    {new_time:8.2f} с  (x{legacy_time / new_time:.1f})")
+
+
+if __name__ == '__main__':
+    main_cli()
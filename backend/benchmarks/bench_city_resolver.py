@@ -0,0 +1,74 @@
+"""Определение города: прежний перебор startswith против CityResolver.
+
+Запуск из папки backend:
+    python benchmarks/bench_city_resolver.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute  # noqa: E402
+
+CITIES = [
+    'Балашиха', 'Железнодорожный', 'Жуковский', 'Ивантеевка', 'Казань',
+    'Королев', 'Люберцы', 'Мытищи', 'Ногинск', 'Пушкино',
+    'Раменское', 'Сергиев Посад', 'Фрязино', 'Щелково', 'Электросталь'
+]
+
+
+def legacy_city(object_name, settings):
+    """Прежняя реализация get_city_from_object_name"""
+    if not object_name:
+        return None
+    first_word = object_name.split()[0].strip()
+    if first_word == "Сергиев":
+        return "Сергиев Посад"
+    for city in settings.keys():
+        if city.startswith(first_word):
+            return city
+    return None
+
+
+def make_names(rows: int, objects: int, seed: int = 7) -> list:
+    """Названия объектов: города, сокращения и неизвестные префиксы"""
+    rng = random.Random(seed)
+    prefixes = [city.split()[0] for city in CITIES] + ['Жуков', 'Москва', 'Тула', 'Кор']
+    pool = [f"{rng.choice(prefixes)} ул. Ленина {i}" for i in range(objects)]
+    return [rng.choice(pool) for _ in range(rows)]
+
+
+def timed(name: str, func, names):
+    started = time.perf_counter()
+    for name_value in names:
+        func(name_value)
+    elapsed = time.perf_counter() - started
+    print(f"  {name:<16} {elapsed:7.3f} с  {elapsed / len(names) * 1e9:8.0f} нс/строка")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--objects', type=int, default=3000)
+    parser.add_argument('--cities', type=int, default=len(CITIES),
+                        help='число городов в настройках (лишние генерируются)')
+    args = parser.parse_args()
+
+    cities = CITIES + [f"Город{i}" for i in range(max(0, args.cities - len(CITIES)))]
+    settings = {city: '' for city in cities}
+    names = make_names(args.rows, args.objects)
+
+    resolver = compute.CityResolver(settings)
+    for name_value in set(names):
+        assert legacy_city(name_value, settings) == resolver.resolve(name_value), name_value
+
+    print(f"{args.rows} строк, {args.objects} объектов, {len(cities)} городов")
+    timed('перебор', lambda value: legacy_city(value, settings), names)
+    timed('CityResolver', compute.CityResolver(settings).resolve, names)
+
+
+if __name__ == '__main__':
+    main_cli()
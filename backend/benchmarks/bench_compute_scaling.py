@@ -0,0 +1,68 @@
+"""Масштабирование разбора и агрегации: пул потоков против пула из 1..N процессов.
+
+Перед замерами проверяет, что результаты всех вариантов совпадают.
+
+Запуск из папки backend:
+    python benchmarks/bench_compute_scaling.py --bookings 500000 --max-workers 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from bench_aggregation import SETTINGS, assert_equivalent, generate_rows  # noqa: E402
+from bench_xml_parse import FOOTER, HEADER  # noqa: E402
+
+
+def write_export(path: str, rows: list):
+    """Выгрузка XML Spreadsheet 2003 из сгенерированных бронирований"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(HEADER)
+        for row in rows:
+            cells = ''.join(f'<Cell><Data ss:Type="String">{escape(value)}</Data></Cell>' for value in row)
+            f.write(f'<Row>{cells}</Row>\n')
+        f.write(FOOTER)
+
+
+def timed(backend, path: str):
+    started = time.perf_counter()
+    result = backend.aggregate_file(path, SETTINGS)
+    return result, time.perf_counter() - started
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bookings', type=int, default=500000)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--chunk-rows', type=int, default=main.COMPUTE_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.xls')
+        write_export(path, generate_rows(args.bookings))
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"Бронирований: {args.bookings}, файл {size_mb:.1f} МБ, ядер: {os.cpu_count()}")
+
+        (expected, expected_warnings, _), baseline = timed(main.ThreadComputeBackend(), path)
+        print(f"  {'поток':<14} {baseline:7.2f} с")
+
+        for workers in range(1, args.max_workers + 1):
+            # split_bytes=0 - файл всегда делится на диапазоны строк
+            backend = main.ProcessComputeBackend(workers=workers, chunk_rows=args.chunk_rows, split_bytes=0)
+            backend.start()
+            try:
+                (actual, warnings, _), elapsed = timed(backend, path)
+            finally:
+                backend.shutdown()
+            assert warnings == expected_warnings, warnings[:5]
+            assert_equivalent(expected, actual)
+            print(f"  {f'процессов: {workers}':<14} {elapsed:7.2f} с  (x{baseline / elapsed:.2f})")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,67 @@
+"""Микробенчмарк разбора дат: цепочка strptime против DateParser с кэшем.
+
+Запуск из папки backend:
+    python benchmarks/bench_parse_date.py --calls 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute  # noqa: E402
+
+
+def legacy_parse_date(date_str):
+    """Прежняя реализация parse_date"""
+    if not date_str:
+        return None
+    date_str = date_str.strip()
+    for fmt in compute.DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def make_values(calls: int, distinct: int, fmt: str, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    start = date(2025, 1, 1)
+    pool = [(start + timedelta(days=i)).strftime(fmt) for i in range(distinct)]
+    return [rng.choice(pool) for _ in range(calls)]
+
+
+def run(name: str, func, values):
+    started = time.perf_counter()
+    for value in values:
+        func(value)
+    elapsed = time.perf_counter() - started
+    print(f"  {name:<22} {elapsed:7.3f} с  {elapsed / len(values) * 1e9:8.0f} нс/вызов")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=1000000)
+    parser.add_argument('--distinct', type=int, default=400)
+    args = parser.parse_args()
+
+    for fmt in compute.DATE_FORMATS:
+        values = make_values(args.calls, args.distinct, fmt)
+        print(f"Формат {fmt}, {args.calls} вызовов, {args.distinct} разных строк")
+        for value in values[:1000]:
+            assert legacy_parse_date(value) == compute.DateParser().parse(value), value
+
+        run('strptime', legacy_parse_date, values)
+        uncached = compute.DateParser(max_size=0)
+        run('без кэша (быстрый путь)', uncached._parse_uncached, values)
+        cached = compute.DateParser()
+        run('DateParser', cached.parse, values)
+        print(f"  статистика кэша: {cached.stats()}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,113 @@
+"""Нагрузочный тест опроса статуса: полный ответ, курсор since и ETag/304.
+
+Запускает сервер в отдельном процессе с синтетической задачей (длинный журнал)
+и измеряет байты ответа и процессорное время сервера на один запрос.
+Время процессора берётся из /proc, поэтому оно есть только в Linux.
+
+Запуск из папки backend:
+    python benchmarks/bench_status_polling.py --polls 2000 --log-lines 400
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_CODE = """
+import sys
+import uvicorn
+import main
+
+main.task_store.log_limit = {log_lines}
+main.task_store.create('bench', total=15, message='Задача создана')
+for i in range({log_lines}):
+    main.task_store.log('bench', f'Город {{i % 15}}: записано ячеек {{i * 7}}, пропущено {{i * 3}}')
+main.task_store.set_progress('bench', current=7, current_city='Королев')
+uvicorn.run(main.app, host='127.0.0.1', port={port}, log_level='warning')
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_cpu_seconds(pid: int):
+    """utime + stime процесса из /proc или None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def wait_for_server(base_url: str, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f'{base_url}/health', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError('Сервер не запустился')
+
+
+def measure(name: str, session, url: str, polls: int, pid: int, **kwargs):
+    cpu_before = server_cpu_seconds(pid)
+    started = time.perf_counter()
+    total_bytes = 0
+    statuses = set()
+    for _ in range(polls):
+        response = session.get(url, **kwargs)
+        total_bytes += len(response.content)
+        statuses.add(response.status_code)
+    elapsed = time.perf_counter() - started
+    cpu_after = server_cpu_seconds(pid)
+    cpu = f'{(cpu_after - cpu_before) / polls * 1000:6.3f} мс' if cpu_before is not None else '   н/д'
+    print(f"  {name:<16} {total_bytes / polls:9.0f} байт/запрос  CPU сервера {cpu}/запрос  "
+          f"{elapsed / polls * 1000:6.2f} мс/запрос  коды {sorted(statuses)}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--polls', type=int, default=2000)
+    parser.add_argument('--log-lines', type=int, default=400)
+    args = parser.parse_args()
+
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    code = SERVER_CODE.format(log_lines=args.log_lines, port=port)
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=BACKEND_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server(base_url)
+        session = requests.Session()
+        token = session.post(f'{base_url}/api/login',
+                             json={'username': 'admin', 'password': 'portcomfort'}).json()['token']
+        session.headers['Authorization'] = f'Bearer {token}'
+        url = f'{base_url}/api/status/bench'
+
+        first = session.get(url)
+        etag = first.headers['ETag']
+        cursor = first.json()['success_total']
+
+        print(f"{args.polls} запросов, журнал {args.log_lines} строк")
+        measure('полный статус', session, url, args.polls, server.pid)
+        measure('курсор since', session, url, args.polls, server.pid,
+                params={'since': cursor, 'errors_since': 0})
+        measure('If-None-Match', session, url, args.polls, server.pid,
+                headers={'If-None-Match': etag})
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main_cli()
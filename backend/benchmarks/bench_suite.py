@@ -0,0 +1,190 @@
+"""Набор бенчмарков горячих участков обработки с JSON-отчётом и сравнением с базой.
+
+По каждому этапу меряется время (лучшее и медиана из --repeat прогонов),
+пиковая память (tracemalloc, отдельным прогоном, чтобы трассировка не искажала
+время) и прирост живых блоков памяти (sys.getallocatedblocks до и после
+прогона - грубая оценка того, что этап оставляет после себя).
+
+Входные данные генерируются детерминированно (synthetic_export.py), поэтому
+результаты разных запусков и машин сравнимы при одинаковых параметрах.
+
+Запуск из папки backend:
+    python benchmarks/bench_suite.py --output results.json
+    python benchmarks/bench_suite.py --baseline benchmarks/baseline.json
+    python benchmarks/bench_suite.py --rows 100000 --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute  # noqa: E402
+import main  # noqa: E402
+from synthetic_export import SETTINGS, add_arguments, generate_rows, generator_params, write_export  # noqa: E402
+
+
+def fresh_caches():
+    """Сбрасывает кэши дат и городов, чтобы каждый прогон начинался с холодного состояния"""
+    compute.date_parser = compute.DateParser()
+    compute._city_resolver = None
+    compute._city_resolver_key = None
+
+
+def build_stages(path: str) -> list:
+    """Этапы: (имя, функция без аргументов, возвращающая число обработанных элементов)"""
+    rows = compute.parse_excel_xml_2003(path)
+    bookings = [(row[1], row[2], row[6]) for row in rows[1:] if len(row) >= 7]
+    dates = [value for check_in, check_out, _ in bookings for value in (check_in, check_out)]
+    names = [row[0] for row in rows[1:] if row]
+
+    def xml_parse():
+        return sum(1 for _ in compute.iter_excel_xml_2003_rows(path))
+
+    def aggregate():
+        compute.process_xls_data(rows, SETTINGS)
+        return len(rows)
+
+    def room_nights():
+        for check_in, check_out, amount in bookings:
+            compute.calculate_room_nights_and_income(check_in, check_out, amount)
+        return len(bookings)
+
+    def parse_date():
+        for value in dates:
+            compute.parse_date(value)
+        return len(dates)
+
+    def city_resolve():
+        for name in names:
+            main.get_city_from_object_name(name, SETTINGS)
+        return len(names)
+
+    def end_to_end():
+        _, _, rows_count = main.ThreadComputeBackend().aggregate_file(path, SETTINGS)
+        return rows_count
+
+    return [
+        ('xml_parse', xml_parse),
+        ('aggregate', aggregate),
+        ('room_nights', room_nights),
+        ('parse_date', parse_date),
+        ('city_resolve', city_resolve),
+        ('end_to_end', end_to_end),
+    ]
+
+
+def run_stage(fn, repeat: int) -> dict:
+    times = []
+    blocks = 0
+    for _ in range(repeat):
+        fresh_caches()
+        gc.collect()
+        blocks_before = sys.getallocatedblocks()
+        started = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - started)
+        gc.collect()
+        blocks = sys.getallocatedblocks() - blocks_before
+
+    fresh_caches()
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return {
+        'items': items,
+        'best_s': round(best, 4),
+        'median_s': round(statistics.median(times), 4),
+        'ns_per_item': round(best / items * 1e9, 1) if items else None,
+        'peak_mb': round(peak / 1024 / 1024, 2),
+        'net_blocks': blocks,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Список регрессий: этапы, где время или пиковая память выросли больше порога"""
+    regressions = []
+    for name, current in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base:
+            continue
+        for metric in ('best_s', 'peak_mb'):
+            if base[metric] and current[metric] > base[metric] * (1 + threshold):
+                change = current[metric] / base[metric] - 1
+                regressions.append(f"{name}.{metric}: {base[metric]} -> {current[metric]} (+{change:.0%})")
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', default='', help='этапы через запятую (по умолчанию все)')
+    parser.add_argument('--output', help='куда записать результаты в JSON')
+    parser.add_argument('--baseline', help='JSON с базовыми результатами для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.15, help='допустимый рост времени и памяти')
+    parser.add_argument('--save-baseline', help='записать результаты как новую базу')
+    args = parser.parse_args()
+
+    params = generator_params(args)
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': args.repeat,
+            'params': params,
+        },
+        'stages': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.xls')
+        write_export(path, generate_rows(**params))
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        print(f"Строк: {args.rows}, файл {size_mb:.1f} МБ, повторов: {args.repeat}")
+
+        selected = {name for name in args.stages.split(',') if name}
+        for name, fn in build_stages(path):
+            if selected and name not in selected:
+                continue
+            stats = run_stage(fn, args.repeat)
+            results['stages'][name] = stats
+            print(f"  {name:<13} {stats['best_s']:8.3f} с (медиана {stats['median_s']:.3f})  "
+                  f"{stats['ns_per_item']:>8} нс/эл.  пик {stats['peak_mb']:7.2f} МБ  блоков {stats['net_blocks']:+d}")
+
+    for target in (args.output, args.save_baseline):
+        if target:
+            with open(target, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            print(f"Результаты записаны: {target}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['meta'].get('params') != params:
+            print("Внимание: параметры данных отличаются от базы, сравнение неточное")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Регрессии (порог {args.threshold:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"Регрессий нет (порог {args.threshold:.0%})")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,90 @@
+"""Сравнение потокового парсера XML Spreadsheet 2003 с прежним (ET.parse).
+
+Запуск из папки backend:
+    python benchmarks/bench_xml_parse.py --rows 200000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compute  # noqa: E402
+
+HEADER = (
+    '<?xml version="1.0"?>\n'
+    '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" '
+    'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+    '<Worksheet ss:Name="Sheet1"><Table>\n'
+)
+FOOTER = '</Table></Worksheet></Workbook>\n'
+CITIES = ['Балашиха', 'Казань', 'Мытищи', 'Сергиев', 'Щелково']
+
+
+def write_sample(path: str, rows: int):
+    """Пишет простую выгрузку с rows строками бронирований"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(HEADER)
+        for i in range(rows):
+            city = CITIES[i % len(CITIES)]
+            day = i % 28 + 1
+            f.write(
+                '<Row>'
+                f'<Cell><Data ss:Type="String">{city} Номер {i % 50}</Data></Cell>'
+                f'<Cell><Data ss:Type="String">{day:02d}.03.2025</Data></Cell>'
+                f'<Cell><Data ss:Type="String">{day:02d}.04.2025</Data></Cell>'
+                '<Cell><Data ss:Type="String">Гость</Data></Cell>'
+                '<Cell><Data ss:Type="String">2</Data></Cell>'
+                '<Cell><Data ss:Type="String">Сайт</Data></Cell>'
+                f'<Cell><Data ss:Type="Number">{1000 + i % 9000}</Data></Cell>'
+                '<Cell><Data ss:Type="String">-</Data></Cell>'
+                '</Row>\n'
+            )
+        f.write(FOOTER)
+
+
+def legacy_parse(file_path: str) -> list:
+    """Прежняя реализация: всё дерево в памяти"""
+    ns = {'ss': 'urn:schemas-microsoft-com:office:spreadsheet'}
+    root = ET.parse(file_path).getroot()
+    table = root.find('.//ss:Worksheet', ns).find('.//ss:Table', ns)
+    data = []
+    for row in table.findall('ss:Row', ns):
+        data.append([
+            (cell.find('ss:Data', ns).text if cell.find('ss:Data', ns) is not None else '')
+            for cell in row.findall('ss:Cell', ns)
+        ])
+    return data
+
+
+def measure(name: str, func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {rows:>9} строк  {elapsed:8.2f} с  пик памяти {peak / 1024 / 1024:8.1f} МБ")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.xls')
+        write_sample(path, args.rows)
+        print(f"Файл: {os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+
+        measure('ET.parse', lambda: len(legacy_parse(path)))
+        # Потоковый парсер: строки не накапливаются, только считаются
+        measure('iterparse', lambda: sum(1 for _ in compute.iter_excel_xml_2003_rows(path)))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,112 @@
+"""Регрессионная проверка: /health отвечает за миллисекунды во время долгого импорта.
+
+Разбор файла и вызовы Google выполняются в пулах потоков, а не в event loop,
+поэтому импорт не должен задерживать /health, /api/status и вход. Скрипт
+поднимает приложение в этом же процессе на поддельном Google Sheets API
+(fake_sheets.py), замеряет /health в простое, затем загружает большую
+выгрузку и непрерывно опрашивает /health до конца импорта. Если p99 задержки
+во время импорта больше --max-p99-ms, скрипт завершается с кодом 1.
+
+Запуск из папки backend:
+    python benchmarks/check_health_latency.py
+    python benchmarks/check_health_latency.py --rows 500000 --latency 0.1 --max-p99-ms 50
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+import uvicorn
+
+import load_test
+from fake_sheets import FakeSheetsBackend, install
+from synthetic_export import CITIES, generate_rows, write_export
+
+main = load_test.main
+
+
+def poll_health(base_url: str, stop: threading.Event, interval: float) -> list:
+    """Задержки /health (сек), пока не выставлен stop"""
+    session = requests.Session()
+    latencies = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = session.get(f'{base_url}/health')
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+        stop.wait(interval)
+    return latencies
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help='строк в выгрузке')
+    parser.add_argument('--cities', type=int, default=len(CITIES))
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа поддельного API (сек)')
+    parser.add_argument('--poll-interval', type=float, default=0.01, help='пауза между запросами /health (сек)')
+    parser.add_argument('--idle', type=float, default=1.0, help='сколько секунд мерить /health в простое')
+    parser.add_argument('--max-p99-ms', type=float, default=50, help='допустимый p99 /health во время импорта (мс)')
+    parser.add_argument('--timeout', type=float, default=600, help='ожидание импорта (сек)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    backend = FakeSheetsBackend(latency=args.latency, seed=args.seed)
+    install(backend)
+    load_test.prepare(backend, CITIES[:args.cities])
+    path = os.path.join(load_test.WORK_DIR, 'export.xls')
+    write_export(path, generate_rows(args.rows, seed=args.seed))
+
+    port = load_test.free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    try:
+        stop = threading.Event()
+        threading.Timer(args.idle, stop.set).start()
+        idle = poll_health(base_url, stop, args.poll_interval)
+
+        driver = load_test.LoadDriver(base_url, 0.2)
+        stop = threading.Event()
+        busy = []
+        poller = threading.Thread(target=lambda: busy.extend(poll_health(base_url, stop, args.poll_interval)),
+                                  daemon=True)
+        poller.start()
+        started = time.perf_counter()
+        upload = threading.Thread(target=driver.upload, args=(path,), daemon=True)
+        upload.start()
+        upload.join(args.timeout)
+        import_wall = time.perf_counter() - started
+        stop.set()
+        poller.join()
+    finally:
+        server.should_exit = True
+        server_thread.join()
+
+    if upload.is_alive() or not driver.results:
+        print(f"Импорт не завершился за {args.timeout} с")
+        sys.exit(1)
+    result = driver.results[0]
+    idle_stats = load_test.latency_stats(idle)
+    busy_stats = load_test.latency_stats(busy)
+    print(f"Импорт {args.rows} строк, городов {args.cities}: {result['status']} за {import_wall:.1f} с")
+    for name, stats in (('простой', idle_stats), ('импорт', busy_stats)):
+        print(f"  /health {name:<8} запросов {stats['count']:5d}  p50 {stats['p50_ms']} мс  "
+              f"p99 {stats['p99_ms']} мс  макс {stats['max_ms']} мс")
+
+    if result['status'] != 'completed':
+        print(f"Импорт завершился со статусом {result['status']}")
+        sys.exit(1)
+    if busy_stats['p99_ms'] > args.max_p99_ms:
+        print(f"Регрессия: p99 /health во время импорта {busy_stats['p99_ms']} мс > {args.max_p99_ms} мс")
+        sys.exit(1)
+    print(f"p99 /health во время импорта в пределах {args.max_p99_ms} мс")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,150 @@
+"""Проверка отсева дубликатов при повторной загрузке за тот же день.
+
+Дубликатом считается только файл, загруженный в лист последним. Скрипт
+поднимает приложение в этом же процессе на поддельном Google Sheets API
+(fake_sheets.py) и проверяет два сценария:
+  A -> B -> A: повторная загрузка A возвращает в листы значения A;
+  A -> B (запись в одну таблицу упала) -> A: частично записанный B снимает
+  отметку с A, и повторная загрузка A снова пишет его значения.
+При ошибке скрипт завершается с кодом 1.
+
+Запуск из папки backend:
+    python benchmarks/check_reupload.py
+    python benchmarks/check_reupload.py --rows 20000 --cities 4
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import uvicorn
+
+import load_test
+from fake_sheets import FakeApiError, FakeSheetsBackend, install
+from synthetic_export import CITIES, generate_rows, write_export
+
+main = load_test.main
+SHEET_ROWS = 370  # Строки листа с датами (заголовок и 366 дней)
+DUPLICATE_MESSAGE = 'уже загружен'
+
+
+class Checker:
+    def __init__(self, backend: FakeSheetsBackend, keys: list, base_url: str):
+        self.backend = backend
+        self.keys = keys
+        self.driver = load_test.LoadDriver(base_url, 0.05)
+        self.base_url = base_url
+        self.failures = []
+
+    def check(self, ok: bool, message: str):
+        print(f"  {'OK ' if ok else 'ОШИБКА'} {message}")
+        if not ok:
+            self.failures.append(message)
+
+    def upload(self, path: str) -> dict:
+        """Загружает файл и возвращает итоговый статус задачи"""
+        session = self.driver.session()
+        with open(path, 'rb') as f:
+            task_id = session.post(f'{self.base_url}/api/upload',
+                                   files={'file': (os.path.basename(path), f)}).json()['task_id']
+        while True:
+            status = session.get(f'{self.base_url}/api/status/{task_id}').json()
+            if status['status'] in load_test.FINISHED:
+                return status
+            time.sleep(0.05)
+
+    def sheets(self) -> dict:
+        """Значения столбцов E и H листа с сегодняшней датой во всех таблицах.
+
+        Пустая ячейка равна нулю: при записи по снимку даты, пропавшие из
+        выгрузки, обнуляются, а не очищаются.
+        """
+        title = time.strftime('%d%m%y')
+        return {
+            key: [(self.backend.cell(key, title, row, 5) or 0, self.backend.cell(key, title, row, 8) or 0)
+                  for row in range(1, SHEET_ROWS + 1)]
+            for key in self.keys
+        }
+
+
+def skipped_as_duplicate(status: dict) -> bool:
+    return any(DUPLICATE_MESSAGE in line for line in status['success'])
+
+
+def check_a_b_a(checker: Checker, file_a: str, file_b: str):
+    print("A -> B -> A:")
+    checker.upload(file_a)
+    values_a = checker.sheets()
+    checker.upload(file_b)
+    checker.check(checker.sheets() != values_a, "после B в листах значения B")
+    status = checker.upload(file_a)
+    checker.check(not skipped_as_duplicate(status), "повторная загрузка A не отсеяна как дубликат")
+    checker.check(checker.sheets() == values_a, "после повторной A в листах снова значения A")
+    status = checker.upload(file_a)
+    checker.check(skipped_as_duplicate(status), "ещё одна загрузка A отсеяна как дубликат")
+
+
+def check_partial_failure(checker: Checker, file_a: str, file_b: str):
+    print("A -> B (запись в одну таблицу упала) -> A:")
+    checker.upload(file_a)
+    values_a = checker.sheets()
+    dispatch = checker.backend._dispatch
+    broken = checker.keys[0]
+
+    def failing_dispatch(book, key, operation, tail, query, body):
+        if key == broken and operation == 'values_batch_update':
+            raise FakeApiError(403, 'The caller does not have permission')
+        return dispatch(book, key, operation, tail, query, body)
+
+    checker.backend._dispatch = failing_dispatch
+    try:
+        status = checker.upload(file_b)
+    finally:
+        checker.backend._dispatch = dispatch
+    failed = [error['city'] for error in status['errors'] if 'Ошибка при записи' in error['message']]
+    checker.check(len(failed) == 1, f"запись B не удалась в одном городе: {failed}")
+    status = checker.upload(file_a)
+    checker.check(not skipped_as_duplicate(status), "загрузка A после частичной B не отсеяна как дубликат")
+    checker.check(checker.sheets() == values_a, "после повторной A в листах значения A")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000, help='строк в файле')
+    parser.add_argument('--cities', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    backend = FakeSheetsBackend(seed=args.seed)
+    install(backend)
+    keys = list(load_test.prepare(backend, CITIES[:args.cities]))
+    files = []
+    for index in range(2):
+        path = os.path.join(load_test.WORK_DIR, f'export-{"ab"[index]}.xls')
+        write_export(path, generate_rows(args.rows, seed=args.seed + index))
+        files.append(path)
+
+    port = load_test.free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    try:
+        checker = Checker(backend, keys, f'http://127.0.0.1:{port}')
+        check_a_b_a(checker, *files)
+        check_partial_failure(checker, *files)
+    finally:
+        server.should_exit = True
+        server_thread.join()
+
+    if checker.failures:
+        print(f"Проверок не пройдено: {len(checker.failures)}")
+        sys.exit(1)
+    print("Все проверки пройдены")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,185 @@
+"""Проверка действий над завершёнными задачами при TASK_STORE=sqlite.
+
+С TASK_STORE=sqlite завершённая задача после записи в базу выгружается из
+памяти. Скрипт проверяет, что поля, которые ставятся уже после завершения
+(committed_task_id подготовленной задачи, resumed_task_id, profile_ready),
+сохраняются, и повторные POST /api/tasks/{id}/commit и /resume отклоняются
+с 409, а не запускают вторую запись. Приложение поднимается в этом же
+процессе на поддельном Google Sheets API (fake_sheets.py). При ошибке скрипт
+завершается с кодом 1.
+
+Запуск из папки backend:
+    python benchmarks/check_sqlite_tasks.py
+    python benchmarks/check_sqlite_tasks.py --rows 20000 --cities 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import uvicorn
+
+# Хранилище задач выбирается при импорте main, поэтому настраиваем его заранее
+WORK_DIR = tempfile.mkdtemp(prefix='check_sqlite_tasks_')
+os.environ['TASK_STORE'] = 'sqlite'
+os.environ['TASK_STORE_PATH'] = os.path.join(WORK_DIR, 'tasks.db')
+os.environ.setdefault('TASK_STORE_FLUSH_INTERVAL', '0.1')
+os.environ.setdefault('PROFILE_DIR', os.path.join(WORK_DIR, 'profiles'))
+
+import load_test  # noqa: E402
+from fake_sheets import FakeApiError, FakeSheetsBackend, install  # noqa: E402
+from synthetic_export import CITIES, generate_rows, write_export  # noqa: E402
+
+main = load_test.main
+FINISHED = load_test.FINISHED + ('prepared',)
+
+
+class Checker:
+    def __init__(self, base_url: str, timeout: float):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = load_test.LoadDriver(base_url, 0.1).session()
+        self.failures = []
+
+    def check(self, ok: bool, message: str):
+        print(f"  {'OK ' if ok else 'ОШИБКА'} {message}")
+        if not ok:
+            self.failures.append(message)
+
+    def wait(self, task_id: str) -> dict:
+        """Ждёт завершения задачи и её выгрузки из памяти хранилища"""
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            status = self.session.get(f'{self.base_url}/api/status/{task_id}').json()
+            if status['status'] in FINISHED and main.task_store.version(task_id) is not None:
+                with main.task_store._lock:
+                    evicted = task_id not in main.task_store._records
+                if evicted:
+                    return status
+            time.sleep(0.05)
+        raise TimeoutError(f"Задача {task_id} не завершилась за {self.timeout} с")
+
+    def upload(self, path: str, **params) -> str:
+        with open(path, 'rb') as f:
+            response = self.session.post(f'{self.base_url}/api/upload', params=params,
+                                         files={'file': (os.path.basename(path), f)})
+        response.raise_for_status()
+        return response.json()['task_id']
+
+    def post(self, task_id: str, action: str):
+        return self.session.post(f'{self.base_url}/api/tasks/{task_id}/{action}')
+
+
+def check_commit(checker: Checker, path: str):
+    print("Подготовка и запись (prepare -> commit):")
+    prepared_id = checker.upload(path, prepare='true')
+    status = checker.wait(prepared_id)
+    checker.check(status['status'] == 'prepared', f"подготовка завершилась: {status['status']}")
+
+    response = checker.post(prepared_id, 'commit')
+    checker.check(response.status_code == 200, f"первый commit принят: {response.status_code}")
+    second = checker.post(prepared_id, 'commit')
+    checker.check(second.status_code == 409, f"повторный commit сразу - 409: {second.status_code}")
+    if response.status_code != 200:
+        return
+
+    commit_id = response.json()['task_id']
+    status = checker.wait(commit_id)
+    checker.check(status['status'] == 'completed', f"запись завершилась: {status['status']}")
+    checker.wait(prepared_id)
+    third = checker.post(prepared_id, 'commit')
+    checker.check(third.status_code == 409, f"commit после выгрузки задачи из памяти - 409: {third.status_code}")
+    saved = checker.session.get(f'{checker.base_url}/api/status/{prepared_id}').json()
+    checker.check(saved.get('committed_task_id') == commit_id, "committed_task_id сохранён в базе")
+
+
+def check_resume(checker: Checker, backend: FakeSheetsBackend, path: str):
+    print("Возобновление (resume) после отказа записи в одну таблицу:")
+    dispatch = backend._dispatch
+
+    def failing_dispatch(book, key, operation, tail, query, body):
+        if key == 'fake-sheet-0' and operation == 'values_batch_update':
+            raise FakeApiError(403, 'The caller does not have permission')
+        return dispatch(book, key, operation, tail, query, body)
+
+    backend._dispatch = failing_dispatch
+    try:
+        task_id = checker.upload(path)
+        status = checker.wait(task_id)
+    finally:
+        backend._dispatch = dispatch
+    failed = [error['city'] for error in status['errors'] if 'Ошибка при записи' in error['message']]
+    checker.check(len(failed) == 1, f"запись не удалась в одном городе: {failed}")
+
+    response = checker.post(task_id, 'resume')
+    checker.check(response.status_code == 200, f"первый resume принят: {response.status_code}")
+    second = checker.post(task_id, 'resume')
+    checker.check(second.status_code == 409, f"повторный resume сразу - 409: {second.status_code}")
+    if response.status_code != 200:
+        return
+
+    checker.check(response.json()['cities'] == failed, f"возобновляются только {failed}: {response.json()['cities']}")
+    resumed_id = response.json()['task_id']
+    status = checker.wait(resumed_id)
+    checker.check(status['status'] == 'completed' and not any('Ошибка при записи' in error['message']
+                                                              for error in status['errors']),
+                  f"возобновление завершилось без ошибок записи: {status['status']}")
+    checker.wait(task_id)
+    third = checker.post(task_id, 'resume')
+    checker.check(third.status_code == 409, f"resume после выгрузки задачи из памяти - 409: {third.status_code}")
+    saved = checker.session.get(f'{checker.base_url}/api/status/{task_id}').json()
+    checker.check(saved.get('resumed_task_id') == resumed_id, "resumed_task_id сохранён в базе")
+
+
+def check_profile(checker: Checker, path: str):
+    print("Профиль задачи (profile_ready ставится после завершения):")
+    task_id = checker.upload(path, profile='true')
+    status = checker.wait(task_id)
+    checker.check(status['status'] == 'completed', f"импорт завершился: {status['status']}")
+    checker.check(status.get('profile_ready') is True, "profile_ready сохранён в базе")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5000, help='строк в файле')
+    parser.add_argument('--cities', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=60, help='ожидание одной задачи (сек)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    backend = FakeSheetsBackend(seed=args.seed)
+    install(backend)
+    load_test.prepare(backend, CITIES[:args.cities])
+    # Разные файлы: одинаковые загрузки отсеялись бы как дубликаты
+    files = []
+    for index in range(3):
+        path = os.path.join(WORK_DIR, f'export-{index}.xls')
+        write_export(path, generate_rows(args.rows, seed=args.seed + index))
+        files.append(path)
+
+    port = load_test.free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    try:
+        checker = Checker(f'http://127.0.0.1:{port}', args.timeout)
+        check_commit(checker, files[0])
+        check_resume(checker, backend, files[1])
+        check_profile(checker, files[2])
+    finally:
+        server.should_exit = True
+        server_thread.join()
+
+    if checker.failures:
+        print(f"Проверок не пройдено: {len(checker.failures)}")
+        sys.exit(1)
+    print("Все проверки пройдены")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,345 @@
+"""Локальная замена Google Sheets API для нагрузочных тестов.
+
+Подменяет транспорт requests, поэтому настоящие gspread, GoogleClientManager,
+ограничитель квоты и повторы работают как с Google, но без сети и квоты.
+Поддерживается подмножество API, которое использует приложение: метаданные
+таблицы (open_by_key, worksheets, worksheet), batchUpdate (deleteSheet,
+duplicateSheet, updateSheetProperties), values.get (col_values),
+values.batchGet и values.batchUpdate. Drive API приложением не используется.
+
+Задержка, квота чтения/записи в минуту (ответ 429 с Retry-After) и доля
+случайных ошибок 429/5xx настраиваются; каждый запрос считается по таблице и
+операции.
+
+Использование (до первого обращения к Google):
+    backend = FakeSheetsBackend(latency=0.05, error_rate=0.01)
+    backend.add_spreadsheet('fake-1', dates)
+    install(backend)
+"""
+import copy
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+import google.auth.credentials
+import requests
+from requests.adapters import BaseAdapter
+
+import main
+
+SHEETS_PREFIX = '/v4/spreadsheets/'
+TEMPLATE_TITLE = 'Шаблон'
+DEFAULT_ROWS = 1000
+DEFAULT_COLUMNS = 26
+
+# Статусы ошибок в ответах Google
+ERROR_STATUSES = {
+    400: 'INVALID_ARGUMENT',
+    404: 'NOT_FOUND',
+    429: 'RESOURCE_EXHAUSTED',
+    500: 'INTERNAL',
+    502: 'BAD_GATEWAY',
+    503: 'UNAVAILABLE',
+}
+
+
+class FakeApiError(Exception):
+    def __init__(self, code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+class FakeSheetsBackend:
+    """Таблицы в памяти и счётчики запросов"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, reads_per_minute: int = 0,
+                 writes_per_minute: int = 0, error_rate: float = 0.0, error_codes=(429, 500, 503),
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota = {'read': reads_per_minute, 'write': writes_per_minute}  # 0 - без ограничения
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.calls = Counter()      # (ID таблицы, операция) -> запросов
+        self.sub_requests = Counter()  # Вид запроса внутри batchUpdate -> количество
+        self.statuses = Counter()   # Код ответа -> количество
+        self._books = {}
+        self._window = {'read': deque(), 'write': deque()}
+        self._rng = random.Random(seed)
+        self._next_sheet_id = 1000
+        self._lock = threading.Lock()
+
+    def add_spreadsheet(self, key: str, dates: List[str], title: str = TEMPLATE_TITLE):
+        """Таблица с одним листом-шаблоном: заголовок и даты в столбце B"""
+        column_b = ['Дата', ''] + list(dates)
+        properties = {
+            'sheetId': 0, 'title': title, 'index': 0, 'sheetType': 'GRID',
+            'gridProperties': {'rowCount': max(DEFAULT_ROWS, len(column_b)), 'columnCount': DEFAULT_COLUMNS},
+        }
+        with self._lock:
+            self._books[key] = {
+                'sheets': [{'properties': properties}],
+                'values': {0: {(row, 2): value for row, value in enumerate(column_b, start=1)}},
+            }
+
+    def sheet_titles(self, key: str) -> List[str]:
+        with self._lock:
+            return [sheet['properties']['title'] for sheet in self._books[key]['sheets']]
+
+    def cell(self, key: str, title: str, row: int, col: int):
+        with self._lock:
+            book = self._books[key]
+            return book['values'][self._sheet(book, title)['sheetId']].get((row, col))
+
+    def calls_by_spreadsheet(self) -> dict:
+        """ID таблицы -> {операция: запросов}"""
+        result = {}
+        with self._lock:
+            for (key, operation), count in self.calls.items():
+                result.setdefault(key, {})[operation] = count
+        return result
+
+    def summary(self) -> dict:
+        with self._lock:
+            operations = Counter()
+            for (_, operation), count in self.calls.items():
+                operations[operation] += count
+            return {
+                'total': sum(self.calls.values()),
+                'operations': dict(operations),
+                'sub_requests': dict(self.sub_requests),
+                'statuses': dict(self.statuses),
+            }
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.sub_requests.clear()
+            self.statuses.clear()
+
+    # Обработка HTTP-запроса
+
+    def handle(self, request: requests.PreparedRequest) -> requests.Response:
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        url = urlparse(request.url)
+        query = parse_qs(url.query)
+        body = json.loads(request.body) if request.body else None
+        headers = {}
+        with self._lock:
+            try:
+                if not url.path.startswith(SHEETS_PREFIX):
+                    raise FakeApiError(404, f"Неподдерживаемый адрес: {url.path}")
+                key, _, tail = url.path[len(SHEETS_PREFIX):].partition('/')
+                key, _, method = key.partition(':')
+                operation, kind = self._operation(request.method, method, tail)
+                self.calls[(key, operation)] += 1
+                self._check_quota(kind)
+                self._inject_error()
+                if key not in self._books:
+                    raise FakeApiError(404, f"Requested entity was not found: {key}")
+                status, data = 200, self._dispatch(self._books[key], key, operation, tail, query, body)
+            except FakeApiError as e:
+                status = e.code
+                data = {'error': {'code': e.code, 'message': str(e), 'status': ERROR_STATUSES[e.code]}}
+                if e.retry_after is not None:
+                    headers['Retry-After'] = str(max(1, round(e.retry_after)))
+            self.statuses[status] += 1
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        response.headers.update(headers)
+        response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    @staticmethod
+    def _operation(http_method: str, method: str, tail: str):
+        """(название операции, вид квоты)"""
+        if method == 'batchUpdate':
+            return 'batch_update', 'write'
+        if tail == 'values:batchUpdate':
+            return 'values_batch_update', 'write'
+        if tail == 'values:batchGet':
+            return 'values_batch_get', 'read'
+        if tail.startswith('values/'):
+            return 'values_get', 'read'
+        if not tail and http_method == 'GET':
+            return 'get_spreadsheet', 'read'
+        raise FakeApiError(400, f"Неподдерживаемый запрос: {http_method} {tail or method}")
+
+    def _check_quota(self, kind: str):
+        limit = self.quota[kind]
+        if not limit:
+            return
+        now = time.monotonic()
+        window = self._window[kind]
+        while window and window[0] <= now - 60:
+            window.popleft()
+        if len(window) >= limit:
+            raise FakeApiError(429, f"Quota exceeded for quota metric '{kind} requests'",
+                               retry_after=window[0] + 60 - now)
+        window.append(now)
+
+    def _inject_error(self):
+        if self.error_rate and self._rng.random() < self.error_rate:
+            code = self._rng.choice(self.error_codes)
+            raise FakeApiError(code, f"Внедрённая ошибка {code}", retry_after=1 if code == 429 else None)
+
+    def _dispatch(self, book: dict, key: str, operation: str, tail: str, query: dict, body: dict) -> dict:
+        if operation == 'get_spreadsheet':
+            return {'spreadsheetId': key, 'properties': {'title': key}, 'sheets': copy.deepcopy(book['sheets'])}
+        if operation == 'batch_update':
+            replies = [self._apply(book, request) for request in body['requests']]
+            for index, sheet in enumerate(book['sheets']):
+                sheet['properties']['index'] = index
+            return {'spreadsheetId': key, 'replies': replies}
+        if operation == 'values_batch_update':
+            cells = 0
+            for item in body['data']:
+                cells += self._write(book, item['range'], item['values'])
+            return {'spreadsheetId': key, 'totalUpdatedCells': cells}
+        if operation == 'values_batch_get':
+            return {'spreadsheetId': key, 'valueRanges': [self._read(book, rng) for rng in query.get('ranges', [])]}
+        value_range = self._read(book, unquote(tail[len('values/'):]))
+        if query.get('majorDimension') == ['COLUMNS']:
+            column = [row[0] if row else '' for row in value_range['values']]
+            value_range['values'] = [column] if column else []
+            value_range['majorDimension'] = 'COLUMNS'
+        return value_range
+
+    def _apply(self, book: dict, request: dict) -> dict:
+        (kind, arg), = request.items()
+        self.sub_requests[kind] += 1
+        if kind == 'deleteSheet':
+            self._sheet_by_id(book, arg['sheetId'])
+            book['sheets'] = [s for s in book['sheets'] if s['properties']['sheetId'] != arg['sheetId']]
+            book['values'].pop(arg['sheetId'], None)
+            return {}
+        if kind == 'duplicateSheet':
+            source = self._sheet_by_id(book, arg['sourceSheetId'])
+            title = arg.get('newSheetName') or f"Копия {source['title']}"
+            if any(s['properties']['title'] == title for s in book['sheets']):
+                raise FakeApiError(400, f"A sheet with the name \"{title}\" already exists")
+            self._next_sheet_id += 1
+            properties = dict(copy.deepcopy(source), sheetId=self._next_sheet_id, title=title,
+                              index=arg.get('insertSheetIndex', len(book['sheets'])))
+            book['sheets'].insert(properties['index'], {'properties': properties})
+            book['values'][self._next_sheet_id] = dict(book['values'][source['sheetId']])
+            return {'duplicateSheet': {'properties': properties}}
+        if kind == 'updateSheetProperties':
+            properties = self._sheet_by_id(book, arg['properties']['sheetId'])
+            properties.update({k: v for k, v in arg['properties'].items() if k != 'sheetId'})
+            return {}
+        raise FakeApiError(400, f"Неподдерживаемый запрос batchUpdate: {kind}")
+
+    @staticmethod
+    def _sheet_by_id(book: dict, sheet_id: int) -> dict:
+        for sheet in book['sheets']:
+            if sheet['properties']['sheetId'] == sheet_id:
+                return sheet['properties']
+        raise FakeApiError(400, f"No grid with id: {sheet_id}")
+
+    @staticmethod
+    def _sheet(book: dict, title: str) -> dict:
+        for sheet in book['sheets']:
+            if sheet['properties']['title'] == title:
+                return sheet['properties']
+        raise FakeApiError(400, f"Unable to parse range: {title}")
+
+    @staticmethod
+    def _column(letters: str) -> int:
+        col = 0
+        for ch in letters:
+            col = col * 26 + ord(ch) - 64
+        return col
+
+    def _range(self, book: dict, rng: str):
+        """Диапазон A1 -> (свойства листа, строка1, столбец1, строка2, столбец2)"""
+        title, _, cells = rng.rpartition('!')
+        properties = self._sheet(book, title.strip("'").replace("''", "'"))
+        grid = properties['gridProperties']
+        bounds = []
+        for part in cells.split(':'):
+            match = re.fullmatch(r'([A-Z]*)(\d*)', part)
+            if not match:
+                raise FakeApiError(400, f"Unable to parse range: {rng}")
+            bounds.append((int(match.group(2)) if match.group(2) else None,
+                           self._column(match.group(1)) if match.group(1) else None))
+        (row1, col1), (row2, col2) = bounds[0], bounds[-1]
+        return (properties, row1 or 1, col1 or 1, row2 or grid['rowCount'], col2 or grid['columnCount'])
+
+    def _write(self, book: dict, rng: str, values: list) -> int:
+        properties, row1, col1, _, _ = self._range(book, rng)
+        target = book['values'][properties['sheetId']]
+        cells = 0
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                if value is not None:
+                    target[(row1 + i, col1 + j)] = value
+                    cells += 1
+        return cells
+
+    def _read(self, book: dict, rng: str) -> dict:
+        properties, row1, col1, row2, col2 = self._range(book, rng)
+        source = book['values'][properties['sheetId']]
+        rows = [[source.get((r, c), '') for c in range(col1, col2 + 1)] for r in range(row1, row2 + 1)]
+        for row in rows:
+            while row and row[-1] == '':
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return {'range': rng, 'majorDimension': 'ROWS', 'values': rows}
+
+
+class FakeSheetsAdapter(BaseAdapter):
+    """Транспорт requests, отвечающий из FakeSheetsBackend"""
+
+    def __init__(self, backend: FakeSheetsBackend):
+        super().__init__()
+        self.backend = backend
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        return self.backend.handle(request)
+
+    def close(self):
+        pass
+
+
+class FakeCredentials(google.auth.credentials.Credentials):
+    """Учётные данные без сервера токенов: токен выдаётся на час"""
+
+    def refresh(self, request):
+        self.token = 'fake-token'
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+class FakeClientManager(main.GoogleClientManager):
+    """Менеджер клиента, чьи сессии ходят в FakeSheetsBackend"""
+
+    def __init__(self, backend: FakeSheetsBackend, **kwargs):
+        super().__init__(credentials_factory=FakeCredentials, **kwargs)
+        self.backend = backend
+
+    def _adapter(self) -> FakeSheetsAdapter:
+        return FakeSheetsAdapter(self.backend)
+
+
+def install(backend: FakeSheetsBackend) -> FakeClientManager:
+    """Подключает приложение к FakeSheetsBackend вместо Google"""
+    main.google_client_manager.invalidate()
+    main.spreadsheet_cache.clear()
+    main.google_client_manager = FakeClientManager(backend)
+    return main.google_client_manager
@@ -0,0 +1,231 @@
+"""Сквозной нагрузочный тест импорта на поддельном Google Sheets API.
+
+Поднимает приложение в этом же процессе (uvicorn в отдельном потоке), подменяет
+Google на FakeSheetsBackend (fake_sheets.py), параллельно загружает
+сгенерированные выгрузки и опрашивает /api/status и /health. Выводит время
+импорта, запросы к API по городам и p50/p99 задержки опроса.
+
+Ограничитель квоты приложения настраивается как обычно, через переменные
+окружения (SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE, SHEETS_BURST,
+RETRY_DELAY); квоту и ошибки поддельного API задают параметры скрипта.
+
+Запуск из папки backend:
+    python benchmarks/load_test.py --uploads 8 --concurrency 4 --rows 20000 --latency 0.05
+    SHEETS_READS_PER_MINUTE=600 python benchmarks/load_test.py --fake-reads-per-minute 300 --error-rate 0.02
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import requests
+import uvicorn
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Снимки и загрузки теста не должны смешиваться с данными рабочего экземпляра
+WORK_DIR = tempfile.mkdtemp(prefix='load_test_')
+os.environ.setdefault('SNAPSHOT_DB', os.path.join(WORK_DIR, 'snapshots.db'))
+os.environ.setdefault('UPLOAD_DIR', os.path.join(WORK_DIR, 'uploads'))
+
+import main  # noqa: E402
+from fake_sheets import FakeSheetsBackend, install  # noqa: E402
+from synthetic_export import CITIES, generate_rows, write_export  # noqa: E402
+
+FINISHED = ('completed', 'failed', 'cancelled')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def latency_stats(values: list) -> dict:
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.5) * 1000, 2) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 2) if values else None,
+        'max_ms': round(max(values) * 1000, 2) if values else None,
+    }
+
+
+def prepare(backend: FakeSheetsBackend, cities: list) -> dict:
+    """Таблица на каждый город и настройки приложения; возвращает ID таблицы -> город"""
+    start = date(2025, 1, 1)
+    dates = [(start + timedelta(days=i)).strftime('%d.%m.%Y') for i in range(366)]
+    settings = {}
+    for index, city in enumerate(cities):
+        key = f'fake-sheet-{index}'
+        backend.add_spreadsheet(key, dates)
+        settings[city] = f'https://docs.google.com/spreadsheets/d/{key}/edit'
+
+    path = os.path.join(WORK_DIR, 'settings.json')
+    main.SETTINGS_FILE = path
+    main.settings_service = main.SettingsService(path)
+    main.settings_service.save(settings)
+    return {main.parse_sheet_id(url): city for city, url in settings.items()}
+
+
+class LoadDriver:
+    def __init__(self, base_url: str, poll_interval: float):
+        self.base_url = base_url
+        self.poll_interval = poll_interval
+        self.status_latencies = []
+        self.health_latencies = []
+        self.results = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.token = requests.post(f'{base_url}/api/login',
+                                   json={'username': 'admin', 'password': 'portcomfort'}).json()['token']
+
+    def session(self) -> requests.Session:
+        # Сессия на поток: requests.Session не потокобезопасна
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers['Authorization'] = f'Bearer {self.token}'
+        return session
+
+    def upload(self, path: str) -> dict:
+        """Загружает файл и опрашивает статус до завершения"""
+        session = self.session()
+        started = time.perf_counter()
+        with open(path, 'rb') as f:
+            response = session.post(f'{self.base_url}/api/upload', files={'file': (os.path.basename(path), f)})
+        if response.status_code != 200:
+            result = {'status': f'HTTP {response.status_code}', 'wall_s': time.perf_counter() - started}
+        else:
+            task_id = response.json()['task_id']
+            while True:
+                time.sleep(self.poll_interval)
+                poll_started = time.perf_counter()
+                status = session.get(f'{self.base_url}/api/status/{task_id}').json()
+                with self._lock:
+                    self.status_latencies.append(time.perf_counter() - poll_started)
+                if status['status'] in FINISHED:
+                    break
+            result = {'status': status['status'], 'wall_s': time.perf_counter() - started,
+                      'errors': status.get('errors_total', len(status.get('errors', [])))}
+        with self._lock:
+            self.results.append(result)
+        return result
+
+    def poll_health(self, stop: threading.Event):
+        session = requests.Session()
+        while not stop.is_set():
+            started = time.perf_counter()
+            session.get(f'{self.base_url}/health')
+            with self._lock:
+                self.health_latencies.append(time.perf_counter() - started)
+            stop.wait(self.poll_interval)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--uploads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=20000, help='строк в каждом файле')
+    parser.add_argument('--cities', type=int, default=len(CITIES))
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа API (сек)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке (сек)')
+    parser.add_argument('--fake-reads-per-minute', type=int, default=0, help='квота чтения API (0 - без квоты)')
+    parser.add_argument('--fake-writes-per-minute', type=int, default=0, help='квота записи API (0 - без квоты)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля запросов с ошибкой 429/500/503')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='куда записать результаты в JSON')
+    args = parser.parse_args()
+
+    backend = FakeSheetsBackend(latency=args.latency, jitter=args.jitter,
+                                reads_per_minute=args.fake_reads_per_minute,
+                                writes_per_minute=args.fake_writes_per_minute,
+                                error_rate=args.error_rate, seed=args.seed)
+    install(backend)
+    cities = prepare(backend, CITIES[:args.cities])
+
+    # Файлы с разным seed: одинаковые загрузки отсеялись бы как дубликаты
+    files = []
+    for index in range(args.uploads):
+        path = os.path.join(WORK_DIR, f'export-{index}.xls')
+        write_export(path, generate_rows(args.rows, seed=args.seed + index, unknown_ratio=0.05))
+        files.append(path)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=port, log_level='warning'))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+    server_thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    stop = threading.Event()
+    try:
+        driver = LoadDriver(f'http://127.0.0.1:{port}', args.poll_interval)
+        health_thread = threading.Thread(target=driver.poll_health, args=(stop,), daemon=True)
+        health_thread.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(driver.upload, files))
+        total_wall = time.perf_counter() - started
+    finally:
+        stop.set()
+        server.should_exit = True
+        server_thread.join()
+
+    walls = [result['wall_s'] for result in driver.results]
+    statuses = {}
+    for result in driver.results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    calls = backend.calls_by_spreadsheet()
+    per_city = {city: calls.get(key, {}) for key, city in cities.items()}
+    report = {
+        'params': vars(args),
+        'total_wall_s': round(total_wall, 2),
+        'imports': {
+            'statuses': statuses,
+            'wall_mean_s': round(statistics.mean(walls), 2),
+            'wall_max_s': round(max(walls), 2),
+            'city_errors': sum(result.get('errors', 0) for result in driver.results),
+        },
+        'api': backend.summary(),
+        'api_calls_per_city': per_city,
+        'status_latency': latency_stats(driver.status_latencies),
+        'health_latency': latency_stats(driver.health_latencies),
+    }
+
+    print(f"Загрузок: {args.uploads} по {args.rows} строк, параллельно {args.concurrency}, "
+          f"городов {len(cities)}, всего {report['total_wall_s']} с")
+    print(f"  импорт: {statuses}, в среднем {report['imports']['wall_mean_s']} с, "
+          f"максимум {report['imports']['wall_max_s']} с, ошибок {report['imports']['city_errors']}")
+    api = report['api']
+    print(f"  запросов к API: {api['total']}  {api['operations']}  коды {api['statuses']}")
+    for city, operations in per_city.items():
+        print(f"    {city:<16} {sum(operations.values()):5d}  {operations}")
+    for name in ('status_latency', 'health_latency'):
+        stats = report[name]
+        print(f"  {name:<15} запросов {stats['count']:5d}  p50 {stats['p50_ms']} мс  "
+              f"p99 {stats['p99_ms']} мс  макс {stats['max_ms']} мс")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны: {args.output}")
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,152 @@
+"""Детерминированный генератор выгрузок XML Spreadsheet 2003 для бенчмарков.
+
+При одинаковых параметрах и seed файл получается байт в байт одинаковым.
+
+Запуск из папки backend:
+    python benchmarks/synthetic_export.py export.xls --rows 1000000 --malformed 0.01
+"""
+import argparse
+import random
+from datetime import date, timedelta
+from typing import Iterator, List
+from xml.sax.saxutils import escape
+
+CITIES = [
+    'Балашиха', 'Железнодорожный', 'Жуковский', 'Ивантеевка', 'Казань',
+    'Королев', 'Люберцы', 'Мытищи', 'Ногинск', 'Пушкино',
+    'Раменское', 'Сергиев Посад', 'Фрязино', 'Щелково', 'Электросталь'
+]
+SETTINGS = {city: '' for city in CITIES}
+
+# Города, которых нет в настройках: такие строки пропускаются без предупреждений
+UNKNOWN_CITIES = ['Москва', 'Тула', 'Химки']
+
+# Длительность проживания (ночей)
+STAY_DISTRIBUTIONS = ('longtail', 'exponential', 'uniform', 'fixed')
+# Доли городов: равные, степенные (первые города чаще) или один город
+CITY_MIXES = ('uniform', 'zipf', 'single')
+# Виды испорченных строк
+MALFORMED_KINDS = ('bad_date', 'empty_field', 'short_row', 'bad_amount', 'reversed_dates')
+
+HEADER = (
+    '<?xml version="1.0"?>\n'
+    '<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet" '
+    'xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet">\n'
+    '<Worksheet ss:Name="Sheet1"><Table>\n'
+)
+FOOTER = '</Table></Worksheet></Workbook>\n'
+
+
+def _nights(rng: random.Random, stay: str, mean_nights: float) -> int:
+    if stay == 'fixed':
+        return max(1, round(mean_nights))
+    if stay == 'uniform':
+        return rng.randint(1, max(1, round(mean_nights * 2 - 1)))
+    if stay == 'exponential':
+        return 1 + int(rng.expovariate(1 / mean_nights))
+    # longtail: в основном короткие, 5% - от месяца до четырёх
+    if rng.random() < 0.05:
+        return rng.randrange(30, 120)
+    return 1 + int(rng.expovariate(1 / mean_nights))
+
+
+def _city_picker(rng: random.Random, city_mix: str, cities: List[str]):
+    if city_mix == 'single':
+        return lambda: cities[0]
+    if city_mix == 'zipf':
+        weights = [1 / rank for rank in range(1, len(cities) + 1)]
+        return lambda: rng.choices(cities, weights)[0]
+    return lambda: rng.choice(cities)
+
+
+def _malform(rng: random.Random, row: List[str]) -> List[str]:
+    kind = rng.choice(MALFORMED_KINDS)
+    if kind == 'bad_date':
+        row[1] = rng.choice(['32.13.2025', 'вчера', '2025/01/01'])
+    elif kind == 'empty_field':
+        row[rng.choice([0, 1, 2, 6])] = ''
+    elif kind == 'short_row':
+        del row[rng.randrange(3, 8):]
+    elif kind == 'bad_amount':
+        row[6] = rng.choice(['н/д', '12,34,56', '-'])
+    else:
+        row[1], row[2] = row[2], row[1]
+    return row
+
+
+def generate_rows(rows: int, seed: int = 42, stay: str = 'longtail', mean_nights: float = 6.0,
+                  city_mix: str = 'uniform', unknown_ratio: float = 0.0, malformed_ratio: float = 0.0,
+                  date_format: str = '%d.%m.%Y', objects_per_city: int = 200) -> Iterator[List[str]]:
+    """Отдаёт строки бронирований (8 столбцов, как в выгрузке) по одной"""
+    if stay not in STAY_DISTRIBUTIONS:
+        raise ValueError(f"Неизвестное распределение длительности: {stay}")
+    if city_mix not in CITY_MIXES:
+        raise ValueError(f"Неизвестный набор городов: {city_mix}")
+
+    rng = random.Random(seed)
+    pick_city = _city_picker(rng, city_mix, CITIES)
+    start = date(2025, 1, 1)
+    for _ in range(rows):
+        city = rng.choice(UNKNOWN_CITIES) if rng.random() < unknown_ratio else pick_city()
+        check_in = start + timedelta(days=rng.randrange(365))
+        check_out = check_in + timedelta(days=_nights(rng, stay, mean_nights))
+        row = [
+            f"{city} кв. {rng.randrange(objects_per_city)}",
+            check_in.strftime(date_format),
+            check_out.strftime(date_format),
+            'Гость', '2', 'Сайт',
+            f"{rng.randrange(1500, 300000)},{rng.randrange(100):02d}",
+            '-',
+        ]
+        if rng.random() < malformed_ratio:
+            row = _malform(rng, row)
+        yield row
+
+
+def write_export(path: str, rows: Iterator[List[str]]) -> int:
+    """Пишет строки в файл XML Spreadsheet 2003 и возвращает их число"""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(HEADER)
+        for row in rows:
+            cells = ''.join(f'<Cell><Data ss:Type="String">{escape(value)}</Data></Cell>' for value in row)
+            f.write(f'<Row>{cells}</Row>\n')
+            count += 1
+        f.write(FOOTER)
+    return count
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Параметры генератора (общие для CLI генератора и набора бенчмарков)"""
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--stay', choices=STAY_DISTRIBUTIONS, default='longtail')
+    parser.add_argument('--mean-nights', type=float, default=6.0)
+    parser.add_argument('--city-mix', choices=CITY_MIXES, default='uniform')
+    parser.add_argument('--unknown', type=float, default=0.05, help='доля строк с городами не из настроек')
+    parser.add_argument('--malformed', type=float, default=0.01, help='доля испорченных строк')
+
+
+def generator_params(args: argparse.Namespace) -> dict:
+    return {
+        'rows': args.rows,
+        'seed': args.seed,
+        'stay': args.stay,
+        'mean_nights': args.mean_nights,
+        'city_mix': args.city_mix,
+        'unknown_ratio': args.unknown,
+        'malformed_ratio': args.malformed,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    add_arguments(parser)
+    args = parser.parse_args()
+    count = write_export(args.path, generate_rows(**generator_params(args)))
+    print(f"Записано строк: {count} -> {args.path}")
+
+
+if __name__ == '__main__':
+    main_cli()
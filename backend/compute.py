@@ -0,0 +1,832 @@
+"""Разбор выгрузок и агрегация КН и дохода по городам и датам.
+
+Модуль не имеет побочных эффектов при импорте: не настраивает логирование,
+не открывает базы и не создаёт клиентов Google. Его импортирует main, а
+процессы-воркеры COMPUTE_BACKEND=process (spawn) импортируют только его,
+поэтому задания для них тоже лежат здесь.
+"""
+import asyncio
+import json
+import mmap
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Поддерживаемые форматы дат: основной DD.MM.YYYY, затем DD.MM.YY и YYYY-MM-DD
+DATE_FORMATS = ("%d.%m.%Y", "%d.%m.%y", "%Y-%m-%d")
+DATE_CACHE_SIZE = int(os.getenv('DATE_CACHE_SIZE', '4096'))  # Максимум строк в кэше дат
+
+class DateParser:
+    """Разбор дат с кэшем по исходной строке.
+
+    В выгрузках повторяются одни и те же несколько сотен дат, поэтому каждая
+    строка разбирается один раз. DD.MM.YYYY разбирается вручную без strptime,
+    остальные форматы пробуются начиная с формата, найденного в столбце.
+    """
+
+    def __init__(self, max_size: int = DATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.column_format = None  # Формат столбца, определяется по первым значениям
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+
+    def parse(self, date_str: str) -> Optional[datetime]:
+        """Возвращает дату или None, если строка не похожа на дату"""
+        result = self._cache.get(date_str, self)
+        if result is not self:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self._parse_uncached(date_str)
+        if len(self._cache) >= self.max_size:
+            # Кэш ограничен - проще начать заново, чем вести LRU на горячем пути
+            self._cache.clear()
+        self._cache[date_str] = result
+        return result
+
+    def detect_format(self, values: Iterable[str], sample: int = 20) -> Optional[str]:
+        """Определяет формат столбца по первым непустым значениям"""
+        counts = {}
+        checked = 0
+        for value in values:
+            if not value:
+                continue
+            value = value.strip()
+            for fmt in DATE_FORMATS:
+                try:
+                    datetime.strptime(value, fmt)
+                except ValueError:
+                    continue
+                counts[fmt] = counts.get(fmt, 0) + 1
+                break
+            checked += 1
+            if checked >= sample:
+                break
+
+        if counts:
+            self.column_format = max(counts, key=counts.get)
+        return self.column_format
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий в кэш"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "size": len(self._cache),
+        }
+
+    def _parse_uncached(self, date_str: str) -> Optional[datetime]:
+        if not date_str:
+            return None
+
+        value = date_str.strip()
+
+        # Быстрый путь для DD.MM.YYYY
+        if len(value) == 10 and value[2] == '.' and value[5] == '.':
+            day, month, year = value[:2], value[3:5], value[6:]
+            if day.isdigit() and month.isdigit() and year.isdigit():
+                try:
+                    result = datetime(int(year), int(month), int(day))
+                except ValueError:
+                    result = None
+                if result is not None:
+                    if self.column_format is None:
+                        self.column_format = DATE_FORMATS[0]
+                    return result
+
+        # Форматы не пересекаются, поэтому порядок влияет только на скорость
+        formats = DATE_FORMATS
+        if self.column_format is not None:
+            formats = (self.column_format,) + tuple(fmt for fmt in DATE_FORMATS if fmt != self.column_format)
+
+        for fmt in formats:
+            try:
+                result = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if self.column_format is None:
+                self.column_format = fmt
+            return result
+
+        return None
+
+# Разбор дат из загружаемых файлов
+date_parser = DateParser()
+
+def parse_date(date_str: str) -> Optional[datetime]:
+    """Парсит дату в формате DD.MM.YYYY (а также DD.MM.YY и YYYY-MM-DD)"""
+    return date_parser.parse(date_str)
+
+# Псевдонимы: первое слово названия объекта -> город (можно переопределить через CITY_ALIASES)
+DEFAULT_CITY_ALIASES = {"Сергиев": "Сергиев Посад"}
+CITY_ALIASES = json.loads(os.getenv('CITY_ALIASES', 'null')) or DEFAULT_CITY_ALIASES
+CITY_CACHE_SIZE = int(os.getenv('CITY_CACHE_SIZE', '20000'))  # Максимум названий объектов в кэше
+
+class CityResolver:
+    """Определяет город по первому слову названия объекта.
+
+    Индекс строится один раз из списка городов: каждому префиксу названия
+    города соответствует первый город из настроек, который с него начинается
+    (как при прежнем переборе startswith). Результат кэшируется по названию
+    объекта, так как объекты повторяются в тысячах бронирований.
+    """
+
+    def __init__(self, cities: Iterable[str], aliases: Optional[Dict[str, str]] = None):
+        self.aliases = dict(CITY_ALIASES if aliases is None else aliases)
+        self._prefixes = {}
+        for city in cities:
+            for end in range(1, len(city) + 1):
+                self._prefixes.setdefault(city[:end], city)
+        self._cache = {}
+
+    def resolve(self, object_name: str) -> Optional[str]:
+        """Возвращает город из настроек или None"""
+        city = self._cache.get(object_name, self)
+        if city is not self:
+            return city
+
+        city = self._resolve_uncached(object_name)
+        if len(self._cache) >= CITY_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[object_name] = city
+        return city
+
+    def _resolve_uncached(self, object_name: str) -> Optional[str]:
+        if not object_name:
+            return None
+
+        # Берём первое слово
+        words = object_name.split()
+        if not words:
+            return None
+        first_word = words[0]
+
+        # Псевдонимы (например, "Сергиев" -> "Сергиев Посад")
+        if first_word in self.aliases:
+            return self.aliases[first_word]
+
+        return self._prefixes.get(first_word)
+
+_city_resolver = None
+_city_resolver_key = None
+
+def get_city_resolver(settings: Dict[str, str]) -> CityResolver:
+    """Возвращает индекс городов, пересобирая его только при изменении списка городов"""
+    global _city_resolver, _city_resolver_key
+    key = tuple(settings.keys())
+    if _city_resolver is None or key != _city_resolver_key:
+        _city_resolver = CityResolver(key)
+        _city_resolver_key = key
+    return _city_resolver
+
+def calculate_income_per_night(check_in_date: datetime, check_out_date: datetime, total_amount: str) -> Optional[float]:
+    """Считает доход за ночь, None если бронирование нельзя учесть"""
+    if check_in_date >= check_out_date:
+        return None
+
+    # Проверяем сумму на None и пустые значения
+    if not total_amount:
+        return None
+
+    try:
+        amount = float(total_amount.replace(',', '.').replace(' ', ''))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+    return amount / (check_out_date - check_in_date).days
+
+def calculate_room_nights_and_income(check_in: str, check_out: str, total_amount: str) -> List[Tuple[datetime, int, float]]:
+    """Рассчитывает КН и Доход для каждого дня между заездом и выездом"""
+    try:
+        check_in_date = parse_date(check_in)
+        check_out_date = parse_date(check_out)
+
+        if not check_in_date or not check_out_date:
+            return []
+
+        income_per_night = calculate_income_per_night(check_in_date, check_out_date, total_amount)
+        if income_per_night is None:
+            return []
+
+        # Считаем количество ночей
+        nights = (check_out_date - check_in_date).days
+
+        result = []
+        current_date = check_in_date
+        
+        # Для каждой ночи (кроме дня выезда)
+        for i in range(nights):
+            result.append((current_date, 1, income_per_night))
+            current_date += timedelta(days=1)
+        
+        # День выезда - 0 КН, 0 Доход
+        result.append((check_out_date, 0, 0))
+        
+        return result
+    except (ValueError, TypeError):
+        return []
+
+class RoomNightsAggregator:
+    """Суммирует КН и доход по городам и датам через разностные массивы.
+
+    Бронирование добавляется за O(1): +1 КН и +доход за ночь в день заезда,
+    -1 и -доход в день выезда. Итог по каждому дню получается одним
+    префиксным суммированием по диапазону дат.
+    """
+
+    def __init__(self):
+        self._base = None  # Порядковый номер дня, соответствующий индексу 0
+        self._cities = {}  # город -> (дельты КН, дельты дохода, отметки дней выезда)
+
+    def _city_arrays(self, city: str, size: int):
+        if city not in self._cities:
+            self._cities[city] = (array('l'), array('d'), bytearray())
+        kn, income, checkout = self._cities[city]
+        if len(kn) < size:
+            grow = size - len(kn)
+            kn.extend(array('l', bytes(grow * kn.itemsize)))
+            income.extend(array('d', bytes(grow * income.itemsize)))
+            checkout.extend(bytes(grow))
+        return kn, income, checkout
+
+    def _rebase(self, new_base: int):
+        """Сдвигает начало массивов влево, если пришла более ранняя дата"""
+        shift = self._base - new_base
+        for kn, income, checkout in self._cities.values():
+            kn[0:0] = array('l', bytes(shift * kn.itemsize))
+            income[0:0] = array('d', bytes(shift * income.itemsize))
+            checkout[0:0] = bytes(shift)
+        self._base = new_base
+
+    def add(self, city: str, check_in_date: datetime, check_out_date: datetime, income_per_night: float):
+        """Учитывает одно бронирование (check_in_date < check_out_date)"""
+        start = check_in_date.toordinal()
+        end = check_out_date.toordinal()
+        if self._base is None:
+            self._base = start
+        elif start < self._base:
+            self._rebase(start)
+
+        start -= self._base
+        end -= self._base
+        kn, income, checkout = self._city_arrays(city, end + 1)
+        kn[start] += 1
+        kn[end] -= 1
+        income[start] += income_per_night
+        income[end] -= income_per_night
+        checkout[end] = 1
+
+    def export(self) -> Tuple[Optional[int], Dict[str, Tuple[bytes, bytes, bytes]]]:
+        """Разностные массивы в компактном виде (сырые байты) для передачи между процессами"""
+        return self._base, {
+            city: (kn.tobytes(), income.tobytes(), bytes(checkout))
+            for city, (kn, income, checkout) in self._cities.items()
+        }
+
+    def merge(self, exported: Tuple[Optional[int], Dict[str, Tuple[bytes, bytes, bytes]]]):
+        """Добавляет результат export() другого агрегатора (дельты просто складываются)"""
+        base, cities = exported
+        if base is None:
+            return
+        if self._base is None:
+            self._base = base
+        elif base < self._base:
+            self._rebase(base)
+
+        shift = base - self._base
+        for city, (kn_bytes, income_bytes, checkout_bytes) in cities.items():
+            kn_part = array('l')
+            kn_part.frombytes(kn_bytes)
+            income_part = array('d')
+            income_part.frombytes(income_bytes)
+            kn, income, checkout = self._city_arrays(city, shift + len(kn_part))
+            for offset, value in enumerate(kn_part):
+                if value:
+                    kn[shift + offset] += value
+            for offset, value in enumerate(income_part):
+                if value:
+                    income[shift + offset] += value
+            for offset, value in enumerate(checkout_bytes):
+                if value:
+                    checkout[shift + offset] = 1
+
+    def result(self) -> Dict[str, Dict[datetime, Dict[str, float]]]:
+        """Возвращает {город: {дата: {'kn', 'income'}}} в формате прежней агрегации.
+
+        КН совпадают с прежней агрегацией по ночам точно. Доход складывается в
+        другом порядке, поэтому может отличаться в последних знаках float (до
+        ~1e-7 руб. на миллион бронирований, см. benchmarks/bench_aggregation.py).
+        """
+        city_data = {}
+        for city, (kn_deltas, income_deltas, checkout) in self._cities.items():
+            dates = {}
+            running_kn = 0
+            # Префиксная сумма с компенсацией (Neumaier), чтобы +/- дельты не копили погрешность
+            running_income = 0.0
+            compensation = 0.0
+            for offset in range(len(kn_deltas)):
+                running_kn += kn_deltas[offset]
+                delta = income_deltas[offset]
+                total = running_income + delta
+                if abs(running_income) >= abs(delta):
+                    compensation += (running_income - total) + delta
+                else:
+                    compensation += (delta - total) + running_income
+                running_income = total
+
+                if running_kn > 0:
+                    dates[datetime.fromordinal(self._base + offset)] = {'kn': running_kn, 'income': running_income + compensation}
+                else:
+                    # Проживающих нет - доход точно 0, сбрасываем накопленную погрешность
+                    running_income = 0.0
+                    compensation = 0.0
+                    if checkout[offset]:
+                        # День выезда - 0 КН, 0 Доход
+                        dates[datetime.fromordinal(self._base + offset)] = {'kn': 0, 'income': 0}
+            city_data[city] = dates
+        return city_data
+
+CANCEL_CHECK_ROWS = 10000  # Как часто (в строках) разбор проверяет отмену задачи
+
+def aggregate_rows(data: Iterable[List[str]], settings: Dict[str, str], aggregator: RoomNightsAggregator,
+                   warnings: List[str], start_row: int = 1, city_resolver: Optional[CityResolver] = None,
+                   cancel_event: Optional[threading.Event] = None) -> int:
+    """Добавляет строки в агрегатор; start_row - номер первой строки для предупреждений.
+
+    city_resolver - готовый индекс городов для settings (по умолчанию строится
+    по списку городов). Если выставлен cancel_event, разбор прерывается с
+    CancelledError в пределах CANCEL_CHECK_ROWS строк. Возвращает количество
+    обработанных строк.
+    """
+    if city_resolver is None:
+        city_resolver = get_city_resolver(settings)
+    row_idx = start_row - 1
+    
+    for row_idx, row in enumerate(data, start=start_row):
+        if cancel_event is not None and row_idx % CANCEL_CHECK_ROWS == 0 and cancel_event.is_set():
+            raise asyncio.CancelledError()
+        if len(row) < 8:  # Нужно минимум 8 столбцов
+            continue
+        
+        # Извлекаем данные из строки
+        object_name = row[0] if len(row) > 0 and row[0] else ""  # 1 столбец - объект
+        check_in = row[1] if len(row) > 1 and row[1] else ""     # 2 столбец - заезд
+        check_out = row[2] if len(row) > 2 and row[2] else ""    # 3 столбец - выезд
+        total_amount = row[6] if len(row) > 6 and row[6] else "" # 7 столбец - сумма
+        
+        # Проверяем, что все необходимые поля заполнены
+        if not object_name or not check_in or not check_out or not total_amount:
+            warnings.append(f"Строка {row_idx}: Пропущена - не все поля заполнены")
+            continue
+        
+        # Получаем город из названия объекта
+        city = city_resolver.resolve(object_name)
+        
+        if not city:
+            continue  # Пропускаем строки без города из настроек
+        
+        # Проверяем формат дат
+        check_in_date = parse_date(check_in)
+        check_out_date = parse_date(check_out)
+        if not check_in_date or not check_out_date:
+            warnings.append(f"Строка {row_idx}: Неверный формат даты (заезд: {check_in}, выезд: {check_out})")
+            continue
+
+        # Рассчитываем КН и Доход
+        income_per_night = calculate_income_per_night(check_in_date, check_out_date, total_amount)
+        if income_per_night is None:
+            warnings.append(f"Строка {row_idx}: Ошибка расчёта КН/Дохода")
+            continue
+
+        # Группируем данные по городу и дате
+        aggregator.add(city, check_in_date, check_out_date, income_per_night)
+
+    return row_idx - start_row + 1
+
+def process_xls_data(data: Iterable[List[str]], settings: Dict[str, str]) -> Dict[str, Dict[datetime, Dict[str, float]]]:
+    """Обрабатывает данные XLS (список или поток строк) и группирует по городам"""
+    aggregator = RoomNightsAggregator()
+    warnings = []
+    aggregate_rows(data, settings, aggregator, warnings)
+    return aggregator.result(), warnings
+
+# Функция для обработки только XML Spreadsheet 2003
+
+# Теги и атрибуты XML Spreadsheet 2003 в нотации ElementTree
+SS_NS = '{urn:schemas-microsoft-com:office:spreadsheet}'
+SS_WORKSHEET = SS_NS + 'Worksheet'
+SS_TABLE = SS_NS + 'Table'
+SS_ROW = SS_NS + 'Row'
+SS_CELL = SS_NS + 'Cell'
+SS_DATA = SS_NS + 'Data'
+SS_INDEX = SS_NS + 'Index'
+SS_MERGE_ACROSS = SS_NS + 'MergeAcross'
+
+def _xml_2003_row_values(row) -> List[str]:
+    """Собирает значения ячеек строки с учётом ss:Index и ss:MergeAcross"""
+    row_data = []
+    for cell in row.findall(SS_CELL):
+        # ss:Index - номер столбца (с 1), пропущенные ячейки заполняем пустыми
+        index = cell.get(SS_INDEX)
+        if index:
+            position = int(index) - 1
+            if position > len(row_data):
+                row_data.extend([''] * (position - len(row_data)))
+
+        data_elem = cell.find(SS_DATA)
+        value = data_elem.text if data_elem is not None else ''
+        row_data.append(value)
+
+        # Объединённая ячейка занимает ещё MergeAcross столбцов справа
+        merge_across = cell.get(SS_MERGE_ACROSS)
+        if merge_across:
+            row_data.extend([''] * int(merge_across))
+    return row_data
+
+def _xml_2003_rows_from_events(events: Iterable, row_number: int = 0) -> Iterator[List[str]]:
+    """Отдаёт строки первого листа из событий ('start'/'end') разбора XML.
+
+    row_number - сколько строк листа уже отдано до этих событий (нужно для
+    ss:Index, который задаёт абсолютный номер строки).
+    """
+    worksheet_found = False
+    table = None
+
+    for event, elem in events:
+        if event == 'start':
+            if elem.tag == SS_WORKSHEET:
+                worksheet_found = True
+            elif elem.tag == SS_TABLE and worksheet_found and table is None:
+                table = elem
+            continue
+
+        if elem.tag == SS_ROW and table is not None:
+            # ss:Index у строки - пропущенные строки отдаём пустыми
+            index = elem.get(SS_INDEX)
+            if index:
+                while row_number < int(index) - 1:
+                    yield []
+                    row_number += 1
+
+            yield _xml_2003_row_values(elem)
+            row_number += 1
+
+            # Освобождаем разобранные строки
+            table.clear()
+        elif elem.tag == SS_WORKSHEET:
+            # Читаем только первый лист
+            break
+
+    if not worksheet_found:
+        raise Exception('Worksheet не найден')
+    if table is None:
+        raise Exception('Table не найдена')
+
+def iter_excel_xml_2003_rows(file_path: str) -> Iterator[List[str]]:
+    """Потоково читает первый лист XML Spreadsheet 2003 и отдаёт строки по одной.
+
+    Разобранные строки сразу удаляются из дерева, поэтому расход памяти
+    не зависит от размера файла.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            yield from _xml_2003_rows_from_events(ET.iterparse(f, events=('start', 'end')))
+    except Exception as e:
+        raise Exception(f"Ошибка при парсинге XML Spreadsheet 2003: {str(e)}")
+
+# Открывающие теги Table и Row с любым префиксом пространства имён
+XML_2003_TABLE_TAG = re.compile(rb'<((?:[\w.-]+:)?)Table[\s>]')
+XML_2003_ROW_INDEX = re.compile(rb'Index="(\d+)"')
+
+def split_excel_xml_2003(file_path: str, chunk_rows: int) -> Optional[Tuple[bytes, List[Tuple[int, int, int]]]]:
+    """Делит таблицу первого листа на диапазоны байтов по границам строк.
+
+    Возвращает (заголовок до открывающего тега Table включительно,
+    [(начало, конец, строк листа до диапазона)]) или None, если файл нельзя
+    разделить без полного разбора. Строки ищутся по тексту тегов, без разбора
+    XML, поэтому проход по файлу занимает доли секунды.
+    """
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        table = XML_2003_TABLE_TAG.search(data)
+        if table is None:
+            return None
+        prefix = table.group(1)
+        table_open_end = data.find(b'>', table.start())
+        table_close = data.find(b'</' + prefix + b'Table>', table_open_end)
+        if data[table_open_end - 1:table_open_end] == b'/' or table_close < 0:
+            return None
+
+        row_tag = re.compile(b'<' + re.escape(prefix) + rb'Row(?=[\s>/])([^>]*)>')
+        ranges = []
+        row_number = 0
+        rows_in_range = 0
+        range_start = None
+        range_first_row = 0
+        for row in row_tag.finditer(data, table_open_end, table_close):
+            if rows_in_range >= chunk_rows:
+                ranges.append((range_start, row.start(), range_first_row))
+                rows_in_range = 0
+            if rows_in_range == 0:
+                range_start = row.start()
+                range_first_row = row_number
+
+            # ss:Index - абсолютный номер строки, пропуски считаются пустыми строками
+            attributes = row.group(1)
+            if attributes and b'Index=' in attributes:
+                index = XML_2003_ROW_INDEX.search(attributes)
+                if index:
+                    row_number = max(row_number, int(index.group(1)) - 1)
+            row_number += 1
+            rows_in_range += 1
+
+        if rows_in_range:
+            ranges.append((range_start, table_close, range_first_row))
+        return bytes(data[:table_open_end + 1]), ranges
+
+def iter_excel_xml_2003_range(file_path: str, header: bytes, start: int, end: int,
+                              row_number: int) -> Iterator[List[str]]:
+    """Отдаёт строки из диапазона байтов [start, end) таблицы (см. split_excel_xml_2003).
+
+    Парсеру сначала передаётся заголовок файла (объявления пространств имён,
+    кодировка, открытые Worksheet и Table), затем только байты диапазона.
+    """
+    def events():
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        parser.feed(header)
+        yield from parser.read_events()
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(remaining, 16 * 1024))
+                if not block:
+                    break
+                remaining -= len(block)
+                parser.feed(block)
+                yield from parser.read_events()
+
+    try:
+        yield from _xml_2003_rows_from_events(events(), row_number)
+    except Exception as e:
+        raise Exception(f"Ошибка при парсинге XML Spreadsheet 2003: {str(e)}")
+
+def parse_excel_xml_2003(file_path: str) -> list:
+    """Парсит Excel XML Spreadsheet 2003 и возвращает данные как двумерный массив"""
+    return list(iter_excel_xml_2003_rows(file_path))
+
+# Чтение .xlsx (OOXML) и бинарных .xls (BIFF)
+
+# Сигнатуры форматов по первым байтам файла
+ZIP_MAGIC = b'PK\x03\x04'
+OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PKG_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Встроенные форматы чисел Excel, которые означают дату
+XLSX_BUILTIN_DATE_FORMATS = set(range(14, 23)) | {45, 46, 47}
+
+def detect_spreadsheet_format(file_path: str) -> str:
+    """Определяет формат файла по сигнатуре: xml2003, xlsx или xls"""
+    with open(file_path, 'rb') as f:
+        head = f.read(4096)
+
+    if head.startswith(ZIP_MAGIC):
+        return 'xlsx'
+    if head.startswith(OLE2_MAGIC):
+        return 'xls'
+
+    # XML может начинаться с BOM и пробелов
+    text = head.lstrip(b'\xef\xbb\xbf').lstrip()
+    if text.startswith(b'<') and b'urn:schemas-microsoft-com:office:spreadsheet' in head:
+        return 'xml2003'
+
+    raise Exception("Неизвестный формат файла - ожидается XML Spreadsheet 2003, .xlsx или .xls")
+
+def _format_number(value: float) -> str:
+    """Приводит число к строке так, как его показывает Excel (1500.0 -> '1500')"""
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def _xlsx_column_index(cell_ref: str) -> int:
+    """Переводит ссылку вида 'AB12' в номер столбца с нуля"""
+    index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + (ord(char.upper()) - 64)
+    return index - 1
+
+def _xlsx_first_sheet_path(archive) -> str:
+    """Находит путь к первому листу книги через workbook.xml и его связи"""
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    sheet = workbook.find(f'{XLSX_NS}sheets/{XLSX_NS}sheet')
+    if sheet is None:
+        raise Exception('В книге нет листов')
+    rel_id = sheet.get(f'{XLSX_REL_NS}id')
+
+    rels = ET.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iter(f'{XLSX_PKG_REL_NS}Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            return target.lstrip('/') if target.startswith('/') else f'xl/{target}'
+    raise Exception('Не найден файл первого листа')
+
+def _xlsx_date_base(archive) -> datetime:
+    """Начало отсчёта дат книги (система 1900 или 1904)"""
+    workbook = ET.fromstring(archive.read('xl/workbook.xml'))
+    workbook_pr = workbook.find(f'{XLSX_NS}workbookPr')
+    if workbook_pr is not None and workbook_pr.get('date1904') in ('1', 'true'):
+        return datetime(1904, 1, 1)
+    return datetime(1899, 12, 30)
+
+def _xlsx_shared_strings(archive) -> List[str]:
+    """Потоково читает таблицу общих строк"""
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+
+    strings = []
+    with archive.open('xl/sharedStrings.xml') as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag != f'{XLSX_NS}si':
+                continue
+            # Текст лежит в <t> или в runs <r><t> (rich text)
+            parts = []
+            for child in elem:
+                if child.tag == f'{XLSX_NS}t':
+                    parts.append(child.text or '')
+                elif child.tag == f'{XLSX_NS}r':
+                    t = child.find(f'{XLSX_NS}t')
+                    if t is not None:
+                        parts.append(t.text or '')
+            strings.append(''.join(parts))
+            elem.clear()
+    return strings
+
+def _xlsx_date_styles(archive) -> set:
+    """Возвращает номера стилей ячеек (атрибут s), у которых формат даты"""
+    if 'xl/styles.xml' not in archive.namelist():
+        return set()
+
+    styles = ET.fromstring(archive.read('xl/styles.xml'))
+    date_formats = set(XLSX_BUILTIN_DATE_FORMATS)
+    for num_fmt in styles.iter(f'{XLSX_NS}numFmt'):
+        # Убираем литералы в кавычках и цвета, ищем токены дня/месяца/года
+        code = re.sub(r'"[^"]*"|\[[^\]]*\]', '', num_fmt.get('formatCode', '').lower())
+        if re.search(r'[dy]', code):
+            date_formats.add(int(num_fmt.get('numFmtId')))
+
+    date_styles = set()
+    cell_xfs = styles.find(f'{XLSX_NS}cellXfs')
+    if cell_xfs is not None:
+        for style_index, xf in enumerate(cell_xfs.findall(f'{XLSX_NS}xf')):
+            if int(xf.get('numFmtId', '0')) in date_formats:
+                date_styles.add(style_index)
+    return date_styles
+
+def iter_xlsx_rows(file_path: str) -> Iterator[List[str]]:
+    """Потоково читает первый лист .xlsx, не загружая DOM книги целиком"""
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            sheet_path = _xlsx_first_sheet_path(archive)
+            shared_strings = _xlsx_shared_strings(archive)
+            date_styles = _xlsx_date_styles(archive)
+            date_base = _xlsx_date_base(archive)
+
+            row_tag = f'{XLSX_NS}row'
+            cell_tag = f'{XLSX_NS}c'
+            value_tag = f'{XLSX_NS}v'
+            inline_tag = f'{XLSX_NS}is'
+            text_tag = f'{XLSX_NS}t'
+            sheet_data = None
+            row_number = 0
+
+            with archive.open(sheet_path) as f:
+                for event, elem in ET.iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        if elem.tag == f'{XLSX_NS}sheetData':
+                            sheet_data = elem
+                        continue
+                    if elem.tag != row_tag:
+                        continue
+
+                    # Пропущенные строки (атрибут r) отдаём пустыми
+                    row_ref = elem.get('r')
+                    if row_ref:
+                        while row_number < int(row_ref) - 1:
+                            yield []
+                            row_number += 1
+
+                    row_data = []
+                    for cell in elem.findall(cell_tag):
+                        cell_ref = cell.get('r')
+                        if cell_ref:
+                            position = _xlsx_column_index(cell_ref)
+                            if position > len(row_data):
+                                row_data.extend([''] * (position - len(row_data)))
+
+                        cell_type = cell.get('t', 'n')
+                        value_elem = cell.find(value_tag)
+                        raw = value_elem.text if value_elem is not None else None
+
+                        if cell_type == 's' and raw is not None:
+                            value = shared_strings[int(raw)]
+                        elif cell_type == 'inlineStr':
+                            inline = cell.find(inline_tag)
+                            value = ''.join(t.text or '' for t in inline.iter(text_tag)) if inline is not None else ''
+                        elif raw is None:
+                            value = ''
+                        elif cell_type == 'n' and int(cell.get('s', '0')) in date_styles:
+                            value = (date_base + timedelta(days=float(raw))).strftime('%d.%m.%Y')
+                        elif cell_type == 'n':
+                            value = _format_number(float(raw))
+                        else:
+                            value = raw
+                        row_data.append(value)
+
+                    yield row_data
+                    row_number += 1
+
+                    # Освобождаем разобранные строки
+                    if sheet_data is not None:
+                        sheet_data.clear()
+    except Exception as e:
+        raise Exception(f"Ошибка при чтении файла .xlsx: {str(e)}")
+
+def iter_xls_rows(file_path: str) -> Iterator[List[str]]:
+    """Читает первый лист бинарного .xls (BIFF) через xlrd"""
+    try:
+        import xlrd
+
+        book = xlrd.open_workbook(file_path, on_demand=True)
+        try:
+            sheet = book.sheet_by_index(0)
+            for row_idx in range(sheet.nrows):
+                row_data = []
+                for cell in sheet.row(row_idx):
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        value = xlrd.xldate_as_datetime(cell.value, book.datemode).strftime('%d.%m.%Y')
+                    elif cell.ctype == xlrd.XL_CELL_NUMBER:
+                        value = _format_number(cell.value)
+                    elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                        value = ''
+                    else:
+                        value = str(cell.value)
+                    row_data.append(value)
+                yield row_data
+            # Освобождаем лист после прохода
+            book.unload_sheet(0)
+        finally:
+            book.release_resources()
+    except Exception as e:
+        raise Exception(f"Ошибка при чтении файла .xls: {str(e)}")
+
+def iter_spreadsheet_rows(file_path: str) -> Iterator[List[str]]:
+    """Определяет формат файла и отдаёт строки первого листа одним итератором"""
+    file_format = detect_spreadsheet_format(file_path)
+    if file_format == 'xlsx':
+        return iter_xlsx_rows(file_path)
+    if file_format == 'xls':
+        return iter_xls_rows(file_path)
+    return iter_excel_xml_2003_rows(file_path)
+
+# Задания для процессов-воркеров COMPUTE_BACKEND=process
+
+def compute_worker_ping() -> int:
+    """Пустое задание для прогрева процесса-воркера"""
+    return os.getpid()
+
+def aggregate_file_in_worker(file_path: str, settings: Dict[str, str]):
+    """Разбирает и агрегирует файл целиком в процессе-воркере"""
+    aggregator = RoomNightsAggregator()
+    warnings = []
+    rows_count = aggregate_rows(iter_spreadsheet_rows(file_path), settings, aggregator, warnings)
+    return aggregator.export(), warnings, rows_count
+
+def aggregate_chunk_in_worker(rows: List[List[str]], settings: Dict[str, str], start_row: int):
+    """Агрегирует порцию строк в процессе-воркере"""
+    aggregator = RoomNightsAggregator()
+    warnings = []
+    aggregate_rows(rows, settings, aggregator, warnings, start_row)
+    return aggregator.export(), warnings
+
+def aggregate_xml_2003_range_in_worker(file_path: str, header: bytes, start: int, end: int,
+                                       row_number: int, settings: Dict[str, str]):
+    """Разбирает и агрегирует диапазон строк XML Spreadsheet 2003 в процессе-воркере"""
+    aggregator = RoomNightsAggregator()
+    warnings = []
+    rows = iter_excel_xml_2003_range(file_path, header, start, end, row_number)
+    rows_count = aggregate_rows(rows, settings, aggregator, warnings, row_number + 1)
+    return aggregator.export(), warnings, rows_count
@@ -1,21 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, BackgroundTasks
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
+from multipart.multipart import MultipartParser, parse_options_header
+import aiofiles
 import json
 import os
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import email.utils
 from typing import Dict, List, Optional, Tuple
 import gspread
+from gspread.utils import ValueRenderOption
 from google.oauth2.service_account import Credentials
+import random
 import re
-import xml.etree.ElementTree as ET
+import sqlite3
+import sys
+import tempfile
+from urllib.parse import urlparse
+import hashlib
+import heapq
+import itertools
 import logging
+import marshal
+import math
+import multiprocessing
+import threading
 import time
-from functools import lru_cache
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import socket
+import requests
+import google.auth.exceptions as google_auth_exceptions
+import google.auth.transport.requests as google_requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+import compute
+from compute import (CityResolver, DateParser, RoomNightsAggregator, aggregate_chunk_in_worker,
+                     aggregate_file_in_worker, aggregate_rows, aggregate_xml_2003_range_in_worker,
+                     compute_worker_ping, detect_spreadsheet_format, iter_spreadsheet_rows,
+                     split_excel_xml_2003)
 
 # Настройка логирования
 logging.basicConfig(
@@ -61,15 +93,20 @@ app.add_middleware(
     max_age=86400,  # Кэшируем preflight на 24 часа
 )
 
-# Глобальный кэш для клиента Google Sheets
-_google_client_cache = None
-_last_client_creation = 0
-CLIENT_CACHE_TTL = 300  # 5 минут
+# Клиент Google Sheets: одна авторизованная сессия на процесс
+GOOGLE_HTTP_POOL_SIZE = int(os.getenv('GOOGLE_HTTP_POOL_SIZE', '0'))  # Соединений в пуле (0 - по числу SHEETS_IO_WORKERS)
+GOOGLE_HTTP_TIMEOUT = float(os.getenv('GOOGLE_HTTP_TIMEOUT', '60'))  # Таймаут запроса к Google (сек)
+GOOGLE_TOKEN_REFRESH_MARGIN = float(os.getenv('GOOGLE_TOKEN_REFRESH_MARGIN', '300'))  # За сколько секунд до истечения обновлять токен
 
 # Настройки для работы с Google API
-GOOGLE_API_DELAY = float(os.getenv('GOOGLE_API_DELAY', '1.0'))  # Задержка между запросами в секундах
 MAX_RETRIES = int(os.getenv('MAX_RETRIES', '3'))  # Максимальное количество попыток
-RETRY_DELAY = float(os.getenv('RETRY_DELAY', '2.0'))  # Задержка между попытками
+RETRY_DELAY = float(os.getenv('RETRY_DELAY', '2.0'))  # Пауза перед первым повтором, дальше удваивается
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '30'))  # Предел паузы между попытками (сек)
+RETRY_JITTER = float(os.getenv('RETRY_JITTER', '0.5'))  # Доля паузы, выбираемая случайно
+SHEETS_READS_PER_MINUTE = int(os.getenv('SHEETS_READS_PER_MINUTE', '60'))  # Квота чтения Sheets API на пользователя
+SHEETS_WRITES_PER_MINUTE = int(os.getenv('SHEETS_WRITES_PER_MINUTE', '60'))  # Квота записи Sheets API на пользователя
+SHEETS_BURST = int(os.getenv('SHEETS_BURST', '10'))  # Сколько запросов можно сделать подряд без ожидания
+CITY_CONCURRENCY = int(os.getenv('CITY_CONCURRENCY', '4'))  # Сколько городов обрабатывается одновременно
 
 # Простой health check эндпоинт для Render.com
 @app.get("/health")
@@ -119,8 +156,581 @@ USERS = {
     "admin": "portcomfort"
 }
 
+# Метрики в формате Prometheus (GET /metrics)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # Если задан, /metrics требует заголовок Authorization: Bearer <токен>
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # Границы гистограмм этапов (сек)
+
+class MetricsRegistry:
+    """Счётчики, измерители и гистограммы с метками.
+
+    Значения хранятся в словарях по (имя, метки), запись - одно обновление
+    под блокировкой, поэтому метрики можно держать включёнными постоянно.
+    render() выдаёт текстовый формат Prometheus 0.0.4.
+    """
+
+    def __init__(self):
+        self._meta = {}        # имя -> (тип, описание, границы гистограммы)
+        self._values = {}      # (имя, метки) -> значение счётчика или измерителя
+        self._histograms = {}  # (имя, метки) -> [счётчики по границам..., +Inf, сумма, количество]
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self._meta[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(buckets) + 3)
+            state[bisect.bisect_left(buckets, value)] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Наблюдает длительность блока в гистограмме name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra: str = "") -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    @staticmethod
+    def _value(value: float) -> str:
+        """Число без потери точности: целые как есть, дробные - repr(float)"""
+        if isinstance(value, int):
+            return str(value)
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(float(value))
+
+    def render(self) -> str:
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((key, list(state)) for key, state in self._histograms.items())
+        series = {}
+        for (name, labels), value in values:
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {self._value(value)}")
+        for (name, labels), state in histograms:
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self._meta[name][2] + (math.inf,), state):
+                cumulative += count
+                bucket_labels = self._labels(labels, 'le="' + self._value(bound) + '"')
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {self._value(state[-2])}")
+            lines.append(f"{name}_count{self._labels(labels)} {state[-1]}")
+
+        output = []
+        for name in sorted(series):
+            kind, help_text, _ = self._meta.get(name, ("untyped", "", ()))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(series[name])
+        return "\n".join(output) + "\n"
+
+metrics = MetricsRegistry()
+metrics.describe("import_stage_duration_seconds", "histogram",
+                 "Длительность этапов импорта: upload, parse, aggregate, rotate, write (rotate и write - по городам)")
+metrics.describe("import_rows_parsed_total", "counter", "Разобрано строк выгрузок")
+metrics.describe("import_parse_rows_per_second", "gauge", "Скорость разбора последнего файла (строк/сек)")
+metrics.describe("sheets_api_requests_total", "counter", "Запросы к Google API по методу и коду ответа")
+metrics.describe("sheets_api_sent_bytes_total", "counter", "Байт тела запросов к Google API")
+metrics.describe("sheets_api_rate_limited_total", "counter", "Ответы 429 (превышена квота) по методу")
+metrics.describe("sheets_retries_total", "counter", "Повторы операций с таблицами после ошибок")
+metrics.describe("sheets_failfast_total", "counter", "Операции с таблицами, прерванные без повторов (ошибка не временная)")
+metrics.describe("import_tasks_queued", "gauge", "Задачи, ожидающие в очереди импорта")
+metrics.describe("import_tasks_running", "gauge", "Выполняющиеся задачи импорта")
+metrics.describe("task_store_tasks", "gauge", "Задачи в памяти хранилища статусов")
+metrics.describe("prepared_cache_files", "gauge", "Разобранные файлы в кэше подготовленных импортов")
+metrics.describe("prepared_cache_bytes", "gauge", "Оценка памяти кэша подготовленных импортов")
+
 # Хранение статусов задач
-task_status = {}
+TASK_STORE = os.getenv('TASK_STORE', 'memory')  # memory или sqlite (общая база для нескольких воркеров)
+TASK_STORE_PATH = os.getenv('TASK_STORE_PATH', '/tmp/tasks.db')  # Файл базы для TASK_STORE=sqlite
+TASK_STORE_MAX_TASKS = int(os.getenv('TASK_STORE_MAX_TASKS', '200'))  # Максимум хранимых завершённых задач
+TASK_STORE_TTL = float(os.getenv('TASK_STORE_TTL', '86400'))  # Сколько хранить завершённую задачу (сек)
+TASK_STORE_FLUSH_INTERVAL = float(os.getenv('TASK_STORE_FLUSH_INTERVAL', '0.5'))  # Период записи изменений в базу (сек)
+TASK_LOG_LIMIT = int(os.getenv('TASK_LOG_LIMIT', '500'))  # Максимум строк журнала в задаче
+TASK_ERRORS_LIMIT = int(os.getenv('TASK_ERRORS_LIMIT', '200'))  # Максимум ошибок в задаче
+
+TASK_FINAL_STATUSES = ("completed", "failed", "cancelled", "prepared")  # prepared - ждёт записи по /commit
+
+class TaskStore:
+    """Статусы задач импорта.
+
+    Журнал (success) и ошибки задачи - кольца ограниченной длины: старые записи
+    отбрасываются, а success_offset/errors_offset считают отброшенные. version
+    растёт при каждом изменении задачи. Записи задач этого процесса лежат в
+    памяти; наследники решают, как их вытеснять и где хранить.
+    """
+
+    def __init__(self, log_limit: int = TASK_LOG_LIMIT, errors_limit: int = TASK_ERRORS_LIMIT):
+        self.log_limit = log_limit
+        self.errors_limit = errors_limit
+        self.on_event = None  # Вызывается как on_event(task_id, version, event, data) при каждом изменении
+        self._records = OrderedDict()
+        self._lock = threading.RLock()
+
+    def create(self, task_id: str, total: int, message: str, status: str = "processing", **fields):
+        now = time.time()
+        record = {
+            "status": status,
+            "progress": {"current": 0, "total": total},
+            "errors": [],
+            "errors_offset": 0,
+            "success": [message],
+            "success_offset": 0,
+            "version": 1,
+            "created": now,
+            "updated": now,
+            **fields,
+        }
+        with self._lock:
+            self._records[task_id] = record
+            self._changed(task_id, record)
+            self._evict()
+
+    def get(self, task_id: str, since: Optional[int] = None, errors_since: Optional[int] = None) -> Optional[dict]:
+        """Копия записи задачи или None.
+
+        since/errors_since - абсолютные номера строк журнала и ошибок: вернутся
+        только записи начиная с них (offset в ответе указывает номер первой).
+        """
+        with self._lock:
+            record = self._records.get(task_id)
+            if record is not None:
+                self._records.move_to_end(task_id)
+                return self._copy(record, since, errors_since)
+        record = self._load(task_id)
+        return self._copy(record, since, errors_since) if record is not None else None
+
+    def size(self) -> int:
+        """Число задач в памяти процесса"""
+        with self._lock:
+            return len(self._records)
+
+    def version(self, task_id: str) -> Optional[int]:
+        """Текущая версия задачи без копирования записи"""
+        with self._lock:
+            record = self._records.get(task_id)
+            if record is not None:
+                return record["version"]
+        return self._load_version(task_id)
+
+    def log(self, task_id: str, message: str):
+        """Добавляет строку в журнал задачи"""
+        with self._lock:
+            record = self._writable(task_id)
+            if record is None:
+                return
+            self._append(record, "success", message, self.log_limit)
+            index = record["success_offset"] + len(record["success"]) - 1
+            self._touch(task_id, record, "log", {"index": index, "message": message})
+
+    def add_error(self, task_id: str, city: str, message: str):
+        with self._lock:
+            record = self._writable(task_id)
+            if record is None:
+                return
+            self._append(record, "errors", {"city": city, "message": message}, self.errors_limit)
+            index = record["errors_offset"] + len(record["errors"]) - 1
+            self._touch(task_id, record, "task_error", {"index": index, "city": city, "message": message})
+
+    def set_progress(self, task_id: str, **progress):
+        with self._lock:
+            record = self._writable(task_id)
+            if record is None:
+                return
+            record["progress"].update(progress)
+            self._touch(task_id, record, "progress", dict(record["progress"]))
+
+    def checkpoint(self, task_id: str, city: str, **steps):
+        """Отмечает выполненные шаги импорта города (поле checkpoints).
+
+        Можно вызывать из рабочих потоков. Словарь checkpoints заменяется, а не
+        меняется на месте: копии записи, выданные get, остаются согласованными.
+        """
+        with self._lock:
+            record = self._writable(task_id)
+            if record is None:
+                return
+            checkpoints = record.get("checkpoints") or {}
+            record["checkpoints"] = {**checkpoints, city: {**checkpoints.get(city, {}), **steps}}
+            self._touch(task_id, record, "checkpoint", {"city": city, **steps})
+
+    def update(self, task_id: str, **fields):
+        """Меняет поля верхнего уровня (status, error, ...)"""
+        with self._lock:
+            record = self._writable(task_id)
+            if record is None:
+                return
+            record.update(fields)
+            self._touch(task_id, record, "status", {"status": record["status"], **fields})
+
+    def flush(self):
+        """Сохраняет накопленные изменения (для хранилищ с диском)"""
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def _append(record: dict, key: str, item, limit: int):
+        items = record[key]
+        items.append(item)
+        overflow = len(items) - limit
+        if overflow > 0:
+            del items[:overflow]
+            record[key + "_offset"] += overflow
+
+    @staticmethod
+    def _tail(record: dict, key: str, since: Optional[int]) -> Tuple[list, int]:
+        offset = record[key + "_offset"]
+        if since is None or since <= offset:
+            return list(record[key]), offset
+        return record[key][since - offset:], since
+
+    @classmethod
+    def _copy(cls, record: dict, since: Optional[int] = None, errors_since: Optional[int] = None) -> dict:
+        success, success_offset = cls._tail(record, "success", since)
+        errors, errors_offset = cls._tail(record, "errors", errors_since)
+        return {
+            **record,
+            "progress": dict(record["progress"]),
+            "errors": errors,
+            "errors_offset": errors_offset,
+            "errors_total": record["errors_offset"] + len(record["errors"]),
+            "success": success,
+            "success_offset": success_offset,
+            "success_total": record["success_offset"] + len(record["success"]),
+        }
+
+    def _touch(self, task_id: str, record: dict, event: str, data: dict):
+        record["version"] += 1
+        record["updated"] = time.time()
+        self._changed(task_id, record)
+        if self.on_event is not None:
+            self.on_event(task_id, record["version"], event, data)
+
+    def _writable(self, task_id: str) -> Optional[dict]:
+        """Запись задачи для изменения (вызывается под self._lock)"""
+        return self._records.get(task_id)
+
+    def _changed(self, task_id: str, record: dict):
+        pass
+
+    def _evict(self):
+        pass
+
+    def _load(self, task_id: str) -> Optional[dict]:
+        return None
+
+    def _load_version(self, task_id: str) -> Optional[int]:
+        return None
+
+class MemoryTaskStore(TaskStore):
+    """Задачи в памяти процесса: завершённые вытесняются по TTL и LRU"""
+
+    def __init__(self, max_tasks: int = TASK_STORE_MAX_TASKS, ttl: float = TASK_STORE_TTL, **kwargs):
+        super().__init__(**kwargs)
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+
+    def _evict(self):
+        # Незавершённые задачи не вытесняются, иначе их прогресс потеряется
+        now = time.time()
+        for task_id, record in list(self._records.items()):
+            if record["status"] not in TASK_FINAL_STATUSES:
+                continue
+            if now - record["updated"] > self.ttl or len(self._records) > self.max_tasks:
+                del self._records[task_id]
+
+class SqliteTaskStore(TaskStore):
+    """Задачи в SQLite (WAL), общей для нескольких воркеров uvicorn.
+
+    Изменения копятся в памяти и записываются одной транзакцией раз в
+    flush_interval секунд фоновым потоком, поэтому обновление прогресса не
+    стоит синхронизации с диском. Завершённая задача после записи убирается из
+    памяти и дальше читается из базы - как и задачи других воркеров.
+    """
+
+    def __init__(self, path: str, flush_interval: float = TASK_STORE_FLUSH_INTERVAL,
+                 max_tasks: int = TASK_STORE_MAX_TASKS, ttl: float = TASK_STORE_TTL, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self._dirty = set()
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY, status TEXT, version INTEGER, updated REAL, record TEXT
+            )
+        """)
+        self._conn.commit()
+        self._wake = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="task-store-flush", daemon=True)
+        self._flusher.start()
+
+    def _changed(self, task_id: str, record: dict):
+        self._dirty.add(task_id)
+        if record["status"] in TASK_FINAL_STATUSES:
+            self._wake.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении статусов задач: {str(e)}")
+
+    def flush(self):
+        with self._lock:
+            rows = []
+            for task_id in self._dirty:
+                record = self._records.get(task_id)
+                if record is not None:
+                    rows.append((task_id, record["status"], record["version"], record["updated"],
+                                 json.dumps(record, ensure_ascii=False)))
+            self._dirty.clear()
+        if not rows:
+            return
+
+        cutoff = time.time() - self.ttl
+        final = ",".join("?" * len(TASK_FINAL_STATUSES))
+        with self._db_lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute(f"DELETE FROM tasks WHERE status IN ({final}) AND updated < ?",
+                               (*TASK_FINAL_STATUSES, cutoff))
+            self._conn.execute(
+                f"DELETE FROM tasks WHERE task_id IN (SELECT task_id FROM tasks WHERE status IN ({final}) "
+                f"ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                (*TASK_FINAL_STATUSES, self.max_tasks)
+            )
+
+        # Завершённые и сохранённые задачи дальше читаются из базы
+        with self._lock:
+            for task_id, status, version, _, _ in rows:
+                record = self._records.get(task_id)
+                if status in TASK_FINAL_STATUSES and record is not None and record["version"] == version:
+                    del self._records[task_id]
+
+    def _writable(self, task_id: str) -> Optional[dict]:
+        record = self._records.get(task_id)
+        if record is None:
+            # Завершённая задача уже выгружена из памяти: возвращаем её туда,
+            # чтобы изменение (committed_task_id, profile_ready, ...) записал flush
+            record = self._load(task_id)
+            if record is not None:
+                self._records[task_id] = record
+        return record
+
+    def _load(self, task_id: str) -> Optional[dict]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT record FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _load_version(self, task_id: str) -> Optional[int]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT version FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._flusher.join(timeout=5)
+        self.flush()
+
+def create_task_store() -> TaskStore:
+    if TASK_STORE == 'sqlite':
+        return SqliteTaskStore(TASK_STORE_PATH)
+    return MemoryTaskStore()
+
+task_store = create_task_store()
+
+# Потоки прогресса задач (SSE и WebSocket)
+TASK_STREAM_HEARTBEAT = float(os.getenv('TASK_STREAM_HEARTBEAT', '15'))  # Период heartbeat в потоке (сек)
+TASK_STREAM_HISTORY = int(os.getenv('TASK_STREAM_HISTORY', '500'))  # Событий задачи для продолжения по Last-Event-ID
+TASK_STREAM_QUEUE_SIZE = int(os.getenv('TASK_STREAM_QUEUE_SIZE', '256'))  # Очередь событий одного подписчика
+
+class TaskSubscription:
+    """Очередь событий одного подписчика.
+
+    Если клиент не успевает читать и очередь переполнилась, накопленные события
+    выбрасываются, а вместо них кладётся None - поток отправит полный снимок
+    задачи. Так медленный клиент не задерживает остальных и не копит память.
+    """
+
+    def __init__(self, task_id: str, loop: asyncio.AbstractEventLoop, size: int):
+        self.task_id = task_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.lagged = False
+
+    def push(self, item):
+        """Можно вызывать из любого потока"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            pass  # Цикл событий уже закрыт
+
+    def _put(self, item):
+        if self.lagged:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.lagged = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+class TaskEventBroker:
+    """Раздаёт изменения задач подписчикам и хранит короткую историю событий"""
+
+    def __init__(self, history: int = TASK_STREAM_HISTORY, queue_size: int = TASK_STREAM_QUEUE_SIZE,
+                 max_tasks: int = TASK_STORE_MAX_TASKS):
+        self.history = history
+        self.queue_size = queue_size
+        self.max_tasks = max_tasks
+        self._history = OrderedDict()  # task_id -> deque[(version, event, data)]
+        self._subscribers = {}  # task_id -> set[TaskSubscription]
+        self._lock = threading.Lock()
+
+    def publish(self, task_id: str, version: int, event: str, data: dict):
+        item = (version, event, data)
+        with self._lock:
+            events = self._history.get(task_id)
+            if events is None:
+                events = self._history[task_id] = deque(maxlen=self.history)
+                while len(self._history) > self.max_tasks:
+                    self._history.popitem(last=False)
+            events.append(item)
+            subscribers = list(self._subscribers.get(task_id, ()))
+        for subscription in subscribers:
+            subscription.push(item)
+
+    def subscribe(self, task_id: str) -> TaskSubscription:
+        subscription = TaskSubscription(task_id, asyncio.get_running_loop(), self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: TaskSubscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.task_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.task_id]
+
+    def replay(self, task_id: str, after_version: int) -> Optional[list]:
+        """События после after_version или None, если история их уже не содержит"""
+        with self._lock:
+            events = list(self._history.get(task_id, ()))
+        if not events or events[0][0] > after_version + 1:
+            return None
+        return [item for item in events if item[0] > after_version]
+
+    def subscribers_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+task_events = TaskEventBroker()
+task_store.on_event = task_events.publish
+
+async def iter_task_events(task_id: str, last_event_id: Optional[int] = None):
+    """Поток событий задачи: (id, event, data), None - heartbeat.
+
+    Начинается со снимка задачи или, если задан last_event_id и история его
+    покрывает, с пропущенных событий. Завершается после финального статуса.
+    """
+    subscription = task_events.subscribe(task_id)
+    try:
+        record = task_store.get(task_id)
+        if record is None:
+            return
+        replay = task_events.replay(task_id, last_event_id) if last_event_id is not None else None
+        if replay is None:
+            version = record["version"]
+            yield version, "snapshot", record
+        else:
+            version = last_event_id
+            for item in replay:
+                version = item[0]
+                yield item
+        if record["status"] in TASK_FINAL_STATUSES and version >= record["version"]:
+            return
+
+        while True:
+            try:
+                item = await asyncio.wait_for(subscription.queue.get(), TASK_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # Задачу может вести другой воркер - тогда событий здесь нет, сверяем версию
+                record = task_store.get(task_id)
+                if record is None:
+                    return
+                if record["version"] > version:
+                    version = record["version"]
+                    yield version, "snapshot", record
+                    if record["status"] in TASK_FINAL_STATUSES:
+                        return
+                else:
+                    yield None
+                continue
+
+            if item is None:
+                # Подписчик отстал - отправляем снимок вместо выброшенных событий
+                subscription.lagged = False
+                record = task_store.get(task_id)
+                if record is None:
+                    return
+                version = record["version"]
+                yield version, "snapshot", record
+                if record["status"] in TASK_FINAL_STATUSES:
+                    return
+                continue
+
+            if item[0] <= version:
+                continue  # Уже вошло в снимок
+            version = item[0]
+            yield item
+            if item[1] == "status" and item[2]["status"] in TASK_FINAL_STATUSES:
+                return
+    finally:
+        task_events.unsubscribe(subscription)
 
 # Путь к файлу настроек
 SETTINGS_FILE = "/tmp/settings.json"
@@ -144,20 +754,136 @@ class TaskStatus(BaseModel):
     success: Optional[List[str]] = None
 
 # Функции для работы с настройками
-def load_settings() -> Dict[str, str]:
-    """Загружает настройки из файла"""
-    if os.path.exists(SETTINGS_FILE):
+class SettingsSnapshot:
+    """Одна версия настроек: ссылки по городам и всё, что из них считается заранее"""
+
+    def __init__(self, cities: Dict[str, str], version: int):
+        self.cities = cities  # Общий для всех читателей словарь - не изменять
+        self.version = version
+        self.fingerprint = settings_fingerprint(cities)
+        self.resolver = CityResolver(tuple(cities))
+        # Ссылка -> ID таблицы; неверные ссылки дадут ошибку у своего города при импорте
+        self.sheet_ids = {}
+        for url in cities.values():
+            try:
+                self.sheet_ids[url] = parse_sheet_id(url)
+            except Exception:
+                pass
+
+def validate_settings(settings: Dict[str, str]) -> Dict[str, str]:
+    """Проверяет ссылки перед сохранением и возвращает очищенные настройки.
+
+    Пустая ссылка допустима (город не настроен), непустая должна вести на
+    Google таблицу. Иначе ValueError со списком городов.
+    """
+    cleaned = {}
+    invalid = []
+    for city, url in settings.items():
+        city, url = city.strip(), (url or '').strip()
+        if not city:
+            continue
+        if url:
+            parsed = urlparse(url)
+            try:
+                parse_sheet_id(url)
+            except Exception:
+                parsed = None
+            if parsed is None or parsed.scheme != 'https' or parsed.netloc != 'docs.google.com':
+                invalid.append(city)
+        cleaned[city] = url
+    if invalid:
+        raise ValueError(f"Неверная ссылка на Google таблицу у городов: {', '.join(invalid)}")
+    return cleaned
+
+class SettingsService:
+    """Настройки город -> ссылка, разобранные и закэшированные в памяти.
+
+    Файл перечитывается, только когда меняются его mtime, inode или размер
+    (в том числе после правки вручную). Запись атомарная - во временный файл
+    рядом и rename, поэтому читатель не увидит наполовину записанный файл.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._snapshot = None
+        self._key = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def cached(self) -> Optional[SettingsSnapshot]:
+        """Последняя загруженная версия без проверки файла"""
+        return self._snapshot
+
+    def get(self) -> SettingsSnapshot:
+        key = self._file_key()
+        snapshot = self._snapshot
+        if snapshot is not None and key == self._key:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or key != self._key:
+                cities = self._read() if key is not None else {}
+                if cities is not None:
+                    self._publish(cities)
+                self._key = key
+            return self._snapshot
+
+    def save(self, settings: Dict[str, str]) -> SettingsSnapshot:
+        """Проверяет и атомарно сохраняет настройки (ValueError при неверных ссылках)"""
+        cities = validate_settings(settings)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(prefix='.settings-', suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(cities, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            snapshot = self._publish(cities)
+            self._key = self._file_key()
+            return snapshot
+
+    def _file_key(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def _read(self) -> Optional[Dict[str, str]]:
+        """Читает файл; при повреждённом файле остаётся прежняя версия (None)"""
         try:
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
             return {}
-    return {}
+        except Exception as e:
+            logger.error(f"Не удалось прочитать настройки {self.path}: {str(e)}")
+            return None if self._snapshot is not None else {}
+        if not isinstance(data, dict):
+            logger.error(f"Настройки {self.path} должны быть объектом город -> ссылка")
+            return None if self._snapshot is not None else {}
+        return {str(city): url for city, url in data.items() if isinstance(url, str)}
+
+    def _publish(self, cities: Dict[str, str]) -> SettingsSnapshot:
+        self._version += 1
+        self._snapshot = SettingsSnapshot(cities, self._version)
+        logger.info(f"Загружены настройки версии {self._version}: {len(cities)} городов")
+        return self._snapshot
+
+settings_service = SettingsService(SETTINGS_FILE)
+
+def load_settings() -> Dict[str, str]:
+    """Текущие настройки город -> ссылка (общий словарь, не изменять)"""
+    return settings_service.get().cities
 
 def save_settings_to_file(settings: Dict[str, str]):
-    """Сохраняет настройки в файл"""
-    with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, ensure_ascii=False, indent=2)
+    """Проверяет и атомарно сохраняет настройки"""
+    settings_service.save(settings)
 
 # Функции для работы с токенами
 def create_access_token(data: dict):
@@ -194,472 +920,1855 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
         logger.error(f"Ошибка при проверке токена: {str(e)}")
         raise HTTPException(status_code=401, detail="Ошибка проверки токена")
 
-# Функции для работы с Google Sheets
-def clear_google_client_cache():
-    """Очищает кэш клиента Google Sheets"""
-    global _google_client_cache, _last_client_creation
-    _google_client_cache = None
-    _last_client_creation = 0
-    logger.info("Кэш клиента Google Sheets очищен")
+def get_stream_user(request: Request, token: Optional[str] = None) -> str:
+    """Пользователь для потоков прогресса.
 
-@lru_cache(maxsize=1)
-def get_google_sheets_client():
-    """Получает клиент для работы с Google Sheets"""
-    global _google_client_cache, _last_client_creation
-    current_time = time.time()
-    
-    if _google_client_cache and (current_time - _last_client_creation) < CLIENT_CACHE_TTL:
-        return _google_client_cache
-    
-    for attempt in range(MAX_RETRIES):
-        try:
-            scopes = [
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-            
-            # Сначала пробуем получить из переменной окружения
-            google_credentials = os.getenv('GOOGLE_CREDENTIALS')
-            if google_credentials:
-                import json
-                credentials_dict = json.loads(google_credentials)
-                credentials = Credentials.from_service_account_info(credentials_dict, scopes=scopes)
-            else:
-                credentials = Credentials.from_service_account_file('service-account.json', scopes=scopes)
-            
-            client = gspread.authorize(credentials)
-            
-            _google_client_cache = client
-            _last_client_creation = current_time
-            return client
-            
-        except FileNotFoundError:
-            logger.error("Файл service-account.json не найден")
-            raise Exception("Файл service-account.json не найден")
-        except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                logger.warning(f"Попытка {attempt + 1} создания клиента не удалась, повторяем через {RETRY_DELAY} сек: {str(e)}")
-                time.sleep(RETRY_DELAY)
-            else:
-                logger.error(f"Ошибка при создании клиента Google Sheets после {MAX_RETRIES} попыток: {str(e)}")
-                raise Exception(f"Ошибка при создании клиента Google Sheets после {MAX_RETRIES} попыток: {str(e)}")
+    EventSource не умеет передавать заголовок Authorization, поэтому токен
+    можно передать параметром ?token=.
+    """
+    authorization = request.headers.get("Authorization", "")
+    if not token and authorization.startswith("Bearer "):
+        token = authorization[len("Bearer "):]
+    username = verify_token(token) if token else None
+    if username is None:
+        logger.warning("Попытка подписки на поток с неверным токеном")
+        raise HTTPException(status_code=401, detail="Неверный токен")
+    return username
 
-def extract_sheet_id_from_url(url: str) -> str:
-    """Извлекает ID таблицы из URL"""
-    match = re.search(r'/spreadsheets/d/([a-zA-Z0-9-_]+)', url)
-    if not match:
-        raise Exception("Неверный формат URL Google Sheets")
-    return match.group(1)
+# Отмена задачи, для которой выполняется вызов в пуле потоков (см. run_blocking)
+_call_context = threading.local()
 
-def create_or_replace_sheet_with_date(sheet_url: str, date_str: str) -> str:
-    """Создает новый лист с датой или заменяет существующий"""
-    for attempt in range(MAX_RETRIES):
-        try:
-            client = get_google_sheets_client()
-            sheet_id = extract_sheet_id_from_url(sheet_url)
-            spreadsheet = client.open_by_key(sheet_id)
-            
-            # Задержка между запросами
-            time.sleep(GOOGLE_API_DELAY)
-            
-            # Получаем все листы
-            worksheets = spreadsheet.worksheets()
-            if not worksheets:
-                raise Exception("В таблице нет листов")
-            
-            # Проверяем, существует ли уже лист с такой датой
-            existing_sheet = None
-            for worksheet in worksheets:
-                if worksheet.title == date_str:
-                    existing_sheet = worksheet
-                    break
-            
-            if existing_sheet:
-                # Удаляем существующий лист
-                spreadsheet.del_worksheet(existing_sheet)
-                
-                # Задержка между запросами
-                time.sleep(GOOGLE_API_DELAY)
-            
-            # Копируем последний лист (который не является удаленным)
-            remaining_worksheets = spreadsheet.worksheets()
-            if not remaining_worksheets:
-                raise Exception("Нет доступных листов для копирования")
-            
-            last_sheet = remaining_worksheets[-1]
-            new_sheet = spreadsheet.duplicate_sheet(last_sheet.id, insert_sheet_index=len(remaining_worksheets))
-            new_sheet.update_title(date_str)
-            
-            return date_str
-            
-        except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                logger.warning(f"Попытка {attempt + 1} не удалась, повторяем через {RETRY_DELAY} сек: {str(e)}")
-                time.sleep(RETRY_DELAY)
-            else:
-                raise Exception(f"Ошибка при создании/замене листа после {MAX_RETRIES} попыток: {str(e)}")
+def check_cancelled(cancel_event: Optional[threading.Event] = None):
+    """Бросает CancelledError, если задача отменена.
 
-def create_sheet_with_date(sheet_url: str, date_str: str) -> str:
-    """Создает новый лист с датой и возвращает его название (устаревшая функция)"""
-    return create_or_replace_sheet_with_date(sheet_url, date_str)
+    Без аргумента проверяет задачу текущего вызова в пуле потоков, поэтому
+    работа останавливается между запросами к API, а не посреди запроса.
+    """
+    if cancel_event is None:
+        cancel_event = getattr(_call_context, 'cancel_event', None)
+    if cancel_event is not None and cancel_event.is_set():
+        raise asyncio.CancelledError()
 
-def parse_date(date_str: str) -> Optional[datetime]:
-    """Парсит дату в формате DD.MM.YYYY"""
-    if not date_str:
-        return None
-    
-    date_str = date_str.strip()
-    
-    try:
-        # Основной формат DD.MM.YYYY
-        return datetime.strptime(date_str, "%d.%m.%Y")
-    except ValueError:
-        pass
-    
-    try:
-        # Формат DD.MM.YY
-        return datetime.strptime(date_str, "%d.%m.%y")
-    except ValueError:
-        pass
-    
-    try:
-        # Формат YYYY-MM-DD
-        return datetime.strptime(date_str, "%Y-%m-%d")
-    except ValueError:
-        pass
-    
-    return None
+def sleep_unless_cancelled(seconds: float):
+    """Пауза в рабочем потоке, которую прерывает отмена задачи текущего вызова"""
+    cancel_event = getattr(_call_context, 'cancel_event', None)
+    if cancel_event is None:
+        time.sleep(seconds)
+        return
+    cancel_event.wait(seconds)
+    check_cancelled()
 
-def get_city_from_object_name(object_name: str, settings: Dict[str, str]) -> Optional[str]:
-    """Извлекает город из названия объекта и сопоставляет с настройками"""
-    if not object_name:
-        return None
-    
-    # Берём первое слово
-    first_word = object_name.split()[0].strip()
-    
-    # Специальная обработка для "Сергиев Посад"
-    if first_word == "Сергиев":
-        return "Сергиев Посад"
-    
-    # Ищем город в настройках
-    for city in settings.keys():
-        if city.startswith(first_word):
-            return city
-    
-    return None
+# Ограничение частоты запросов к Google Sheets
+class TokenBucket:
+    """Потокобезопасное ведро токенов с замедлением после ответов 429.
 
-def calculate_room_nights_and_income(check_in: str, check_out: str, total_amount: str) -> List[Tuple[datetime, int, float]]:
-    """Рассчитывает КН и Доход для каждого дня между заездом и выездом"""
-    try:
-        check_in_date = parse_date(check_in)
-        check_out_date = parse_date(check_out)
-        
-        if not check_in_date or not check_out_date:
-            return []
-        
-        if check_in_date >= check_out_date:
-            return []
-        
-        # Проверяем сумму на None и пустые значения
-        if not total_amount or total_amount is None:
-            return []
-        
-        # Парсим сумму
-        amount = float(total_amount.replace(',', '.').replace(' ', ''))
-        
-        # Считаем количество ночей
-        nights = (check_out_date - check_in_date).days
-        
-        if nights <= 0:
-            return []
-        
-        # Доход за ночь
-        income_per_night = amount / nights
-        
-        result = []
-        current_date = check_in_date
-        
-        # Для каждой ночи (кроме дня выезда)
-        for i in range(nights):
-            result.append((current_date, 1, income_per_night))
-            current_date += timedelta(days=1)
-        
-        # День выезда - 0 КН, 0 Доход
-        result.append((check_out_date, 0, 0))
-        
-        return result
-    except (ValueError, TypeError):
-        return []
+    Токены пополняются со скоростью квоты. После 429 скорость падает вдвое и
+    затем линейно восстанавливается до номинальной примерно за минуту.
+    """
 
-def find_date_row_in_sheet(sheet, target_date: datetime) -> Optional[int]:
-    """Находит строку с датой в столбце B (индекс 1)"""
-    try:
-        # Получаем все значения из столбца B
-        column_b = sheet.col_values(2)  # Столбец B = индекс 1
-        
-        for row_idx, date_str in enumerate(column_b, start=1):
-            if not date_str:
-                continue
-            
-            # Парсим дату из ячейки
-            parsed_date = parse_date(date_str)
-            if parsed_date and parsed_date.date() == target_date.date():
-                return row_idx
-        
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при поиске даты: {str(e)}")
-        return None
+    def __init__(self, per_minute: int, capacity: int):
+        self.max_rate = per_minute / 60.0
+        self.min_rate = self.max_rate / 8
+        self.rate = self.max_rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
 
-def write_data_to_sheet(sheet_url: str, sheet_name: str, processed_data: Dict[datetime, Dict[str, float]]):
-    """Записывает обработанные данные в Google Sheets"""
-    for attempt in range(MAX_RETRIES):
-        try:
-            client = get_google_sheets_client()
-            sheet_id = extract_sheet_id_from_url(sheet_url)
-            spreadsheet = client.open_by_key(sheet_id)
-            
-            # Задержка между запросами
-            time.sleep(GOOGLE_API_DELAY)
-            
-            sheet = spreadsheet.worksheet(sheet_name)
-            
-            # Получаем все значения из столбца B одним запросом
-            column_b = sheet.col_values(2)  # Столбец B = индекс 1
-            
-            # Задержка между запросами
-            time.sleep(GOOGLE_API_DELAY)
-            
-            # Создаем словарь для быстрого поиска дат
-            date_to_row = {}
-            for row_idx, date_str in enumerate(column_b, start=1):
-                if not date_str:
-                    continue
-                
-                parsed_date = parse_date(date_str)
-                if parsed_date:
-                    date_to_row[parsed_date.date()] = row_idx
-            
-            # Подготавливаем данные для массового обновления
-            updates = []
-            
-            # Для каждой даты ищем строку и подготавливаем обновления
-            for date, data in processed_data.items():
-                target_date = date.date()
-                if target_date in date_to_row:
-                    row_idx = date_to_row[target_date]
-                    
-                    # Добавляем обновления в список
-                    updates.append({
-                        'range': f'E{row_idx}',
-                        'values': [[data['kn']]]
-                    })
-                    updates.append({
-                        'range': f'H{row_idx}',
-                        'values': [[data['income']]]
-                    })
-            
-            # Выполняем массовое обновление
-            if updates:
-                sheet.batch_update(updates)
-            
-            return  # Успешно завершили
-                
-        except Exception as e:
-            if attempt < MAX_RETRIES - 1:
-                logger.warning(f"Попытка {attempt + 1} не удалась, повторяем через {RETRY_DELAY} сек: {str(e)}")
-                time.sleep(RETRY_DELAY)
-            else:
-                raise Exception(f"Ошибка при записи данных в таблицу после {MAX_RETRIES} попыток: {str(e)}")
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        # Восстанавливаем скорость после замедления
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 60.0 * elapsed)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
 
-def process_xls_data(data: List[List[str]], settings: Dict[str, str]) -> Dict[str, Dict[datetime, Dict[str, float]]]:
-    """Обрабатывает данные XLS и группирует по городам"""
-    city_data = {}
-    warnings = []
-    
-    for row_idx, row in enumerate(data, start=1):
-        if len(row) < 8:  # Нужно минимум 8 столбцов
-            continue
-        
-        # Извлекаем данные из строки
-        object_name = row[0] if len(row) > 0 and row[0] else ""  # 1 столбец - объект
-        check_in = row[1] if len(row) > 1 and row[1] else ""     # 2 столбец - заезд
-        check_out = row[2] if len(row) > 2 and row[2] else ""    # 3 столбец - выезд
-        total_amount = row[6] if len(row) > 6 and row[6] else "" # 7 столбец - сумма
-        
-        # Проверяем, что все необходимые поля заполнены
-        if not object_name or not check_in or not check_out or not total_amount:
-            warnings.append(f"Строка {row_idx}: Пропущена - не все поля заполнены")
-            continue
-        
-        # Получаем город из названия объекта
-        city = get_city_from_object_name(object_name, settings)
-        
-        if not city:
-            continue  # Пропускаем строки без города из настроек
-        
-        # Проверяем формат дат
-        if not parse_date(check_in) or not parse_date(check_out):
-            warnings.append(f"Строка {row_idx}: Неверный формат даты (заезд: {check_in}, выезд: {check_out})")
-            continue
-        
-        # Рассчитываем КН и Доход
-        calculations = calculate_room_nights_and_income(check_in, check_out, total_amount)
-        if not calculations:
-            warnings.append(f"Строка {row_idx}: Ошибка расчёта КН/Дохода")
-            continue
-        
-        # Группируем данные по городу и дате
-        if city not in city_data:
-            city_data[city] = {}
-        
-        for date, kn, income in calculations:
-            if date not in city_data[city]:
-                city_data[city][date] = {'kn': 0, 'income': 0}
-            
-            city_data[city][date]['kn'] += kn
-            city_data[city][date]['income'] += income
-    
-    return city_data, warnings
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """Ждёт, пока запрос уложится в квоту (вызывать из рабочего потока).
+
+        Перед запросом и после ожидания проверяет отмену задачи.
+        """
+        check_cancelled()
+        wait = self.reserve()
+        if wait > 0:
+            sleep_unless_cancelled(wait)
+
+    def throttle(self):
+        """Реакция на 429: снижаем скорость и обнуляем запас"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0.0)
+
+class SheetsRateLimiter:
+    """Общий лимит запросов чтения и записи для всех задач и городов"""
+
+    def __init__(self, reads_per_minute: int, writes_per_minute: int, burst: int):
+        self.read = TokenBucket(reads_per_minute, burst)
+        self.write = TokenBucket(writes_per_minute, burst)
 
-# Функция для обработки только XML Spreadsheet 2003
+    def throttle(self):
+        self.read.throttle()
+        self.write.throttle()
 
-def parse_excel_xml_2003(file_path: str) -> list:
-    """Парсит Excel XML Spreadsheet 2003 и возвращает данные как двумерный массив"""
+sheets_limiter = SheetsRateLimiter(SHEETS_READS_PER_MINUTE, SHEETS_WRITES_PER_MINUTE, SHEETS_BURST)
+
+# Пулы потоков для блокирующей работы: gspread/HTTP и разбор файлов.
+# Event loop только ждёт результатов, поэтому /health и /api/status отвечают сразу.
+SHEETS_IO_WORKERS = int(os.getenv('SHEETS_IO_WORKERS', '8'))
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', '2'))
+sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_IO_WORKERS, thread_name_prefix='sheets-io')
+parse_executor = ThreadPoolExecutor(max_workers=PARSE_WORKERS, thread_name_prefix='parse')
+
+def _run_unless_cancelled(cancel_event: Optional[threading.Event], func, args, kwargs):
+    # Задание, которое ждало в очереди пула, не стартует после отмены задачи
+    check_cancelled(cancel_event)
+    _call_context.cancel_event = cancel_event
     try:
-        tree = ET.parse(file_path)
-        root = tree.getroot()
-        # Пространство имён для XML Spreadsheet 2003
-        ns = {'ss': 'urn:schemas-microsoft-com:office:spreadsheet'}
-        # Берём первый Worksheet
-        worksheet = root.find('.//ss:Worksheet', ns)
-        if worksheet is None:
-            raise Exception('Worksheet не найден')
-        table = worksheet.find('.//ss:Table', ns)
-        if table is None:
-            raise Exception('Table не найдена')
-        data = []
-        for row in table.findall('ss:Row', ns):
-            row_data = []
-            for cell in row.findall('ss:Cell', ns):
-                data_elem = cell.find('ss:Data', ns)
-                value = data_elem.text if data_elem is not None else ''
-                row_data.append(value)
-            data.append(row_data)
-        return data
-    except Exception as e:
-        raise Exception(f"Ошибка при парсинге XML Spreadsheet 2003: {str(e)}")
+        return func(*args, **kwargs)
+    finally:
+        _call_context.cancel_event = None
 
-# Фоновая задача для обработки файла
-async def process_file_task(task_id: str, file_path: str):
-    """Фоновая задача для обработки XLS файла"""
-    import asyncio
-    
+async def run_blocking(executor, func, *args, cancel_event: Optional[threading.Event] = None, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков.
+
+    При отмене ожидающей корутины выставляет cancel_event: уже идущий вызов
+    API доработает, но следующие шаги этой задачи не начнутся.
+    """
+    loop = asyncio.get_running_loop()
+    profile = current_profile.get()
+    if profile is not None:
+        func, args, kwargs = profile.run, (func, args, kwargs), {}
+    call = functools.partial(_run_unless_cancelled, cancel_event, func, args, kwargs)
     try:
-        # Обновляем статус при начале обработки
-        task_status[task_id]["success"].append("Начинаем обработку файла...")
-        
-        # Загружаем настройки
-        settings = load_settings()
-        task_status[task_id]["success"].append("Загружены настройки системы")
+        return await loop.run_in_executor(executor, call)
+    except asyncio.CancelledError:
+        if cancel_event is not None:
+            cancel_event.set()
+        raise
+
+async def run_sheets_io(func, *args, cancel_event: Optional[threading.Event] = None, **kwargs):
+    """Асинхронная обёртка для вызовов Google Sheets"""
+    return await run_blocking(sheets_executor, func, *args, cancel_event=cancel_event, **kwargs)
+
+async def run_cpu_bound(func, *args, cancel_event: Optional[threading.Event] = None, **kwargs):
+    """Асинхронная обёртка для разбора и агрегации файлов"""
+    return await run_blocking(parse_executor, func, *args, cancel_event=cancel_event, **kwargs)
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Проверяет, что Google ответил 429 (превышена квота)"""
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 429
+
+# Повторы операций с Google Sheets
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}  # Временные ответы Google
+
+class SheetsOperationError(Exception):
+    """Операция с таблицей не удалась; retryable=False - повторять её снаружи бессмысленно"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Пауза из заголовка Retry-After ответа Google (секунды или HTTP-дата)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """Повторы с экспоненциальной паузой, случайным разбросом и учётом Retry-After.
+
+    Пауза перед n-м повтором - delay * 2^(n-1), не больше max_delay, из которой
+    случайно вычитается до доли jitter: задачи, получившие 429 одновременно,
+    повторяют запросы вразнобой. Retry-After из ответа Google задаёт нижнюю
+    границу паузы. Повторяются только сетевые ошибки и ответы из
+    RETRYABLE_STATUS_CODES; остальные (неверная ссылка, нет доступа, нет листа,
+    неверный запрос) прерывают операцию сразу.
+    """
+
+    def __init__(self, attempts: int = MAX_RETRIES, delay: float = RETRY_DELAY,
+                 max_delay: float = RETRY_MAX_DELAY, jitter: float = RETRY_JITTER):
+        self.attempts = max(1, attempts)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = min(max(jitter, 0.0), 1.0)
+
+    @staticmethod
+    def retryable(error: Exception) -> bool:
+        if isinstance(error, SheetsOperationError):
+            return error.retryable
+        # Листа или таблицы нет - повтор этого не исправит
+        if isinstance(error, (gspread.exceptions.WorksheetNotFound, gspread.exceptions.SpreadsheetNotFound)):
+            return False
+        if isinstance(error, (requests.ConnectionError, requests.Timeout, google_auth_exceptions.TransportError,
+                              ConnectionError, TimeoutError)):
+            return True
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status is not None:
+            return status in RETRYABLE_STATUS_CODES
+        if isinstance(error, google_auth_exceptions.RefreshError):
+            return bool(error.retryable)
+        # Остальное - ошибки в данных, структуре таблицы или коде
+        return False
+
+    def pause(self, attempt: int, error: Exception) -> float:
+        """Пауза перед повтором после неудачной попытки attempt (с нуля)"""
+        pause = min(self.max_delay, self.delay * (2 ** attempt))
+        pause *= 1 - self.jitter * random.random()
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            pause = max(pause, retry_after)
+        return pause
+
+    def call(self, operation: str, description: str, func, *args, on_error=None, **kwargs):
+        """Вызывает func с повторами; on_error(e) вызывается после каждой неудачи.
+
+        Окончательная неудача - SheetsOperationError с описанием description.
+        """
+        for attempt in range(self.attempts):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                if not self.retryable(e):
+                    metrics.inc("sheets_failfast_total", operation=operation)
+                    raise SheetsOperationError(f"{description}: {str(e)}")
+                if attempt == self.attempts - 1:
+                    raise SheetsOperationError(f"{description} после {self.attempts} попыток: {str(e)}")
+                pause = self.pause(attempt, e)
+                metrics.inc("sheets_retries_total", operation=operation)
+                logger.warning(f"Попытка {attempt + 1} ({operation}) не удалась, повторяем через {pause:.1f} сек: {str(e)}")
+                sleep_unless_cancelled(pause)
+
+retry_policy = RetryPolicy()
+
+# Функции для работы с Google Sheets
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+def load_google_credentials() -> Credentials:
+    """Учётные данные сервисного аккаунта из GOOGLE_CREDENTIALS или service-account.json"""
+    google_credentials = os.getenv('GOOGLE_CREDENTIALS')
+    if google_credentials:
+        return Credentials.from_service_account_info(json.loads(google_credentials), scopes=GOOGLE_SCOPES)
+    try:
+        return Credentials.from_service_account_file('service-account.json', scopes=GOOGLE_SCOPES)
+    except FileNotFoundError:
+        logger.error("Файл service-account.json не найден")
+        raise Exception("Файл service-account.json не найден")
+
+def sheets_api_method(http_method: str, url: str) -> str:
+    """Название метода Google API для метрик по URL запроса"""
+    parsed = urlparse(url)
+    if parsed.netloc == 'oauth2.googleapis.com':
+        return "token"
+    path = parsed.path
+    if not path.startswith('/v4/spreadsheets/'):
+        return "other"
+    if path.endswith(':batchUpdate'):
+        return "values_batch_update" if '/values:' in path else "batch_update"
+    if path.endswith('/values:batchGet'):
+        return "values_batch_get"
+    if '/values/' in path:
+        return "values_get"
+    return "get_spreadsheet" if http_method == 'GET' else "other"
+
+def record_sheets_response(response: requests.Response, *args, **kwargs):
+    """Хук сессии requests: считает запросы к Google, байты и ответы 429"""
+    request = response.request
+    method = sheets_api_method(request.method, request.url)
+    metrics.inc("sheets_api_requests_total", method=method, code=response.status_code)
+    if request.body:
+        metrics.inc("sheets_api_sent_bytes_total", len(request.body), method=method)
+    if response.status_code == 429:
+        metrics.inc("sheets_api_rate_limited_total", method=method)
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPS-адаптер с TCP keep-alive: простаивающие соединения пула не обрывает сеть"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+class GoogleClientManager:
+    """Один клиент gspread на процесс с общей авторизованной сессией.
+
+    Сессия держит пул keep-alive соединений (по соединению на поток
+    sheets_executor), поэтому запросы не платят за TLS-рукопожатие. Токен
+    доступа получается при создании клиента и обновляется фоновым потоком за
+    refresh_margin секунд до истечения - запросы обновления не ждут. Клиент
+    общий для всех потоков; invalidate() (POST /api/clear-cache) закрывает
+    сессию, и следующий запрос создаёт новый клиент.
+    """
+
+    def __init__(self, credentials_factory=load_google_credentials, pool_size: int = GOOGLE_HTTP_POOL_SIZE,
+                 timeout: float = GOOGLE_HTTP_TIMEOUT, refresh_margin: float = GOOGLE_TOKEN_REFRESH_MARGIN):
+        self.credentials_factory = credentials_factory
+        self.pool_size = pool_size if pool_size > 0 else SHEETS_IO_WORKERS
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._client = None
+        self._credentials = None
+        self._auth_request = None
+        self._refresher = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def get(self) -> gspread.Client:
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None:
+                self._client = self._create()
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh_loop, name="google-token-refresh",
+                                                       daemon=True)
+                    self._refresher.start()
+            return self._client
+
+    def invalidate(self):
+        """Закрывает сессию; следующий get() создаст клиент заново"""
+        with self._lock:
+            client, auth_request = self._client, self._auth_request
+            self._client = self._credentials = self._auth_request = None
+        self._wake.set()
+        if client is not None:
+            client.session.close()
+            auth_request.session.close()
+
+    def stats(self) -> dict:
+        credentials = self._credentials
+        expires_in = None
+        if credentials is not None and credentials.expiry is not None:
+            expires_in = round((credentials.expiry - datetime.utcnow()).total_seconds())
+        return {
+            "connected": self._client is not None,
+            "token_expires_in": expires_in,
+            "refreshes": self.refreshes,
+            "refresh_failures": self.refresh_failures,
+        }
+
+    def _adapter(self) -> HTTPAdapter:
+        return KeepAliveAdapter(pool_connections=2, pool_maxsize=self.pool_size)
+
+    def _session(self, session: requests.Session) -> requests.Session:
+        session.mount('https://', self._adapter())
+        session.hooks['response'].append(record_sheets_response)
+        return session
+
+    def _create(self) -> gspread.Client:
+        try:
+            return retry_policy.call("client", "Ошибка при создании клиента Google Sheets", self._connect)
+        except SheetsOperationError as e:
+            logger.error(str(e))
+            raise
+
+    def _connect(self) -> gspread.Client:
+        credentials = self.credentials_factory()
+        # Токены запрашиваются через отдельную сессию (тоже с keep-alive)
+        auth_request = google_requests.Request(self._session(requests.Session()))
+        credentials.refresh(auth_request)
+        session = self._session(google_requests.AuthorizedSession(credentials, auth_request=auth_request))
+        client = gspread.Client(auth=credentials, session=session)
+        client.set_timeout(self.timeout)
+        self._credentials, self._auth_request = credentials, auth_request
+        logger.info(f"Клиент Google Sheets создан: пул {self.pool_size} соединений, "
+                    f"токен действует до {credentials.expiry}")
+        return client
+
+    def _refresh_delay(self, credentials) -> Optional[float]:
+        """Секунд до планового обновления токена (None - срок действия не указан)"""
+        if credentials.expiry is None:
+            return None
+        return (credentials.expiry - datetime.utcnow()).total_seconds() - self.refresh_margin
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                credentials, auth_request = self._credentials, self._auth_request
+                if credentials is None:
+                    # Клиент сброшен - поток запустится снова вместе с новым клиентом
+                    self._refresher = None
+                    return
+            delay = self._refresh_delay(credentials)
+            if delay is None or delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                continue
+            try:
+                credentials.refresh(auth_request)
+                self.refreshes += 1
+                logger.info(f"Токен Google обновлён заранее, действует до {credentials.expiry}")
+            except Exception as e:
+                # Истёкший токен при необходимости обновит сама сессия при запросе
+                self.refresh_failures += 1
+                logger.warning(f"Не удалось обновить токен Google, повторим через {RETRY_DELAY} сек: {str(e)}")
+                self._wake.wait(RETRY_DELAY)
+                self._wake.clear()
+
+google_client_manager = GoogleClientManager()
+
+def clear_google_client_cache():
+    """Сбрасывает клиент Google Sheets (следующий запрос создаст новую сессию)"""
+    google_client_manager.invalidate()
+    logger.info("Кэш клиента Google Sheets очищен")
+
+def get_google_sheets_client() -> gspread.Client:
+    """Получает общий клиент для работы с Google Sheets"""
+    return google_client_manager.get()
+
+SHEET_ID_PATTERN = re.compile(r'/spreadsheets/d/([a-zA-Z0-9-_]+)')
+
+def parse_sheet_id(url: str) -> str:
+    """Разбирает ID таблицы из URL"""
+    match = SHEET_ID_PATTERN.search(url)
+    if not match:
+        raise Exception("Неверный формат URL Google Sheets")
+    return match.group(1)
+
+def extract_sheet_id_from_url(url: str) -> str:
+    """Извлекает ID таблицы из URL (ссылки из настроек уже разобраны)"""
+    snapshot = settings_service.cached()
+    if snapshot is not None:
+        sheet_id = snapshot.sheet_ids.get(url)
+        if sheet_id is not None:
+            return sheet_id
+    return parse_sheet_id(url)
+
+# Кэш открытых таблиц и их структуры
+SPREADSHEET_CACHE_TTL = float(os.getenv('SPREADSHEET_CACHE_TTL', '3600'))  # Время жизни записи (сек)
+SPREADSHEET_CACHE_SIZE = int(os.getenv('SPREADSHEET_CACHE_SIZE', '64'))  # Максимум таблиц в кэше
+
+class SpreadsheetCache:
+    """Кэш по ID таблицы: объект таблицы, список листов и индекс дат столбца B.
+
+    Записи живут SPREADSHEET_CACHE_TTL секунд, при переполнении вытесняется
+    давно не использованная. Свои структурные изменения (удаление и
+    копирование листов) записываются в кэш сразу, при ошибке запись
+    сбрасывается. Счётчик calls_saved показывает сэкономленные запросы к API.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.calls_saved = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, sheet_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(sheet_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry["created"] > self.ttl:
+                del self._entries[sheet_id]
+                return None
+            self._entries.move_to_end(sheet_id)
+            return entry
+
+    def _saved(self, calls: int = 1):
+        with self._lock:
+            self.calls_saved += calls
+
+    def get_spreadsheet(self, sheet_id: str):
+        """Возвращает объект таблицы, открывая её только при промахе"""
+        entry = self._entry(sheet_id)
+        if entry is not None:
+            self._saved()
+            return entry["spreadsheet"]
+
+        client = get_google_sheets_client()
+        sheets_limiter.read.acquire()
+        spreadsheet = client.open_by_key(sheet_id)
+        with self._lock:
+            self._entries[sheet_id] = {
+                "spreadsheet": spreadsheet,
+                "sheets": None,       # Свойства листов по порядку
+                "date_index": None,   # Дата -> строка в столбце B шаблона
+                "created": time.monotonic(),
+            }
+            self._entries.move_to_end(sheet_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return spreadsheet
+
+    def get_worksheets(self, sheet_id: str) -> list:
+        """Список листов таблицы по порядку"""
+        spreadsheet = self.get_spreadsheet(sheet_id)
+        entry = self._entry(sheet_id)
+        if entry is not None and entry["sheets"] is not None:
+            self._saved()
+            return [gspread.Worksheet(spreadsheet, dict(properties)) for properties in entry["sheets"]]
+
+        sheets_limiter.read.acquire()
+        worksheets = spreadsheet.worksheets()
+        self.set_worksheets(sheet_id, worksheets)
+        return worksheets
+
+    def get_worksheet(self, sheet_id: str, title: str):
+        """Лист по названию; без запроса к API, если структура в кэше"""
+        entry = self._entry(sheet_id)
+        if entry is not None and entry["sheets"] is not None:
+            for properties in entry["sheets"]:
+                if properties["title"] == title:
+                    self._saved()
+                    return gspread.Worksheet(entry["spreadsheet"], dict(properties))
+
+        spreadsheet = self.get_spreadsheet(sheet_id)
+        sheets_limiter.read.acquire()
+        return spreadsheet.worksheet(title)
+
+    def set_worksheets(self, sheet_id: str, worksheets: list):
+        """Запоминает структуру таблицы после собственных изменений"""
+        sheets = []
+        for index, worksheet in enumerate(worksheets):
+            properties = dict(worksheet._properties)
+            properties["index"] = index
+            sheets.append(properties)
+
+        entry = self._entry(sheet_id)
+        if entry is not None:
+            with self._lock:
+                entry["sheets"] = sheets
+
+    def get_date_index(self, sheet_id: str) -> Optional[Dict]:
+        entry = self._entry(sheet_id)
+        if entry is not None and entry["date_index"] is not None:
+            self._saved()
+            return entry["date_index"]
+        return None
+
+    def set_date_index(self, sheet_id: str, date_index: Dict):
+        entry = self._entry(sheet_id)
+        if entry is not None:
+            with self._lock:
+                entry["date_index"] = date_index
+
+    def invalidate(self, sheet_id: str):
+        with self._lock:
+            self._entries.pop(sheet_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        logger.info("Кэш таблиц Google Sheets очищен")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"spreadsheets": len(self._entries), "calls_saved": self.calls_saved}
+
+spreadsheet_cache = SpreadsheetCache(SPREADSHEET_CACHE_TTL, SPREADSHEET_CACHE_SIZE)
+
+def create_or_replace_sheet_with_date(sheet_url: str, date_str: str) -> str:
+    """Создает новый лист с датой или заменяет существующий"""
+    sheet_id = extract_sheet_id_from_url(sheet_url)
+
+    def on_error(e: Exception):
+        # Кэш мог устареть (например, листы меняли вручную) - перечитаем структуру
+        spreadsheet_cache.invalidate(sheet_id)
+        if is_rate_limit_error(e):
+            sheets_limiter.throttle()
+
+    return retry_policy.call("rotate", "Ошибка при создании/замене листа", replace_sheet_with_date,
+                             sheet_id, date_str, on_error=on_error)
+
+def replace_sheet_with_date(sheet_id: str, date_str: str) -> str:
+    """Одна попытка create_or_replace_sheet_with_date"""
+    spreadsheet = spreadsheet_cache.get_spreadsheet(sheet_id)
+    
+    # Получаем все листы
+    worksheets = spreadsheet_cache.get_worksheets(sheet_id)
+    if not worksheets:
+        raise Exception("В таблице нет листов")
+    
+    # Проверяем, существует ли уже лист с такой датой
+    existing_sheet = None
+    for worksheet in worksheets:
+        if worksheet.title == date_str:
+            existing_sheet = worksheet
+            break
+    
+    # Удаление старого листа, копирование шаблона и переименование -
+    # один атомарный batchUpdate: либо применяется всё, либо ничего
+    requests = []
+    if existing_sheet:
+        requests.append({"deleteSheet": {"sheetId": existing_sheet.id}})
+        worksheets = [worksheet for worksheet in worksheets if worksheet.id != existing_sheet.id]
+    
+    # Копируем последний лист (который не является удаленным)
+    if not worksheets:
+        raise Exception("Нет доступных листов для копирования")
+    
+    last_sheet = worksheets[-1]
+    requests.append({
+        "duplicateSheet": {
+            "sourceSheetId": last_sheet.id,
+            "insertSheetIndex": len(worksheets),
+            "newSheetName": date_str,
+        }
+    })
+    sheets_limiter.write.acquire()
+    response = spreadsheet.batch_update({"requests": requests})
+    new_properties = response["replies"][-1]["duplicateSheet"]["properties"]
+    new_sheet = gspread.Worksheet(spreadsheet, new_properties)
+    spreadsheet_cache.set_worksheets(sheet_id, worksheets + [new_sheet])
+    
+    return date_str
+
+def delete_sheet_with_date(city: str, sheet_url: str, date_str: str) -> str:
+    """Удаляет лист с датой из таблицы города и возвращает строку результата"""
+    sheet_id = extract_sheet_id_from_url(sheet_url)
+    spreadsheet = spreadsheet_cache.get_spreadsheet(sheet_id)
+
+    # Ищем лист с сегодняшней датой
+    worksheets = spreadsheet_cache.get_worksheets(sheet_id)
+    for worksheet in worksheets:
+        if worksheet.title == date_str:
+            sheets_limiter.write.acquire()
+            try:
+                spreadsheet.del_worksheet(worksheet)
+            except Exception:
+                spreadsheet_cache.invalidate(sheet_id)
+                raise
+            spreadsheet_cache.set_worksheets(sheet_id, [w for w in worksheets if w.id != worksheet.id])
+            snapshot_store.forget(city, date_str)
+            return f"✅ {city}: лист {date_str} удален"
+    snapshot_store.forget(city, date_str)
+    return f"ℹ️ {city}: лист {date_str} не найден"
+
+def create_sheet_with_date(sheet_url: str, date_str: str) -> str:
+    """Создает новый лист с датой и возвращает его название (устаревшая функция)"""
+    return create_or_replace_sheet_with_date(sheet_url, date_str)
+
+# Разбор дат из столбца B шаблона таблиц
+sheet_date_parser = DateParser()
+
+# Список городов
+CITIES = [
+    'Балашиха', 'Железнодорожный', 'Жуковский', 'Ивантеевка', 'Казань',
+    'Королев', 'Люберцы', 'Мытищи', 'Ногинск', 'Пушкино',
+    'Раменское', 'Сергиев Посад', 'Фрязино', 'Щелково', 'Электросталь'
+]
+
+def get_city_resolver(settings: Dict[str, str]) -> CityResolver:
+    """Возвращает индекс городов, пересобирая его только при изменении списка городов"""
+    # Для текущих настроек индекс построен вместе с их версией
+    snapshot = settings_service.cached()
+    if snapshot is not None and settings is snapshot.cities:
+        return snapshot.resolver
+    return compute.get_city_resolver(settings)
+
+def get_city_from_object_name(object_name: str, settings: Dict[str, str]) -> Optional[str]:
+    """Извлекает город из названия объекта и сопоставляет с настройками"""
+    return get_city_resolver(settings).resolve(object_name)
+
+def find_date_row_in_sheet(sheet, target_date: datetime) -> Optional[int]:
+    """Находит строку с датой в столбце B (индекс 1)"""
+    try:
+        # Получаем все значения из столбца B
+        column_b = sheet.col_values(2)  # Столбец B = индекс 1
         
-        # Парсим Excel файл
-        data = parse_excel_xml_2003(file_path)
-        task_status[task_id]["success"].append(f"Файл Excel обработан - {len(data)} строк данных")
+        for row_idx, date_str in enumerate(column_b, start=1):
+            if not date_str:
+                continue
+            
+            # Парсим дату из ячейки
+            parsed_date = sheet_date_parser.parse(date_str)
+            if parsed_date and parsed_date.date() == target_date.date():
+                return row_idx
+
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при поиске даты: {str(e)}")
+        return None
+
+def build_date_index(column_b: List[str]) -> Dict:
+    """Строит словарь дата -> номер строки по значениям столбца B"""
+    if sheet_date_parser.column_format is None:
+        sheet_date_parser.detect_format(column_b)
+
+    date_to_row = {}
+    for row_idx, date_str in enumerate(column_b, start=1):
+        if not date_str:
+            continue
+
+        parsed_date = sheet_date_parser.parse(date_str)
+        if parsed_date:
+            date_to_row[parsed_date.date()] = row_idx
+    return date_to_row
+
+# Планирование записи в столбцы E (КН) и H (доход)
+SHEETS_WRITE_COLUMNS = (('E', 'kn'), ('H', 'income'))
+SHEETS_WRITE_MAX_GAP = int(os.getenv('SHEETS_WRITE_MAX_GAP', '5'))  # Сколько строк без данных можно включить в один диапазон
+SHEETS_WRITE_MAX_CELLS = int(os.getenv('SHEETS_WRITE_MAX_CELLS', '10000'))  # Максимум ячеек в одном batch_update
+SHEETS_DIFF_WRITES = os.getenv('SHEETS_DIFF_WRITES', 'false').lower() in ('1', 'true', 'yes')  # Писать только изменившиеся ячейки
+
+def same_cell_value(current, new) -> bool:
+    """Сравнивает значение ячейки (UNFORMATTED_VALUE) с новым значением"""
+    if isinstance(current, (int, float)) and isinstance(new, (int, float)):
+        return math.isclose(current, new, rel_tol=1e-12, abs_tol=1e-9)
+    return current == new
+
+def plan_column_ranges(column: str, values: Dict[int, float], current: Optional[Dict[int, object]] = None,
+                       max_gap: int = SHEETS_WRITE_MAX_GAP) -> Tuple[List[dict], int]:
+    """Собирает значения столбца в непрерывные диапазоны вида E5:E40.
+
+    values - номер строки -> новое значение. Если известны текущие значения
+    (current), неизменившиеся ячейки пропускаются. Разрывы внутри диапазона
+    заполняются None - такие ячейки Sheets API не трогает, поэтому формулы и
+    текст в них сохраняются (прочитанные значения обратно не пишутся).
+    Возвращает (диапазоны, пропущено ячеек).
+    """
+    rows = sorted(values)
+    skipped = 0
+    if current is not None:
+        changed = [row for row in rows if not same_cell_value(current.get(row, ''), values[row])]
+        skipped = len(rows) - len(changed)
+        rows = changed
+
+    ranges = []
+    block = []  # Значения текущего диапазона
+    block_start = prev_row = None
+    for row in rows:
+        if block and row - prev_row - 1 > max_gap:
+            ranges.append(_column_range(column, block_start, block))
+            block = []
+        if not block:
+            block_start = row
+        else:
+            block.extend([None] * (row - prev_row - 1))
+        block.append(values[row])
+        prev_row = row
+    if block:
+        ranges.append(_column_range(column, block_start, block))
+    return ranges, skipped
+
+def _column_range(column: str, start_row: int, block: list) -> dict:
+    end_row = start_row + len(block) - 1
+    cells = f'{column}{start_row}' if end_row == start_row else f'{column}{start_row}:{column}{end_row}'
+    return {'range': cells, 'values': [[value] for value in block]}
+
+def split_write_batches(updates: List[dict], max_cells: int = SHEETS_WRITE_MAX_CELLS) -> List[List[dict]]:
+    """Делит диапазоны на запросы не больше max_cells ячеек (длинные диапазоны режутся)"""
+    batches = []
+    batch = []
+    batch_cells = 0
+    for update in updates:
+        column, _, rest = update['range'].partition(':')
+        column_letter = column.rstrip('0123456789')
+        start_row = int(column[len(column_letter):])
+        values = update['values']
+        offset = 0
+        while offset < len(values):
+            take = min(len(values) - offset, max_cells - batch_cells)
+            batch.append(_column_range(column_letter, start_row + offset, [row[0] for row in values[offset:offset + take]]))
+            batch_cells += take
+            offset += take
+            if batch_cells >= max_cells:
+                batches.append(batch)
+                batch = []
+                batch_cells = 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def read_current_values(sheet, first_row: int, last_row: int) -> Dict[str, Dict[int, object]]:
+    """Читает текущие значения столбцов E и H одним batch_get"""
+    ranges = [f'{column}{first_row}:{column}{last_row}' for column, _ in SHEETS_WRITE_COLUMNS]
+    sheets_limiter.read.acquire()
+    value_ranges = sheet.batch_get(ranges, value_render_option=ValueRenderOption.unformatted)
+    current = {}
+    for (column, _), value_range in zip(SHEETS_WRITE_COLUMNS, value_ranges):
+        current[column] = {
+            first_row + offset: (row[0] if row else '')
+            for offset, row in enumerate(value_range)
+        }
+    return current
+
+def write_data_to_sheet(sheet_url: str, sheet_name: str, processed_data: Dict[datetime, Dict[str, float]],
+                        diff: bool = SHEETS_DIFF_WRITES) -> Dict[str, int]:
+    """Записывает обработанные данные в Google Sheets и возвращает статистику записи"""
+    sheet_id = extract_sheet_id_from_url(sheet_url)
+
+    def on_error(e: Exception):
+        if is_rate_limit_error(e):
+            sheets_limiter.throttle()
+        else:
+            spreadsheet_cache.invalidate(sheet_id)
+
+    return retry_policy.call("write", "Ошибка при записи данных в таблицу", write_sheet_values,
+                             sheet_id, sheet_name, processed_data, diff, on_error=on_error)
+
+def write_sheet_values(sheet_id: str, sheet_name: str, processed_data: Dict[datetime, Dict[str, float]],
+                       diff: bool) -> Dict[str, int]:
+    """Одна попытка write_data_to_sheet"""
+    sheet = spreadsheet_cache.get_worksheet(sheet_id, sheet_name)
+
+    # Лист - копия шаблона, поэтому индекс дат столбца B берём из кэша
+    date_to_row = spreadsheet_cache.get_date_index(sheet_id)
+    if date_to_row is None:
+        # Получаем все значения из столбца B одним запросом
+        sheets_limiter.read.acquire()
+        column_b = sheet.col_values(2)  # Столбец B = индекс 1
+
+        # Создаем словарь для быстрого поиска дат
+        date_to_row = build_date_index(column_b)
+        spreadsheet_cache.set_date_index(sheet_id, date_to_row)
+
+    # Новые значения по столбцам: номер строки -> значение
+    column_values = {column: {} for column, _ in SHEETS_WRITE_COLUMNS}
+    for date, data in processed_data.items():
+        row_idx = date_to_row.get(date.date())
+        if row_idx is not None:
+            for column, key in SHEETS_WRITE_COLUMNS:
+                column_values[column][row_idx] = data[key]
+
+    stats = {"cells_written": 0, "cells_skipped": 0, "ranges": 0, "requests": 0}
+    rows = [row for values in column_values.values() for row in values]
+    if not rows:
+        return stats
+
+    # При diff читаем текущие значения и пишем только отличающиеся ячейки
+    current = read_current_values(sheet, min(rows), max(rows)) if diff else {}
+
+    updates = []
+    for column, _ in SHEETS_WRITE_COLUMNS:
+        ranges, skipped = plan_column_ranges(column, column_values[column], current.get(column))
+        updates.extend(ranges)
+        stats["cells_skipped"] += skipped
+        stats["cells_written"] += len(column_values[column]) - skipped
+
+    # Выполняем массовое обновление, разбивая слишком большие запросы
+    for batch in split_write_batches(updates):
+        sheets_limiter.write.acquire()
+        sheet.batch_update(batch)
+        stats["ranges"] += len(batch)
+        stats["requests"] += 1
+
+    return stats
+
+# Вычислительный бэкенд: разбор файла и агрегация
+COMPUTE_BACKEND = os.getenv('COMPUTE_BACKEND', 'thread')  # thread - пул потоков, process - пул процессов
+COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', str(os.cpu_count() or 2)))  # Процессов для COMPUTE_BACKEND=process
+COMPUTE_CHUNK_ROWS = int(os.getenv('COMPUTE_CHUNK_ROWS', '50000'))  # Строк в одной порции для воркера
+COMPUTE_SPLIT_MB = float(os.getenv('COMPUTE_SPLIT_MB', '5'))  # Файлы больше этого делятся на порции строк
+
+def finish_aggregation(aggregator: RoomNightsAggregator, rows_count: int, started: float) -> Dict:
+    """Итоги по городам и метрики этапов parse и aggregate.
+
+    started - начало разбора (time.perf_counter). Строки складываются потоком
+    по мере разбора, поэтому parse включает и сложение; aggregate - расчёт
+    итогов по датам.
+    """
+    parsed = time.perf_counter()
+    result = aggregator.result()
+    parse_seconds = parsed - started
+    metrics.observe("import_stage_duration_seconds", parse_seconds, stage="parse")
+    metrics.observe("import_stage_duration_seconds", time.perf_counter() - parsed, stage="aggregate")
+    metrics.inc("import_rows_parsed_total", rows_count)
+    if parse_seconds > 0:
+        metrics.set("import_parse_rows_per_second", round(rows_count / parse_seconds))
+    return result
+
+class ThreadComputeBackend:
+    """Разбор и агрегация в текущем процессе (вызывается из пула потоков parse_executor)"""
+
+    name = "thread"
+
+    def start(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def aggregate_file(self, file_path: str, settings: Dict[str, str],
+                       cancel_event: Optional[threading.Event] = None) -> Tuple[Dict, List[str], int]:
+        """Возвращает (данные по городам, предупреждения, число строк)"""
+        started = time.perf_counter()
+        aggregator = RoomNightsAggregator()
+        warnings = []
+        rows_count = aggregate_rows(iter_spreadsheet_rows(file_path), settings, aggregator, warnings,
+                                    city_resolver=get_city_resolver(settings), cancel_event=cancel_event)
+        logger.info(f"Кэш дат после разбора файла: {compute.date_parser.stats()}")
+        return finish_aggregation(aggregator, rows_count, started), warnings, rows_count
+
+class ProcessComputeBackend:
+    """Разбор и агрегация в пуле процессов - используются все ядра.
+
+    Файл до COMPUTE_SPLIT_MB разбирается и агрегируется целиком в одном
+    воркере. Больший XML Spreadsheet 2003 делится по границам строк на
+    диапазоны байтов примерно по COMPUTE_CHUNK_ROWS строк, и каждый воркер сам
+    разбирает свой диапазон - разбор XML занимает основную часть времени.
+    Большие .xlsx/.xls разбираются потоком в родительском процессе, и воркерам
+    уходят порции готовых строк. Воркеры возвращают разностные массивы по
+    городам в виде байтов (RoomNightsAggregator.export), родитель складывает
+    их и один раз считает итог. Пул запускается и прогревается при старте
+    приложения, а не при первой загрузке.
+    """
+
+    name = "process"
+
+    def __init__(self, workers: int = COMPUTE_WORKERS, chunk_rows: int = COMPUTE_CHUNK_ROWS,
+                 split_bytes: float = COMPUTE_SPLIT_MB * 1024 * 1024):
+        self.workers = max(1, workers)
+        self.chunk_rows = chunk_rows
+        self.split_bytes = split_bytes
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: форк процесса с потоками (пулы, SQLite) небезопасен
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def start(self):
+        """Запускает все процессы пула заранее"""
+        pool = self._pool()
+        for future in [pool.submit(compute_worker_ping) for _ in range(self.workers)]:
+            future.result()
+        logger.info(f"Пул вычислений запущен: {self.workers} процессов")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def aggregate_file(self, file_path: str, settings: Dict[str, str],
+                       cancel_event: Optional[threading.Event] = None) -> Tuple[Dict, List[str], int]:
+        """Возвращает (данные по городам, предупреждения, число строк)"""
+        started = time.perf_counter()
+        pool = self._pool()
+        aggregator = RoomNightsAggregator()
+        if os.path.getsize(file_path) <= self.split_bytes:
+            exported, warnings, rows_count = pool.submit(aggregate_file_in_worker, file_path, settings).result()
+            aggregator.merge(exported)
+            return finish_aggregation(aggregator, rows_count, started), warnings, rows_count
+
+        warnings = []
+        pending = deque()
+        max_in_flight = self.workers * 2  # Ограничивает память под порции в очереди
+
+        if detect_spreadsheet_format(file_path) == 'xml2003':
+            split = split_excel_xml_2003(file_path, self.chunk_rows)
+            if split is not None:
+                header, ranges = split
+                rows_count = 0
+
+                def collect_range(future):
+                    nonlocal rows_count
+                    exported, range_warnings, range_rows = future.result()
+                    aggregator.merge(exported)
+                    warnings.extend(range_warnings)
+                    rows_count += range_rows
+
+                for start, end, row_number in ranges:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise asyncio.CancelledError()
+                    pending.append(pool.submit(aggregate_xml_2003_range_in_worker,
+                                               file_path, header, start, end, row_number, settings))
+                    while len(pending) >= max_in_flight:
+                        collect_range(pending.popleft())
+                while pending:
+                    collect_range(pending.popleft())
+                return finish_aggregation(aggregator, rows_count, started), warnings, rows_count
+
+        def collect(future):
+            exported, chunk_warnings = future.result()
+            aggregator.merge(exported)
+            warnings.extend(chunk_warnings)
+
+        rows_count = 0
+        chunk = []
+        for row in iter_spreadsheet_rows(file_path):
+            chunk.append(row)
+            if len(chunk) < self.chunk_rows:
+                continue
+            if cancel_event is not None and cancel_event.is_set():
+                raise asyncio.CancelledError()
+            pending.append(pool.submit(aggregate_chunk_in_worker, chunk, settings, rows_count + 1))
+            rows_count += len(chunk)
+            chunk = []
+            while len(pending) >= max_in_flight:
+                collect(pending.popleft())
+        if chunk:
+            pending.append(pool.submit(aggregate_chunk_in_worker, chunk, settings, rows_count + 1))
+            rows_count += len(chunk)
+        # Порции собираются по порядку, поэтому предупреждения идут по номерам строк
+        while pending:
+            collect(pending.popleft())
+        return finish_aggregation(aggregator, rows_count, started), warnings, rows_count
+
+def create_compute_backend():
+    if COMPUTE_BACKEND == 'process':
+        return ProcessComputeBackend()
+    return ThreadComputeBackend()
+
+compute_backend = create_compute_backend()
+
+# Снимки загруженных данных для повторных импортов
+SNAPSHOT_DB = os.getenv('SNAPSHOT_DB', '/tmp/import_snapshots.db')  # Файл SQLite со снимками
+SNAPSHOT_KEEP_DAYS = int(os.getenv('SNAPSHOT_KEEP_DAYS', '7'))  # Сколько дней хранить снимки
+
+def file_sha256(file_path: str) -> str:
+    """Хэш содержимого файла"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def settings_fingerprint(settings: Dict[str, str]) -> str:
+    """Хэш настроек: смена ссылок делает прежние снимки недействительными"""
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class SnapshotStore:
+    """Снимки агрегатов по городу и дню для каждого листа с датой.
+
+    Снимок сохраняется после успешной записи города в лист. Повторная загрузка
+    за тот же день сравнивается со снимком: города без изменений пропускаются,
+    для остальных пишутся только изменившиеся даты. Хэши уже импортированных
+    файлов позволяют сразу завершить загрузку точного дубликата.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS city_snapshots (
+                    city TEXT, sheet_name TEXT, sheet_url TEXT, updated REAL,
+                    PRIMARY KEY (city, sheet_name)
+                );
+                CREATE TABLE IF NOT EXISTS snapshot_days (
+                    city TEXT, sheet_name TEXT, day INTEGER, kn INTEGER, income REAL,
+                    PRIMARY KEY (city, sheet_name, day)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS imported_files (
+                    content_hash TEXT, sheet_name TEXT, settings_hash TEXT, created REAL,
+                    PRIMARY KEY (content_hash, sheet_name, settings_hash)
+                );
+            """)
+        return self._conn
+
+    def load(self, city: str, sheet_name: str, sheet_url: str) -> Optional[Dict[datetime, Dict[str, float]]]:
+        """Снимок города для листа или None, если лист создавали не по этой ссылке"""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT sheet_url FROM city_snapshots WHERE city = ? AND sheet_name = ?",
+                (city, sheet_name)
+            ).fetchone()
+            if row is None or row[0] != sheet_url:
+                return None
+            days = conn.execute(
+                "SELECT day, kn, income FROM snapshot_days WHERE city = ? AND sheet_name = ?",
+                (city, sheet_name)
+            ).fetchall()
+        return {datetime.fromordinal(day): {'kn': kn, 'income': income} for day, kn, income in days}
+
+    def save(self, city: str, sheet_name: str, sheet_url: str, dates: Dict[datetime, Dict[str, float]]):
+        """Заменяет снимок города для листа"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM snapshot_days WHERE city = ? AND sheet_name = ?", (city, sheet_name))
+                conn.executemany(
+                    "INSERT INTO snapshot_days VALUES (?, ?, ?, ?, ?)",
+                    [(city, sheet_name, day.toordinal(), values['kn'], values['income']) for day, values in dates.items()]
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO city_snapshots VALUES (?, ?, ?, ?)",
+                    (city, sheet_name, sheet_url, time.time())
+                )
+
+    def forget(self, city: str, sheet_name: str):
+        """Удаляет снимок (лист удалён или его содержимое неизвестно)"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM snapshot_days WHERE city = ? AND sheet_name = ?", (city, sheet_name))
+                conn.execute("DELETE FROM city_snapshots WHERE city = ? AND sheet_name = ?", (city, sheet_name))
+                conn.execute("DELETE FROM imported_files WHERE sheet_name = ?", (sheet_name,))
+
+    def is_imported(self, content_hash: str, sheet_name: str, settings_hash: str) -> bool:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT 1 FROM imported_files WHERE content_hash = ? AND sheet_name = ? AND settings_hash = ?",
+                (content_hash, sheet_name, settings_hash)
+            ).fetchone()
+        return row is not None
+
+    def unmark_imported(self, sheet_name: str):
+        """Снимает отметку с листов sheet_name перед записью: их содержимое меняется"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM imported_files WHERE sheet_name = ?", (sheet_name,))
+
+    def mark_imported(self, content_hash: str, sheet_name: str, settings_hash: str):
+        """Запоминает успешно импортированный файл и удаляет устаревшие снимки.
+
+        На лист отмечается только последний файл: после загрузки другого файла
+        повторная загрузка прежнего должна снова записать его значения.
+        """
+        cutoff = time.time() - SNAPSHOT_KEEP_DAYS * 86400
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("DELETE FROM imported_files WHERE sheet_name = ?", (sheet_name,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO imported_files VALUES (?, ?, ?, ?)",
+                    (content_hash, sheet_name, settings_hash, time.time())
+                )
+                conn.execute("DELETE FROM imported_files WHERE created < ?", (cutoff,))
+                conn.execute(
+                    "DELETE FROM snapshot_days WHERE (city, sheet_name) IN "
+                    "(SELECT city, sheet_name FROM city_snapshots WHERE updated < ?)",
+                    (cutoff,)
+                )
+                conn.execute("DELETE FROM city_snapshots WHERE updated < ?", (cutoff,))
+
+snapshot_store = SnapshotStore(SNAPSHOT_DB)
+
+def diff_city_data(previous: Dict[datetime, Dict[str, float]],
+                   current: Dict[datetime, Dict[str, float]]) -> Dict[datetime, Dict[str, float]]:
+    """Даты, значения которых изменились; пропавшие из выгрузки даты обнуляются"""
+    delta = {}
+    for date, values in current.items():
+        old = previous.get(date)
+        if old is None or old['kn'] != values['kn'] or not same_cell_value(old['income'], values['income']):
+            delta[date] = values
+    for date in previous.keys() - current.keys():
+        delta[date] = {'kn': 0, 'income': 0}
+    return delta
+
+def import_city(city: str, sheet_url: str, date_str: str, dates: Dict[datetime, Dict[str, float]],
+                checkpoint=None, done: Optional[dict] = None) -> Tuple[str, Dict[str, int]]:
+    """Переносит данные города в лист с датой, используя снимок прошлой загрузки.
+
+    checkpoint(**шаги) отмечает выполненные шаги: sheet - лист создан, written -
+    данные записаны. done - шаги города из прерванной задачи: созданный ею лист
+    не пересоздаётся, в него дописываются данные. Возвращает (описание,
+    статистика записи).
+    """
+    if checkpoint is None:
+        checkpoint = lambda **steps: None
+    if done and done.get("sheet") and not done.get("written"):
+        try:
+            with metrics.timer("import_stage_duration_seconds", stage="write", city=city):
+                stats = write_data_to_sheet(sheet_url, done["sheet"], dates)
+            snapshot_store.save(city, done["sheet"], sheet_url, dates)
+            checkpoint(sheet=done["sheet"], written=True)
+            return f"дописан лист {done['sheet']}", stats
+        except Exception as e:
+            logger.warning(f"Город {city}: не удалось дописать лист {done['sheet']}, пересоздаём: {str(e)}")
+
+    previous = snapshot_store.load(city, date_str, sheet_url)
+    if previous is not None:
+        delta = diff_city_data(previous, dates)
+        if not delta:
+            checkpoint(written=True)
+            return "без изменений", {"cells_written": 0, "cells_skipped": 0, "ranges": 0, "requests": 0}
+        try:
+            with metrics.timer("import_stage_duration_seconds", stage="write", city=city):
+                stats = write_data_to_sheet(sheet_url, date_str, delta)
+            snapshot_store.save(city, date_str, sheet_url, dates)
+            checkpoint(written=True)
+            return f"обновлено дат: {len(delta)}", stats
+        except Exception as e:
+            # Лист могли удалить или изменить вручную - пересоздаём его целиком
+            logger.warning(f"Город {city}: не удалось обновить лист {date_str}, пересоздаём: {str(e)}")
+            snapshot_store.forget(city, date_str)
+
+    with metrics.timer("import_stage_duration_seconds", stage="rotate", city=city):
+        sheet_name = create_sheet_with_date(sheet_url, date_str)
+    checkpoint(sheet=sheet_name)
+    with metrics.timer("import_stage_duration_seconds", stage="write", city=city):
+        stats = write_data_to_sheet(sheet_url, sheet_name, dates)
+    snapshot_store.save(city, sheet_name, sheet_url, dates)
+    checkpoint(written=True)
+    return f"создан лист {sheet_name}", stats
+
+# Подготовленные импорты: разбор без записи (?prepare=true) и запись по /api/tasks/{id}/commit
+PREPARED_CACHE_TTL = float(os.getenv('PREPARED_CACHE_TTL', '3600'))  # Сколько хранить разобранный файл (сек)
+PREPARED_CACHE_MAX_MB = float(os.getenv('PREPARED_CACHE_MAX_MB', '256'))  # Оценка памяти под разобранные файлы (МБ)
+PREPARED_DATE_BYTES = 400  # Примерная память на одну дату города (datetime и словарь kn/income)
+
+class PreparedCache:
+    """Результаты разбора файлов по (SHA-256 содержимого, отпечаток настроек).
+
+    Запись и повторная загрузка того же файла берут агрегаты отсюда и не
+    разбирают файл заново. Размер записи оценивается по числу дат и длине
+    предупреждений; при превышении max_bytes вытесняются давно не
+    использованные записи.
+    """
+
+    def __init__(self, ttl: float = PREPARED_CACHE_TTL, max_bytes: float = PREPARED_CACHE_MAX_MB * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _estimate(city_data: Dict[str, Dict[datetime, Dict[str, float]]], warnings: List[str]) -> int:
+        dates = sum(len(dates) for dates in city_data.values())
+        return dates * PREPARED_DATE_BYTES + sum(len(warning) * 2 + 64 for warning in warnings)
+
+    def get(self, content_hash: str, settings_hash: str) -> Optional[dict]:
+        key = (content_hash, settings_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry["created"] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, content_hash: str, settings_hash: str, city_data: Dict[str, Dict[datetime, Dict[str, float]]],
+            warnings: List[str], rows_count: int) -> dict:
+        entry = {
+            "city_data": city_data,
+            "warnings": warnings,
+            "rows_count": rows_count,
+            "created": time.monotonic(),
+            "size": self._estimate(city_data, warnings),
+        }
+        key = (content_hash, settings_hash)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if entry["size"] <= self.max_bytes:
+                self._entries[key] = entry
+                self._size += entry["size"]
+                while self._size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+        return entry
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)["size"]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"files": len(self._entries), "size_mb": round(self._size / 1024 / 1024, 1),
+                    "hits": self.hits, "misses": self.misses}
+
+prepared_cache = PreparedCache()
+
+def prepared_preview(city_data: Dict[str, Dict[datetime, Dict[str, float]]]) -> Dict[str, dict]:
+    """Итоги по городам для статуса подготовленной задачи"""
+    preview = {}
+    for city, dates in city_data.items():
+        if not dates:
+            continue
+        preview[city] = {
+            "dates": len(dates),
+            "first_date": min(dates).strftime("%d.%m.%Y"),
+            "last_date": max(dates).strftime("%d.%m.%Y"),
+            "kn": sum(values["kn"] for values in dates.values()),
+            "income": round(sum(values["income"] for values in dates.values()), 2),
+        }
+    return preview
+
+# Профилирование отдельных задач импорта
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))  # Доля загрузок, профилируемых без ?profile=true
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.01'))  # Период выборки стеков (сек)
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'import_profiles'))  # Папка профилей
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '20'))  # Сколько последних профилей хранить
+PROFILE_FORMATS = {
+    "summary": ("json", "application/json"),
+    "pstats": ("prof", "application/octet-stream"),
+    "collapsed": ("collapsed", "text/plain; charset=utf-8"),
+}
+
+# Профиль задачи, выполняющейся в текущем контексте asyncio (None - профилирование выключено)
+current_profile: contextvars.ContextVar = contextvars.ContextVar('current_profile', default=None)
+
+def current_rss_bytes() -> Optional[int]:
+    """Текущий RSS процесса из /proc (только Linux)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class TaskProfile:
+    """Профиль одной задачи импорта: этапы и выборки стеков.
+
+    Фоновый поток раз в interval секунд снимает стеки потоков пулов, которые
+    сейчас выполняют вызовы этой задачи (run_blocking), и RSS процесса. Для
+    каждого этапа считаются время (wall), процессорное время вызовов в пулах
+    (сумма по потокам, может превышать wall) и пиковый RSS процесса. Выборка не
+    замедляет сам код, поэтому профиль можно включать в продакшене.
+    """
+
+    def __init__(self, task_id: str, interval: float = PROFILE_INTERVAL):
+        self.task_id = task_id
+        self.interval = interval
+        self.stages: Dict[str, dict] = {}
+        self.stage = "prepare"  # До первого этапа
+        self.samples = {}  # (этап, стек от внешней функции к внутренней) -> выборок
+        self._threads: Dict[int, str] = {}  # поток -> этап, для которого он работает
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profile-{task_id[:8]}", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _entry(self, stage: str) -> dict:
+        entry = self.stages.get(stage)
+        if entry is None:
+            entry = self.stages[stage] = {"wall_s": 0.0, "cpu_s": 0.0, "samples": 0, "peak_rss_mb": None,
+                                          "calls": {}}
+        return entry
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        """Этап задачи (вызывается в event loop)"""
+        self.stage = stage
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._entry(stage)["wall_s"] += time.perf_counter() - started
+
+    def run(self, func, args, kwargs):
+        """Выполняет вызов задачи в потоке пула, учитывая его время и CPU"""
+        stage = self.stage
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = stage
+        started, cpu_started = time.perf_counter(), time.thread_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            cpu = time.thread_time() - cpu_started
+            wall = time.perf_counter() - started
+            name = getattr(func, '__qualname__', repr(func))
+            with self._lock:
+                del self._threads[ident]
+                entry = self._entry(stage)
+                entry["cpu_s"] += cpu
+                call = entry["calls"].setdefault(name, {"count": 0, "wall_s": 0.0, "cpu_s": 0.0})
+                call["count"] += 1
+                call["wall_s"] += wall
+                call["cpu_s"] += cpu
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            rss = current_rss_bytes()
+            with self._lock:
+                entry = self._entry(self.stage)
+                if rss is not None:
+                    rss_mb = round(rss / 1024 / 1024, 1)
+                    entry["peak_rss_mb"] = max(entry["peak_rss_mb"] or 0, rss_mb)
+                for ident, stage in self._threads.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                        frame = frame.f_back
+                    key = (stage, tuple(reversed(stack)))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+                    self._entry(stage)["samples"] += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            stages = {name: {**entry, "wall_s": round(entry["wall_s"], 4), "cpu_s": round(entry["cpu_s"], 4),
+                             "calls": {call: {**stats, "wall_s": round(stats["wall_s"], 4),
+                                              "cpu_s": round(stats["cpu_s"], 4)}
+                                       for call, stats in entry["calls"].items()}}
+                      for name, entry in self.stages.items()}
+        return {"task_id": self.task_id, "started": datetime.fromtimestamp(self._started).isoformat(),
+                "interval_s": self.interval, "compute_backend": compute_backend.name, "stages": stages}
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed (flamegraph.pl, speedscope): этап;функция;... выборок"""
+        lines = []
+        for (stage, stack), count in sorted(self.samples.items()):
+            frames = [stage] + [f"{name} ({os.path.basename(filename)}:{line})" for filename, line, name in stack]
+            lines.append(f"{';'.join(frame.replace(';', ',') for frame in frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def pstats_data(self) -> dict:
+        """Выборки в формате словаря pstats (время = выборки * interval)"""
+        stats = {}
+        for (_, stack), count in self.samples.items():
+            seconds = count * self.interval
+            for index, func in enumerate(stack):
+                if func in stack[:index]:
+                    continue  # Рекурсия: функцию учитываем в выборке один раз
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                own = seconds if index == len(stack) - 1 else 0.0
+                stats[func] = (cc + count, nc + count, tt + own, ct + seconds, callers)
+                if index:
+                    caller = stack[index - 1]
+                    c_cc, c_nc, c_tt, c_ct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (c_cc + count, c_nc + count, c_tt + own, c_ct + seconds)
+        return stats
+
+    def save(self, directory: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+        """Пишет summary (JSON), pstats (marshal) и collapsed-стеки; старые профили удаляет"""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, self.task_id)
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+        with open(f"{base}.prof", 'wb') as f:
+            marshal.dump(self.pstats_data(), f)
+        with open(f"{base}.collapsed", 'w', encoding='utf-8') as f:
+            f.write(self.collapsed())
+
+        summaries = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.json')),
+                           key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in summaries[keep:]:
+            for extension, _ in PROFILE_FORMATS.values():
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, f"{entry.name[:-len('.json')]}.{extension}"))
+
+def profile_stage(stage: str):
+    """Этап для профиля текущей задачи; без профиля ничего не делает"""
+    profile = current_profile.get()
+    return profile.measure(stage) if profile is not None else contextlib.nullcontext()
+
+def profile_path(task_id: str, fmt: str) -> Optional[str]:
+    extension, _ = PROFILE_FORMATS[fmt]
+    path = os.path.join(PROFILE_DIR, f"{os.path.basename(task_id)}.{extension}")
+    return path if os.path.exists(path) else None
+
+# Фоновая задача для обработки файла
+async def process_file_task(task_id: str, file_path: Optional[str], content_hash: Optional[str] = None,
+                            cancel_event: Optional[threading.Event] = None, profile: bool = False,
+                            prepare_only: bool = False, prepared: Optional[dict] = None,
+                            resume: Optional[dict] = None):
+    """Фоновая задача для обработки XLS файла.
+
+    profile - записать профиль задачи. prepare_only - только разобрать файл и
+    показать итоги (статус prepared), без записи в Google. prepared - уже
+    разобранные данные (запись подготовленной задачи), файл не нужен.
+    resume - {"date_str", "checkpoints"} прерванной задачи: записанные ею
+    города пропускаются, листы с той же датой дописываются.
+    """
+    # Флаг отмены для заданий в пулах потоков (его выставляет и /api/tasks/{id}/cancel)
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    task_profile = None
+    if profile:
+        # Переменная контекста видна только этой задаче asyncio и её подзадачам
+        task_profile = TaskProfile(task_id)
+        current_profile.set(task_profile)
+        task_profile.start()
+    
+    try:
+        # Обновляем статус при начале обработки
+        task_store.log(task_id, "Начинаем обработку файла...")
         
-        # Обрабатываем данные XLS
-        city_data, warnings = process_xls_data(data, settings)
-        task_status[task_id]["success"].append(f"Данные сгруппированы по городам - найдено {len(city_data)} городов с данными")
+        # Загружаем настройки
+        settings_snapshot = settings_service.get()
+        settings = settings_snapshot.cities
+        task_store.log(task_id, "Загружены настройки системы")
+
+        # Точный дубликат уже импортированного сегодня файла ничего не меняет
+        date_str = resume["date_str"] if resume else datetime.now().strftime("%d%m%y")
+        if content_hash is None:
+            with profile_stage("hash"):
+                content_hash = await run_cpu_bound(file_sha256, file_path, cancel_event=cancel_event)
+        check_cancelled(cancel_event)
+        settings_hash = settings_snapshot.fingerprint
+        # По этим полям задачу можно возобновить (/api/tasks/{id}/resume) или записать после подготовки
+        task_store.update(task_id, content_hash=content_hash, settings_hash=settings_hash, sheet_date=date_str)
+        imported = False
+        if not prepare_only:
+            with profile_stage("dedupe"):
+                imported = await run_sheets_io(snapshot_store.is_imported, content_hash, date_str, settings_hash)
+        if imported:
+            logger.info(f"Задача {task_id}: файл уже импортирован в листы {date_str}")
+            task_store.log(task_id, f"Этот файл уже загружен в листы {date_str} - изменений нет")
+            task_store.set_progress(task_id, current=len(CITIES), total=len(CITIES))
+            task_store.update(task_id, status="completed")
+            return
         
-        # Получаем текущую дату в формате DDMMYY
-        date_str = datetime.now().strftime("%d%m%y")
+        # Файл, уже разобранный при подготовке или прошлой загрузке, заново не разбираем
+        if prepared is None:
+            prepared = prepared_cache.get(content_hash, settings_hash)
+            if prepared is not None:
+                task_store.log(task_id, "Файл уже разобран ранее - используем готовые итоги")
+        if prepared is None:
+            # Парсим Excel файл потоково - строки сразу уходят в агрегацию (в потоке или пуле процессов)
+            with profile_stage("parse"):
+                city_data, warnings, rows_count = await run_cpu_bound(
+                    compute_backend.aggregate_file, file_path, settings, cancel_event, cancel_event=cancel_event
+                )
+            prepared = prepared_cache.put(content_hash, settings_hash, city_data, warnings, rows_count)
+        city_data, warnings, rows_count = prepared["city_data"], prepared["warnings"], prepared["rows_count"]
+        check_cancelled(cancel_event)
+        task_store.log(task_id, f"Файл Excel обработан - {rows_count} строк данных")
+        task_store.log(task_id, f"Данные сгруппированы по городам - найдено {len(city_data)} городов с данными")
+
+        if prepare_only:
+            for warning in warnings:
+                task_store.add_error(task_id, "Общие", warning)
+            task_store.log(task_id, f"Подготовка завершена, предупреждений: {len(warnings)}. "
+                                    f"Проверьте итоги и подтвердите запись в таблицы")
+            task_store.update(task_id, status="prepared", preview=prepared_preview(city_data))
+            return
         
-        # Список городов
-        cities = [
-            'Балашиха', 'Железнодорожный', 'Жуковский', 'Ивантеевка', 'Казань',
-            'Королев', 'Люберцы', 'Мытищи', 'Ногинск', 'Пушкино',
-            'Раменское', 'Сергиев Посад', 'Фрязино', 'Щелково', 'Электросталь'
-        ]
+        calls_saved_before = spreadsheet_cache.stats()["calls_saved"]
+        write_stats = {"cells_written": 0, "cells_skipped": 0, "ranges": 0, "requests": 0}
         
+        cities = CITIES
         total_cities = len(cities)
         current_progress = 0
-        errors = []
+        failed_cities = 0
+        skipped_cities = 0  # Без ссылки на таблицу - не мешают отметке файла как загруженного
         
         # Добавляем предупреждения в ошибки
         for warning in warnings:
-            errors.append({"city": "Общие", "message": warning})
+            task_store.add_error(task_id, "Общие", warning)
         
         # Обновляем статус
-        task_status[task_id]["progress"]["current"] = current_progress
-        task_status[task_id]["errors"] = errors
+        task_store.set_progress(task_id, current=current_progress, total=total_cities)
+
+        # До записи первого города листы перестают соответствовать прежнему файлу,
+        # даже если эта загрузка упадёт на середине
+        await run_sheets_io(snapshot_store.unmark_imported, date_str)
         
-        # Обрабатываем каждый город
-        for i, city in enumerate(cities, 1):
+        # Города пишутся в независимые таблицы, поэтому обрабатываем их параллельно.
+        # Частоту запросов ограничивает общий sheets_limiter, а не паузы между городами.
+        # Таблицу, в которую пишет другая задача, ждём по spreadsheet_locks.
+        city_semaphore = asyncio.Semaphore(CITY_CONCURRENCY)
+        done_steps = resume["checkpoints"] if resume else {}
+
+        async def process_city(city: str):
+            nonlocal current_progress, failed_cities, skipped_cities
             try:
-                if city in settings and settings[city]:
+                if done_steps.get(city, {}).get("written"):
+                    task_store.log(task_id, f"Город {city}: уже записан прерванной задачей - пропускаем")
+                elif city in settings and settings[city]:
                     # Проверяем, есть ли данные для этого города
                     if city in city_data and city_data[city]:
-                        logger.info(f"Начинаем обработку города: {city}")
-                        task_status[task_id]["success"].append(f"Начинаем обработку города: {city}")
-                        
-                        # Обновляем статус после каждого шага
-                        task_status[task_id]["progress"]["current"] = current_progress
-                        task_status[task_id]["progress"]["current_city"] = city
-                        task_status[task_id]["errors"] = errors
-                        
-                        # Создаем лист с датой
-                        sheet_name = create_sheet_with_date(settings[city], date_str)
-                        task_status[task_id]["success"].append(f"Создан лист {sheet_name} для города {city}")
-                        
-                        # Записываем обработанные данные
-                        write_data_to_sheet(settings[city], sheet_name, city_data[city])
-                        
+                        sheet_key = spreadsheet_locks.key(settings[city])
+                        if spreadsheet_locks.locked(sheet_key):
+                            task_store.log(task_id, f"Город {city}: таблица занята другой задачей, ожидаем")
+                        async with spreadsheet_locks.hold(sheet_key), city_semaphore:
+                            check_cancelled(cancel_event)
+                            logger.info(f"Начинаем обработку города: {city}")
+                            task_store.log(task_id, f"Начинаем обработку города: {city}")
+                            task_store.set_progress(task_id, current_city=city)
+
+                            # Создаем лист с датой и записываем данные (или только изменения)
+                            outcome, city_stats = await run_sheets_io(
+                                import_city, city, settings[city], date_str, city_data[city],
+                                functools.partial(task_store.checkpoint, task_id, city), done_steps.get(city),
+                                cancel_event=cancel_event
+                            )
+                            task_store.log(task_id, f"Город {city}: {outcome}")
+                            for key, value in city_stats.items():
+                                write_stats[key] += value
+
                         logger.info(f"Город {city} обработан успешно - {len(city_data[city])} дат")
-                        task_status[task_id]["success"].append(f"Город {city} обработан успешно - {len(city_data[city])} дат")
+                        task_store.log(task_id, f"Город {city} обработан успешно - {len(city_data[city])} дат")
                     else:
                         logger.info(f"Город {city} - нет данных для обработки")
-                        task_status[task_id]["success"].append(f"Город {city} - нет данных для обработки")
+                        task_store.log(task_id, f"Город {city} - нет данных для обработки")
                 else:
+                    # Не ошибка записи: без ссылки город пропускается и при повторной загрузке,
+                    # а после её добавления меняется отпечаток настроек - дубликат не отсеется
                     logger.warning(f"Город {city} - ссылка на таблицу не настроена")
-                    errors.append({"city": city, "message": "Ссылка на таблицу не настроена"})
+                    skipped_cities += 1
+                    task_store.add_error(task_id, city, "Ссылка на таблицу не настроена")
             except Exception as e:
                 logger.error(f"Ошибка при обработке города {city}: {str(e)}")
-                errors.append({"city": city, "message": str(e)})
-                
-                # Добавляем дополнительную задержку при ошибке
-                await asyncio.sleep(RETRY_DELAY)
-            
+                failed_cities += 1
+                task_store.add_error(task_id, city, str(e))
+
             current_progress += 1
-            task_status[task_id]["progress"]["current"] = current_progress
-            task_status[task_id]["progress"]["total"] = total_cities
-            task_status[task_id]["progress"]["current_city"] = city
-            task_status[task_id]["errors"] = errors
+            task_store.set_progress(task_id, current=current_progress)
 
-            
-            # Добавляем задержку между обработкой городов для избежания превышения квоты
-            if i < len(cities):  # Не делаем задержку после последнего города
-                await asyncio.sleep(GOOGLE_API_DELAY * 3)  # Увеличиваем задержку
+        # Дожидаемся всех городов даже при отмене, чтобы не оставить запись в таблицу после выхода
+        with profile_stage("cities"):
+            await asyncio.gather(*(process_city(city) for city in cities), return_exceptions=True)
+        check_cancelled(cancel_event)
         
         # Завершаем задачу
-        task_status[task_id]["success"].append("Обработка всех городов завершена")
-        task_status[task_id]["status"] = "completed"
-
+        calls_saved = spreadsheet_cache.stats()["calls_saved"] - calls_saved_before
+        logger.info(f"Задача {task_id}: кэш таблиц сэкономил {calls_saved} запросов к Google API")
+        task_store.log(task_id, f"Кэш таблиц сэкономил {calls_saved} запросов к Google API")
+        logger.info(f"Задача {task_id}: статистика записи {write_stats}")
+        task_store.log(task_id, 
+            f"Записано ячеек: {write_stats['cells_written']}, без изменений пропущено: {write_stats['cells_skipped']} "
+            f"({write_stats['ranges']} диапазонов в {write_stats['requests']} запросах)"
+        )
+        if skipped_cities:
+            task_store.log(task_id, f"Пропущено городов без ссылки на таблицу: {skipped_cities}")
+        if not failed_cities:
+            with profile_stage("finish"):
+                await run_sheets_io(snapshot_store.mark_imported, content_hash, date_str, settings_hash)
+        task_store.log(task_id, "Обработка всех городов завершена")
+        task_store.update(task_id, status="completed")
         
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
         logger.error(f"Критическая ошибка в задаче {task_id}: {error_details}")
-        task_status[task_id] = {
-            "status": "failed",
-            "error": str(e),
-            "error_details": error_details,
-            "success": task_status.get(task_id, {}).get("success", []) + [f"Ошибка: {str(e)}"]
-        }
+        task_store.log(task_id, f"Ошибка: {str(e)}")
+        task_store.update(task_id, status="failed", error=str(e), error_details=error_details)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        logger.warning(f"Задача {task_id} отменена")
+        task_store.log(task_id, "Обработка отменена")
+        task_store.update(task_id, status="cancelled")
+        raise
     finally:
         # Удаляем временный файл
-        if os.path.exists(file_path):
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
+        if task_profile is not None:
+            task_profile.stop()
+            try:
+                task_profile.save()
+                task_store.update(task_id, profile_ready=True)
+                logger.info(f"Задача {task_id}: профиль сохранён в {PROFILE_DIR}")
+            except Exception as e:
+                logger.error(f"Задача {task_id}: не удалось сохранить профиль: {str(e)}")
+
+# Очередь импортов и блокировки таблиц
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))  # Импортов, выполняемых одновременно
+JOB_QUEUE_MAX = int(os.getenv('JOB_QUEUE_MAX', '20'))  # Максимум задач, ожидающих в очереди
+JOB_PRIORITIES = {"high": 0, "normal": 1, "low": 2}  # high - ручной перезапуск, low - массовая догрузка
+
+class SpreadsheetLocks:
+    """Блокировки по ID таблицы.
+
+    Задачи, пишущие в одну таблицу, работают с ней по очереди (удаление и
+    копирование листа с датой не пересекаются), а города в разных таблицах
+    обрабатываются параллельно. Блокировка удаляется, когда её никто не ждёт.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}  # ID таблицы -> [asyncio.Lock, владелец и ожидающие]
+
+    @staticmethod
+    def key(sheet_url: str) -> str:
+        try:
+            return extract_sheet_id_from_url(sheet_url)
+        except Exception:
+            return sheet_url
+
+    def locked(self, key: str) -> bool:
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+spreadsheet_locks = SpreadsheetLocks()
+
+class QueueFullError(Exception):
+    """Очередь импортов заполнена - задача не принята"""
+
+class ImportJob:
+    """Задача импорта в очереди"""
+
+    def __init__(self, task_id: str, file_path: Optional[str], content_hash: Optional[str], priority: int, seq: int,
+                 profile: bool = False, prepare_only: bool = False, prepared: Optional[dict] = None,
+                 resume: Optional[dict] = None):
+        self.task_id = task_id
+        self.file_path = file_path
+        self.content_hash = content_hash
+        self.priority = priority
+        self.seq = seq
+        self.profile = profile
+        self.prepare_only = prepare_only
+        self.prepared = prepared  # Разобранные данные для записи подготовленной задачи
+        self.resume = resume  # Дата листов и шаги прерванной задачи при возобновлении
+        self.position = None
+        self.cancel_event = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+
+class JobQueue:
+    """Очередь импортов с приоритетами.
+
+    Одновременно выполняется не больше workers задач, остальные (не больше
+    max_queued) ждут в порядке приоритета, а при равном приоритете - в порядке
+    поступления. Позиция в очереди пишется в статус задачи (queue_position).
+    Методы вызываются из event loop, поэтому проверка места и постановка в
+    очередь в submit не разделены await.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self._queue = []  # куча (приоритет, номер поступления, task_id)
+        self._jobs: Dict[str, ImportJob] = {}
+        self._running: Dict[str, ImportJob] = {}
+        self._seq = itertools.count()
+
+    def is_full(self) -> bool:
+        return len(self._queue) >= self.max_queued
+
+    def submit(self, task_id: str, file_path: Optional[str], content_hash: Optional[str] = None,
+               priority: str = "normal", profile: bool = False, prepare_only: bool = False,
+               prepared: Optional[dict] = None, resume: Optional[dict] = None) -> ImportJob:
+        """Ставит задачу в очередь; QueueFullError, если ждут уже max_queued задач"""
+        if not prepare_only and self.is_full():
+            raise QueueFullError("Очередь импорта заполнена, попробуйте позже")
+        job = ImportJob(task_id, file_path, content_hash, JOB_PRIORITIES[priority], next(self._seq), profile,
+                        prepare_only, prepared, resume)
+        self._jobs[task_id] = job
+        if prepare_only:
+            # Подготовка не пишет в Google, поэтому не ждёт очереди импортов
+            self._start(job)
+            return job
+        heapq.heappush(self._queue, (job.priority, job.seq, task_id))
+        self._dispatch()
+        return job
+
+    def cancel(self, task_id: str) -> Optional[str]:
+        """Отменяет задачу этого процесса: ожидающую - сразу, выполняющуюся - между
+        запросами к Google. Возвращает "cancelled", "cancelling" или None, если задачи нет.
+        """
+        job = self._jobs.get(task_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.task is not None:
+            task_store.log(task_id, "Отмена запрошена - задача остановится после текущего запроса к Google")
+            return "cancelling"
+
+        self._queue = [item for item in self._queue if item[2] != task_id]
+        heapq.heapify(self._queue)
+        del self._jobs[task_id]
+        if job.file_path and os.path.exists(job.file_path):
+            os.remove(job.file_path)
+        task_store.log(task_id, "Задача отменена до начала обработки")
+        task_store.update(task_id, status="cancelled", queue_position=None)
+        self._publish_positions()
+        return "cancelled"
+
+    def stats(self) -> Dict[str, int]:
+        preparing = len(self._jobs) - len(self._running) - len(self._queue)
+        return {"running": len(self._running), "queued": len(self._queue), "preparing": preparing,
+                "workers": self.workers}
+
+    async def shutdown(self):
+        """Отменяет ожидающие и выполняющиеся задачи (при остановке сервера)"""
+        for _, _, task_id in list(self._queue):
+            self.cancel(task_id)
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _dispatch(self):
+        while self._queue and len(self._running) < self.workers:
+            _, _, task_id = heapq.heappop(self._queue)
+            job = self._jobs[task_id]
+            self._running[task_id] = job
+            self._start(job)
+        self._publish_positions()
+
+    def _start(self, job: ImportJob):
+        job.position = None
+        task_store.update(job.task_id, status="processing", queue_position=None)
+        # Ссылку на задачу храним, чтобы её не собрал GC и её можно было отменить
+        job.task = asyncio.create_task(
+            process_file_task(job.task_id, job.file_path, job.content_hash, cancel_event=job.cancel_event,
+                              profile=job.profile, prepare_only=job.prepare_only, prepared=job.prepared,
+                              resume=job.resume)
+        )
+        job.task.add_done_callback(lambda _, task_id=job.task_id: self._finished(task_id))
+
+    def _finished(self, task_id: str):
+        self._running.pop(task_id, None)
+        self._jobs.pop(task_id, None)
+        self._dispatch()
+
+    def _publish_positions(self):
+        for position, (_, _, task_id) in enumerate(sorted(self._queue), start=1):
+            job = self._jobs[task_id]
+            if job.position != position:
+                job.position = position
+                task_store.update(task_id, queue_position=position)
+
+job_queue = JobQueue()
+
+def submit_job(task_id: str, file_path: Optional[str], content_hash: Optional[str], priority: str,
+               **kwargs) -> ImportJob:
+    """Ставит задачу эндпоинта в очередь.
+
+    При заполненной очереди задача помечается failed, её файл удаляется, а
+    клиент получает 503.
+    """
+    try:
+        return job_queue.submit(task_id, file_path, content_hash, priority, **kwargs)
+    except QueueFullError as e:
+        if file_path and os.path.exists(file_path):
             os.remove(file_path)
+        task_store.update(task_id, status="failed", message=str(e), queue_position=None)
+        logger.warning(f"Задача {task_id} не принята: {e}")
+        raise HTTPException(status_code=503, detail=str(e))
 
 # API endpoints
 @app.post("/api/login", response_model=LoginResponse)
@@ -683,50 +2792,211 @@ async def login(request: LoginRequest):
         logger.error(f"Ошибка при авторизации: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка при авторизации")
 
+# Загрузка файлов
+UPLOAD_DIR = os.getenv('UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'xls_uploads'))  # Папка временных файлов загрузок
+UPLOAD_MAX_MB = int(os.getenv('UPLOAD_MAX_MB', '0'))  # Максимальный размер файла (МБ), 0 - без ограничения
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))  # Размер блока записи на диск (байт)
+UPLOAD_ORPHAN_AGE = float(os.getenv('UPLOAD_ORPHAN_AGE', '3600'))  # Возраст брошенного файла загрузки (сек)
+
+class UploadedFile(BaseModel):
+    filename: str
+    path: str
+    sha256: str
+    size: int
+
+async def receive_upload(request: Request, task_id: str) -> UploadedFile:
+    """Потоково сохраняет поле file из multipart-запроса в UPLOAD_DIR.
+
+    Данные пишутся на диск блоками по UPLOAD_CHUNK_SIZE по мере поступления,
+    хэш SHA-256 считается на лету, превышение UPLOAD_MAX_MB (если задан) прерывает приём.
+    """
+    max_bytes = UPLOAD_MAX_MB * 1024 * 1024 if UPLOAD_MAX_MB > 0 else math.inf
+    content_type, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise HTTPException(status_code=400, detail="Ожидается multipart/form-data")
+    content_length = request.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"Файл больше {UPLOAD_MAX_MB} МБ")
+
+    part = {"headers": {}, "field": b"", "value": b"", "is_file": False}
+    upload = {"filename": None, "finished": False}
+    pending = bytearray()  # Данные файла, ещё не записанные на диск
+
+    def on_part_begin():
+        part.update(headers={}, field=b"", value=b"", is_file=False)
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        if disposition.get(b"name") == b"file" and b"filename" in disposition and upload["filename"] is None:
+            part["is_file"] = True
+            upload["filename"] = disposition[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(data, start, end):
+        if part["is_file"]:
+            pending.extend(data[start:end])
+
+    def on_part_end():
+        if part["is_file"]:
+            part["is_file"] = False
+            upload["finished"] = True
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(UPLOAD_DIR, f"{task_id}.upload")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(file_path, "wb") as out:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                filename = upload["filename"]
+                if filename is not None and not (filename.endswith('.xls') or filename.endswith('.xlsx')):
+                    raise HTTPException(status_code=400, detail="Поддерживаются только файлы .xls и .xlsx")
+                if not pending or (len(pending) < UPLOAD_CHUNK_SIZE and not upload["finished"]):
+                    continue
+                size += len(pending)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Файл больше {UPLOAD_MAX_MB} МБ")
+                digest.update(pending)
+                await out.write(bytes(pending))
+                pending.clear()
+            parser.finalize()
+            if pending:
+                size += len(pending)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"Файл больше {UPLOAD_MAX_MB} МБ")
+                digest.update(pending)
+                await out.write(bytes(pending))
+        if not upload["finished"]:
+            raise HTTPException(status_code=400, detail="Файл не передан")
+    except BaseException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    return UploadedFile(filename=upload["filename"], path=file_path, sha256=digest.hexdigest(), size=size)
+
+@app.on_event("startup")
+async def start_compute_backend():
+    """Прогревает пул вычислений в фоне, не задерживая старт сервера"""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(parse_executor, compute_backend.start)
+
+    def report(done):
+        if not done.cancelled() and done.exception() is not None:
+            logger.error(f"Не удалось запустить пул вычислений: {str(done.exception())}")
+
+    future.add_done_callback(report)
+
+@app.on_event("startup")
+async def start_google_client():
+    """Заранее создаёт клиент Google: токен и соединения готовы к первой загрузке"""
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(sheets_executor, get_google_sheets_client)
+
+    def report(done):
+        if not done.cancelled() and done.exception() is not None:
+            logger.warning(f"Клиент Google Sheets не создан при старте: {str(done.exception())}")
+
+    future.add_done_callback(report)
+
+@app.on_event("startup")
+async def cleanup_orphan_uploads():
+    """Удаляет файлы загрузок, оставшиеся от прерванных процессов"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    cutoff = time.time() - UPLOAD_ORPHAN_AGE
+    removed = 0
+    for entry in os.scandir(UPLOAD_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл загрузки {entry.path}: {str(e)}")
+    if removed:
+        logger.info(f"Удалено брошенных файлов загрузок: {removed}")
+
 @app.post("/api/upload")
 async def upload_file(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...),
+    request: Request,
+    priority: str = "normal",
+    profile: bool = False,
+    prepare: bool = False,
     current_user: str = Depends(get_current_user)
 ):
-    """Загрузка Excel файла"""
+    """Загрузка Excel файла (потоково, поле file в multipart/form-data).
+
+    priority - high (ручной перезапуск), normal или low (массовая догрузка).
+    profile - записать профиль задачи (GET /api/tasks/{task_id}/profile); кроме того,
+    профилируется доля PROFILE_SAMPLE_RATE загрузок.
+    prepare - только разобрать файл и показать итоги и предупреждения (статус
+    prepared); запись в таблицы - POST /api/tasks/{task_id}/commit.
+    """
     try:
+        if priority not in JOB_PRIORITIES:
+            raise HTTPException(status_code=400, detail=f"Неизвестный приоритет: {priority}")
+        # Заполненную очередь проверяем и до приёма файла, чтобы не принимать его зря;
+        # окончательно место проверяет submit - за время приёма очередь могла заполниться
+        if not prepare and job_queue.is_full():
+            raise HTTPException(status_code=503, detail="Очередь импорта заполнена, попробуйте позже")
 
-        
-        if not (file.filename.endswith('.xls') or file.filename.endswith('.xlsx')):
-            logger.warning(f"Попытка загрузки неподдерживаемого файла: {file.filename}")
-            raise HTTPException(status_code=400, detail="Поддерживаются только файлы .xls и .xlsx")
-        
         # Создаем уникальный ID задачи
         task_id = str(uuid.uuid4())
         
-        # Сохраняем файл временно с правильным расширением
-        file_extension = '.xlsx' if file.filename.endswith('.xlsx') else '.xls'
-        file_path = f"temp_{task_id}{file_extension}"
-        
+        # Сохраняем файл во временную папку блоками, считая хэш на лету
         try:
-            with open(file_path, "wb") as buffer:
-                content = await file.read()
-                buffer.write(content)
+            with metrics.timer("import_stage_duration_seconds", stage="upload"):
+                uploaded = await receive_upload(request, task_id)
+        except HTTPException as e:
+            logger.warning(f"Загрузка отклонена: {e.detail}")
+            raise
         except Exception as e:
-            logger.error(f"Ошибка при сохранении файла {file.filename}: {str(e)}")
+            logger.error(f"Ошибка при сохранении файла: {str(e)}")
             raise HTTPException(status_code=500, detail="Ошибка при сохранении файла")
-        
+
+        # Проверяем формат по содержимому, а не только по расширению
+        try:
+            file_format = detect_spreadsheet_format(uploaded.path)
+        except Exception as e:
+            os.remove(uploaded.path)
+            logger.warning(f"Неподдерживаемое содержимое файла {uploaded.filename}: {str(e)}")
+            raise HTTPException(status_code=400, detail=str(e))
+
         # Инициализируем статус задачи
-        task_status[task_id] = {
-            "status": "processing",
-            "progress": {"current": 0, "total": 15},
-            "errors": [],
-            "success": ["Задача создана, ожидание начала обработки..."]
-        }
-        
-        logger.info(f"Создана задача {task_id} для файла {file.filename}")
+        profile = profile or random.random() < PROFILE_SAMPLE_RATE
+        task_store.create(task_id, total=len(CITIES), message="Задача создана, ожидание начала обработки...",
+                          status="queued", priority=priority, profiled=profile, prepare=prepare)
         
-        # Запускаем фоновую задачу в отдельном потоке
-        import asyncio
-        asyncio.create_task(process_file_task(task_id, file_path))
+        logger.info(f"Создана задача {task_id} для файла {uploaded.filename} "
+                    f"(формат {file_format}, {uploaded.size} байт, sha256 {uploaded.sha256[:12]}, приоритет {priority})")
         
-        return {"task_id": task_id, "message": "Файл загружен и начата обработка"}
+        # Ставим задачу в очередь; при свободном месте она сразу начинает выполняться
+        job = submit_job(task_id, uploaded.path, uploaded.sha256, priority, profile=profile, prepare_only=prepare)
+        if prepare:
+            return {"task_id": task_id, "queue_position": None, "message": "Файл загружен, идёт проверка"}
+        if job.position:
+            return {"task_id": task_id, "queue_position": job.position,
+                    "message": f"Файл загружен и поставлен в очередь (позиция {job.position})"}
+        return {"task_id": task_id, "queue_position": None, "message": "Файл загружен и начата обработка"}
         
     except HTTPException:
         raise
@@ -734,28 +3004,232 @@ async def upload_file(
         logger.error(f"Неожиданная ошибка при загрузке файла: {str(e)}")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
+@app.post("/api/tasks/{task_id}/cancel")
+async def cancel_task(task_id: str, current_user: str = Depends(get_current_user)):
+    """Отменяет задачу импорта: ожидающую в очереди - сразу, выполняющуюся - между запросами к Google"""
+    status = job_queue.cancel(task_id)
+    if status is None:
+        task = task_store.get(task_id)
+        if task is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        if task["status"] in TASK_FINAL_STATUSES:
+            raise HTTPException(status_code=409, detail=f"Задача уже завершена со статусом {task['status']}")
+        raise HTTPException(status_code=409, detail="Задача выполняется в другом процессе сервера")
+
+    logger.info(f"Задача {task_id}: отмена по запросу {current_user} ({status})")
+    return {"task_id": task_id, "status": status}
+
+def prepared_task_data(task_id: str) -> Tuple[dict, dict]:
+    """(задача, разобранные данные) подготовленной задачи или HTTPException"""
+    task = task_store.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if task["status"] != "prepared":
+        raise HTTPException(status_code=409, detail=f"Задача не подготовлена к записи (статус {task['status']})")
+    prepared = prepared_cache.get(task["content_hash"], task["settings_hash"])
+    if prepared is None:
+        raise HTTPException(status_code=410, detail="Подготовленные данные устарели - загрузите файл заново")
+    return task, prepared
+
+@app.get("/api/tasks/{task_id}/preview")
+async def get_task_preview(task_id: str, current_user: str = Depends(get_current_user)):
+    """КН и доход по городам и датам подготовленной задачи"""
+    _, prepared = prepared_task_data(task_id)
+    return {
+        "rows": prepared["rows_count"],
+        "warnings": len(prepared["warnings"]),
+        "cities": {
+            city: [{"date": date.strftime("%d.%m.%Y"), "kn": values["kn"], "income": round(values["income"], 2)}
+                   for date, values in sorted(dates.items())]
+            for city, dates in prepared["city_data"].items() if dates
+        },
+    }
+
+@app.post("/api/tasks/{task_id}/commit")
+async def commit_task(task_id: str, priority: str = "normal", current_user: str = Depends(get_current_user)):
+    """Записывает в таблицы данные подготовленной задачи без повторного разбора.
+
+    Запись идёт новой задачей в общей очереди импортов; её task_id в ответе.
+    """
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный приоритет: {priority}")
+    task, prepared = prepared_task_data(task_id)
+    if task.get("committed_task_id"):
+        raise HTTPException(status_code=409, detail=f"Задача уже записывается задачей {task['committed_task_id']}")
+    # Города в итогах зависят от настроек - после их изменения файл нужно подготовить заново
+    if task["settings_hash"] != settings_service.get().fingerprint:
+        raise HTTPException(status_code=409, detail="Настройки изменились после подготовки - загрузите файл заново")
+
+    import_id = str(uuid.uuid4())
+    task_store.create(import_id, total=len(CITIES), message=f"Запись подготовленных данных задачи {task_id}",
+                      status="queued", priority=priority, prepared_task_id=task_id)
+    job = submit_job(import_id, None, task["content_hash"], priority, prepared=prepared)
+    task_store.update(task_id, committed_task_id=import_id)
+    logger.info(f"Задача {import_id}: запись подготовленной задачи {task_id} по запросу {current_user}")
+    if job.position:
+        return {"task_id": import_id, "queue_position": job.position,
+                "message": f"Запись поставлена в очередь (позиция {job.position})"}
+    return {"task_id": import_id, "queue_position": None, "message": "Начата запись в таблицы"}
+
+@app.post("/api/tasks/{task_id}/resume")
+async def resume_task(task_id: str, priority: str = "high", current_user: str = Depends(get_current_user)):
+    """Повторяет незавершённую часть импорта: города, не записанные задачей task_id.
+
+    Файл заново не разбирается - берутся итоги из кэша разобранных файлов.
+    Лист, созданный прерванной задачей, не пересоздаётся. Возобновление идёт
+    новой задачей в очереди импортов; её task_id в ответе.
+    """
+    if priority not in JOB_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Неизвестный приоритет: {priority}")
+    task = task_store.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if task["status"] not in ("completed", "failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Задачу нельзя возобновить (статус {task['status']})")
+    if task.get("resumed_task_id"):
+        raise HTTPException(status_code=409, detail=f"Задача уже возобновлена задачей {task['resumed_task_id']}")
+    if not task.get("sheet_date"):
+        raise HTTPException(status_code=409, detail="Задача остановилась до разбора файла - загрузите файл заново")
+    settings_snapshot = settings_service.get()
+    if task["settings_hash"] != settings_snapshot.fingerprint:
+        raise HTTPException(status_code=409, detail="Настройки изменились после импорта - загрузите файл заново")
+    prepared = prepared_cache.get(task["content_hash"], task["settings_hash"])
+    if prepared is None:
+        raise HTTPException(status_code=410, detail="Разобранные данные устарели - загрузите файл заново")
+
+    checkpoints = task.get("checkpoints") or {}
+    settings = settings_snapshot.cities
+    pending = [city for city in CITIES
+               if prepared["city_data"].get(city) and settings.get(city)
+               and not checkpoints.get(city, {}).get("written")]
+    if not pending:
+        raise HTTPException(status_code=409, detail="Все города с данными уже записаны")
+
+    resumed_id = str(uuid.uuid4())
+    task_store.create(resumed_id, total=len(CITIES),
+                      message=f"Возобновление задачи {task_id}: осталось городов {len(pending)}",
+                      status="queued", priority=priority, resumed_from=task_id, checkpoints=checkpoints)
+    job = submit_job(resumed_id, None, task["content_hash"], priority, prepared=prepared,
+                     resume={"date_str": task["sheet_date"], "checkpoints": checkpoints})
+    task_store.update(task_id, resumed_task_id=resumed_id)
+    logger.info(f"Задача {resumed_id}: возобновление задачи {task_id} ({', '.join(pending)}) по запросу {current_user}")
+    if job.position:
+        return {"task_id": resumed_id, "queue_position": job.position, "cities": pending,
+                "message": f"Возобновление поставлено в очередь (позиция {job.position})"}
+    return {"task_id": resumed_id, "queue_position": None, "cities": pending, "message": "Возобновление начато"}
+
+@app.get("/api/tasks/{task_id}/profile")
+async def get_task_profile(task_id: str, format: str = "summary", current_user: str = Depends(get_current_user)):
+    """Профиль задачи: summary (этапы, JSON), pstats (файл для pstats/snakeviz) или collapsed (для flamegraph)"""
+    if format not in PROFILE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный формат профиля: {format}")
+    path = profile_path(task_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Профиль задачи не найден")
+    _, media_type = PROFILE_FORMATS[format]
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
 @app.get("/api/status/{task_id}")
 async def get_task_status(
     task_id: str,
+    request: Request,
+    since: Optional[int] = None,
+    errors_since: Optional[int] = None,
     current_user: str = Depends(get_current_user)
 ):
-    """Получение статуса обработки задачи"""
+    """Получение статуса обработки задачи.
+
+    since/errors_since - курсоры журнала и ошибок (значения success_total и
+    errors_total из прошлого ответа): вернутся только новые записи. ETag - версия
+    задачи; если она не изменилась, ответ 304 без тела.
+    """
     try:
-        # Быстрая проверка без блокировки
-        if task_id not in task_status:
+        version = task_store.version(task_id)
+        if version is None:
             logger.warning(f"Запрос статуса для несуществующей задачи {task_id}")
             raise HTTPException(status_code=404, detail="Задача не найдена")
-        
-        # Возвращаем копию статуса, чтобы избежать блокировки
-        status_copy = task_status[task_id].copy()
-        return status_copy
+
+        etag = f'"{version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+        # Хранилище возвращает копию записи
+        status_copy = task_store.get(task_id, since=since, errors_since=errors_since)
+        if status_copy is None:
+            raise HTTPException(status_code=404, detail="Задача не найдена")
+        return JSONResponse(
+            content=status_copy,
+            headers={"ETag": f'"{status_copy["version"]}"', "Cache-Control": "no-cache"}
+        )
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Ошибка при получении статуса задачи {task_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка при получении статуса задачи")
 
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def format_sse(item) -> str:
+    """Событие задачи в формате text/event-stream (None - heartbeat-комментарий)"""
+    if item is None:
+        return ": ping\n\n"
+    version, event, data = item
+    return f"id: {version}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/api/status/{task_id}/stream")
+async def stream_task_status(
+    task_id: str,
+    request: Request,
+    last_event_id: Optional[str] = None,
+    current_user: str = Depends(get_stream_user)
+):
+    """Поток прогресса задачи (Server-Sent Events): снимок, затем только изменения"""
+    if task_store.get(task_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+
+    # При переподключении EventSource сам присылает заголовок Last-Event-ID
+    resume_from = parse_last_event_id(request.headers.get("Last-Event-ID") or last_event_id)
+
+    async def event_stream():
+        yield "retry: 2000\n\n"
+        async for item in iter_task_events(task_id, resume_from):
+            if await request.is_disconnected():
+                break
+            yield format_sse(item)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/api/status/{task_id}/ws")
+async def websocket_task_status(websocket: WebSocket, task_id: str, token: Optional[str] = None,
+                                last_event_id: Optional[str] = None):
+    """Тот же поток прогресса через WebSocket: сообщения {"id", "event", "data"}"""
+    if not token or verify_token(token) is None:
+        logger.warning("Попытка подписки на поток с неверным токеном")
+        await websocket.close(code=4401)
+        return
+    if task_store.get(task_id) is None:
+        await websocket.close(code=4404)
+        return
 
+    await websocket.accept()
+    try:
+        async for item in iter_task_events(task_id, parse_last_event_id(last_event_id)):
+            if item is None:
+                await websocket.send_json({"event": "ping"})
+            else:
+                version, event, data = item
+                await websocket.send_json({"id": version, "event": event, "data": data})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/api/settings")
 async def get_settings(current_user: str = Depends(get_current_user)):
@@ -776,15 +3250,33 @@ async def save_settings(
         logger.info(f"Сохранение настроек пользователем {current_user}")
         save_settings_to_file(settings)
         return {"message": "Настройки сохранены"}
+    except ValueError as e:
+        logger.warning(f"Настройки не сохранены: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Ошибка при сохранении настроек: {str(e)}")
         raise HTTPException(status_code=500, detail="Ошибка при сохранении настроек")
 
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Метрики в текстовом формате Prometheus"""
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Неверный токен метрик")
+    queue = job_queue.stats()
+    metrics.set("import_tasks_queued", queue["queued"])
+    metrics.set("import_tasks_running", queue["running"])
+    metrics.set("task_store_tasks", task_store.size())
+    prepared = prepared_cache.stats()
+    metrics.set("prepared_cache_files", prepared["files"])
+    metrics.set("prepared_cache_bytes", prepared["size_mb"] * 1024 * 1024)
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/api/clear-cache")
 async def clear_cache(current_user: str = Depends(get_current_user)):
-    """Очищает кэш клиента Google Sheets"""
+    """Очищает кэш клиента Google Sheets и кэш структуры таблиц"""
     try:
         clear_google_client_cache()
+        spreadsheet_cache.clear()
         return {"message": "Кэш очищен"}
     except Exception as e:
         logger.error(f"Ошибка при очистке кэша: {str(e)}")
@@ -797,39 +3289,37 @@ async def clear_today_sheets(current_user: str = Depends(get_current_user)):
         settings = load_settings()
         date_str = datetime.now().strftime("%d%m%y")
         
-        results = []
-        for city, sheet_url in settings.items():
+        async def clear_city(city: str, sheet_url: str) -> str:
             try:
-                client = get_google_sheets_client()
-                sheet_id = extract_sheet_id_from_url(sheet_url)
-                spreadsheet = client.open_by_key(sheet_id)
-                
-                # Задержка между запросами
-                time.sleep(GOOGLE_API_DELAY)
-                
-                # Ищем лист с сегодняшней датой
-                worksheets = spreadsheet.worksheets()
-                for worksheet in worksheets:
-                    if worksheet.title == date_str:
-                        spreadsheet.del_worksheet(worksheet)
-                        results.append(f"✅ {city}: лист {date_str} удален")
-                        break
-                else:
-                    results.append(f"ℹ️ {city}: лист {date_str} не найден")
-                    
+                # Не удаляем лист, в который сейчас пишет задача импорта
+                async with spreadsheet_locks.hold(spreadsheet_locks.key(sheet_url)):
+                    return await run_sheets_io(delete_sheet_with_date, city, sheet_url, date_str)
             except Exception as e:
                 logger.error(f"Ошибка при очистке листа для города {city}: {str(e)}")
-                results.append(f"❌ {city}: ошибка - {str(e)}")
+                return f"❌ {city}: ошибка - {str(e)}"
+
+        # Вызовы Google идут в пуле потоков, частоту ограничивает sheets_limiter
+        results = await asyncio.gather(*(clear_city(city, sheet_url) for city, sheet_url in settings.items()))
         
         return {
             "message": f"Очистка листов с датой {date_str} завершена",
-            "results": results
+            "results": list(results)
         }
         
     except Exception as e:
         logger.error(f"Ошибка при очистке листов: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при очистке листов: {str(e)}")
 
+@app.on_event("shutdown")
+async def shutdown_workers():
+    """Отменяет незавершённые импорты и останавливает пулы потоков"""
+    await job_queue.shutdown()
+    sheets_executor.shutdown(wait=False, cancel_futures=True)
+    parse_executor.shutdown(wait=False, cancel_futures=True)
+    compute_backend.shutdown()
+    google_client_manager.invalidate()
+    task_store.close()
+
 # Убираем SPA fallback роут, так как фронтенд теперь отдельный сервис
 
 if __name__ == "__main__":
@@ -105,7 +105,8 @@ const Dashboard = ({ onLogout }) => {
     e.preventDefault();
   };
 
-  const uploadFile = async () => {
+  // prepare - только проверить файл: итоги по городам без записи в таблицы
+  const uploadFile = async (prepare = false) => {
     if (!selectedFile) {
       setError('Пожалуйста, выберите файл');
       return;
@@ -138,6 +139,7 @@ const Dashboard = ({ onLogout }) => {
         headers: {
           'Content-Type': 'multipart/form-data',
         },
+        params: prepare ? { prepare: true } : {},
         timeout: 120000, // 2 минуты таймаут для больших файлов
         onUploadProgress: (progressEvent) => {
           const percentCompleted = Math.round((progressEvent.loaded * 100) / progressEvent.total);
@@ -173,21 +175,137 @@ const Dashboard = ({ onLogout }) => {
     }
   };
 
-  const trackProcessingStatus = async (taskId) => {
+  // Продолжение задачи новой задачей без повторного разбора файла:
+  // commit - запись проверенного файла, resume - города, не записанные прерванной задачей
+  const continueTask = async (action) => {
+    const taskId = localStorage.getItem('lastTaskId');
+    if (!taskId) {
+      return;
+    }
+    setError('');
+    try {
+      const response = await axios.post(`${API_CONFIG.baseURL}${API_CONFIG.endpoints.tasks}/${taskId}/${action}`);
+      setLastSuccessCount(0);
+      setLastErrorsCount(0);
+      setLogTimes({});
+      localStorage.setItem('lastTaskId', response.data.task_id);
+      trackProcessingStatus(response.data.task_id);
+    } catch (err) {
+      if (err.response && err.response.data && err.response.data.detail) {
+        setError(err.response.data.detail);
+      } else {
+        setError(action === 'commit' ? 'Ошибка при записи в таблицы' : 'Ошибка при возобновлении задачи');
+      }
+    }
+  };
+
+  // Отмена задачи: из очереди - сразу, выполняющейся - после текущего запроса к Google
+  const cancelTask = async () => {
+    const taskId = localStorage.getItem('lastTaskId');
+    if (!taskId) {
+      return;
+    }
+    try {
+      await axios.post(`${API_CONFIG.baseURL}${API_CONFIG.endpoints.tasks}/${taskId}/cancel`);
+    } catch (err) {
+      if (err.response && err.response.data && err.response.data.detail) {
+        setError(err.response.data.detail);
+      } else {
+        setError('Ошибка при отмене задачи');
+      }
+    }
+  };
+
+  // Применяет событие потока к текущему статусу
+  const applyStatusEvent = (status, event, data) => {
+    if (event === 'snapshot') {
+      return data;
+    }
+    if (!status) {
+      return status;
+    }
+    if (event === 'log') {
+      const known = (status.success_offset || 0) + status.success.length;
+      return data.index < known ? status : { ...status, success: [...status.success, data.message] };
+    }
+    if (event === 'task_error') {
+      const known = (status.errors_offset || 0) + status.errors.length;
+      return data.index < known ? status : { ...status, errors: [...status.errors, { city: data.city, message: data.message }] };
+    }
+    if (event === 'progress') {
+      return { ...status, progress: data };
+    }
+    if (event === 'status') {
+      return { ...status, ...data };
+    }
+    return status;
+  };
+
+  const trackProcessingStatus = (taskId) => {
+    // Поток событий (SSE): сервер присылает только изменения
+    if (window.EventSource) {
+      const token = localStorage.getItem('authToken');
+      const url = `${API_CONFIG.baseURL}${API_CONFIG.endpoints.status}/${taskId}/stream?token=${encodeURIComponent(token || '')}`;
+      const source = new EventSource(url);
+      let received = false;
+
+      ['snapshot', 'log', 'task_error', 'progress', 'status'].forEach((eventName) => {
+        source.addEventListener(eventName, (e) => {
+          received = true;
+          const data = JSON.parse(e.data);
+          setProcessingStatus(prevStatus => applyStatusEvent(prevStatus, eventName, data));
+          // Поток закрываем сами, иначе EventSource переподключится после завершения задачи
+          if (['completed', 'failed', 'cancelled', 'prepared'].includes(data.status)) {
+            source.close();
+          }
+        });
+      });
+
+      source.onerror = () => {
+        // До первого события поток недоступен - возвращаемся к опросу.
+        // Иначе EventSource переподключится сам и продолжит с Last-Event-ID.
+        if (!received) {
+          source.close();
+          pollProcessingStatus(taskId);
+        }
+      };
+      return;
+    }
+
+    pollProcessingStatus(taskId);
+  };
+
+  const pollProcessingStatus = async (taskId) => {
+    // Накопленный статус, версия (ETag) и курсоры журнала между запросами
+    let status = null;
+    let etag = null;
+
     const checkStatus = async () => {
       try {
+        const params = status ? { since: status.success_total, errors_since: status.errors_total } : {};
         const response = await axios.get(`${API_CONFIG.baseURL}${API_CONFIG.endpoints.status}/${taskId}`, {
           timeout: 30000, // 30 секунд таймаут
+          params,
+          headers: etag ? { 'If-None-Match': etag } : {},
+          validateStatus: (code) => (code >= 200 && code < 300) || code === 304,
         });
         
-        const status = response.data;
-
-        
-        // Обновляем статус
-        setProcessingStatus(status);
+        if (response.status !== 304) {
+          const delta = response.data;
+          etag = response.headers.etag || null;
+          // Сервер прислал только новые строки журнала и ошибки - дописываем их
+          status = status ? {
+            ...delta,
+            success: [...status.success, ...delta.success],
+            errors: [...status.errors, ...delta.errors],
+          } : delta;
+          
+          // Обновляем статус
+          setProcessingStatus(status);
+        }
         
         // Останавливаем опрос статуса при завершении обработки всех 15 городов
-        if (status.status === 'completed' || status.status === 'failed') {
+        if (['completed', 'failed', 'cancelled', 'prepared'].includes(status.status)) {
           return; // Останавливаем проверку
         }
         
@@ -255,12 +373,20 @@ const Dashboard = ({ onLogout }) => {
             <div style={{ marginTop: '15px' }}>
               <p><strong>Выбранный файл:</strong> {selectedFile.name}</p>
               <button 
-                onClick={uploadFile} 
+                onClick={() => uploadFile(false)} 
                 className="btn" 
                 disabled={uploading}
               >
                 {uploading ? 'Загрузка...' : 'Загрузить и обработать'}
               </button>
+              <button
+                onClick={() => uploadFile(true)}
+                className="btn btn-secondary"
+                disabled={uploading}
+                style={{ marginLeft: '10px' }}
+              >
+                Проверить без записи
+              </button>
               
 
             </div>
@@ -272,6 +398,53 @@ const Dashboard = ({ onLogout }) => {
           <div className="card">
 
             <div className="realtime-logs">
+              {processingStatus.status === 'queued' && processingStatus.queue_position && (
+                <div className="progress-info">
+                  <span className="progress-text">В очереди: позиция {processingStatus.queue_position}</span>
+                </div>
+              )}
+
+              {['queued', 'processing'].includes(processingStatus.status) && (
+                <button onClick={cancelTask} className="btn btn-secondary">
+                  Отменить
+                </button>
+              )}
+
+              {(['failed', 'cancelled'].includes(processingStatus.status) ||
+                (processingStatus.status === 'completed' && processingStatus.errors && processingStatus.errors.length > 0)) && (
+                <button onClick={() => continueTask('resume')} className="btn btn-secondary">
+                  Повторить незаписанные города
+                </button>
+              )}
+
+              {processingStatus.status === 'prepared' && processingStatus.preview && (
+                <div className="progress-info">
+                  <table style={{ width: '100%', marginBottom: '10px' }}>
+                    <thead>
+                      <tr>
+                        <th align="left">Город</th>
+                        <th align="left">Даты</th>
+                        <th align="right">КН</th>
+                        <th align="right">Доход</th>
+                      </tr>
+                    </thead>
+                    <tbody>
+                      {Object.entries(processingStatus.preview).map(([city, item]) => (
+                        <tr key={city}>
+                          <td>{city}</td>
+                          <td>{item.first_date} - {item.last_date} ({item.dates})</td>
+                          <td align="right">{item.kn}</td>
+                          <td align="right">{item.income.toLocaleString()}</td>
+                        </tr>
+                      ))}
+                    </tbody>
+                  </table>
+                  <button onClick={() => continueTask('commit')} className="btn">
+                    Записать в таблицы
+                  </button>
+                </div>
+              )}
+
               {processingStatus.progress && processingStatus.status === 'processing' && (
                 <div className="progress-info">
                   <div className="progress-header">
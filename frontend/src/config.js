@@ -7,6 +7,7 @@ export const API_CONFIG = {
     login: '/api/login',
     upload: '/api/upload',
     status: '/api/status',
+    tasks: '/api/tasks',
     settings: '/api/settings'
   }
 };